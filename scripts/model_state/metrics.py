@@ -36,8 +36,13 @@ config.read("config.txt")
 URI = config.get("neo4j", "url")
 AUTH = (config.get("neo4j", "user"), config.get("neo4j", "pass"))
 
-# The MO extras field is of the format 0xaddr_pages_sizebits
-mo_extra_pages_regex = r'(?<=_)\d+(?=_)'
+# The MO extras field is of the format 0xaddr_pages_sizebits, with _mapcount appended by the proc model
+mo_extra_pages_regex = r'_(\d+)_(\d+)'
+
+def mo_extra_size(extra):
+    # Size of an MO in bytes, since pages may be of different sizes
+    match = re.search(mo_extra_pages_regex, extra)
+    return float(int(match.group(1)) << int(match.group(2)))
 
 def calc_rsi(pd1, pd2):
     # Resource types of interest
@@ -80,10 +85,10 @@ def calc_rsi(pd1, pd2):
         for type,count_union,count_intersect,extras_union,extras_intersect in zip_vals:
             rsi = 0
             if (type == "MO"):
-                # Treat MOs specially, we use the number of pages to calculate RSI for PMR
-                # The 'extras' field contains the number of physical pages
-                rsi = float(sum([float(re.search(mo_extra_pages_regex, extra).group(0)) for extra in extras_intersect])) / \
-                      sum([float(re.search(mo_extra_pages_regex, extra).group(0)) for extra in extras_union])
+                # Treat MOs specially, we use the size of the pages to calculate RSI for PMR
+                # The 'extras' field contains the number and size of physical pages
+                rsi = float(sum([mo_extra_size(extra) for extra in extras_intersect])) / \
+                      sum([mo_extra_size(extra) for extra in extras_union])
             elif count_union > 0:
                 rsi = count_intersect / count_union
 
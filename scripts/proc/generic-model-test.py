@@ -0,0 +1,126 @@
+#!/bin/python3
+
+import csv
+import os
+import tempfile
+import generic_model as gm
+
+
+def boundary():
+    print ("----------------------")
+
+def check(name, expected, actual):
+    print(f'Checking {name}', end ="\t" )
+    if (expected != actual):
+        print(f'FAIL {expected} != {actual}')
+    else:
+        print("PASS")
+
+def build(lazy: bool) -> gm.ModelGraph:
+    """
+    Build the same model with the one-page nodes and their edges kept as ranges, or added one at a time
+    """
+    model = gm.ModelGraph()
+    kernel_id = model.add_pd_node("Kernel")
+    pd_id = model.add_pd_node("p")
+    device_id = model.add_resource_space_node(gm.ResourceType.MO)
+    ads_id = model.add_resource_space_node(gm.ResourceType.VMR)
+
+    # A whole MO node between runs, so the runs do not start at the first ID
+    mo_node_id = model.add_mo_node(device_id, 0x100000, 4, 12, 1)
+
+    def mo_nodes(phys_addr, n_pages, size_bits, mapcount):
+        if lazy:
+            return model.add_mo_nodes(device_id, phys_addr, n_pages, size_bits, mapcount)
+        ids = [model.add_mo_node(device_id, phys_addr + (i << size_bits), 1, size_bits, mapcount) for i in range(n_pages)]
+        return range(ids[0], ids[-1] + 1)
+
+    def vmr_nodes(vmr_type, n_pages, size_bits):
+        if lazy:
+            return model.add_vmr_nodes(ads_id, vmr_type, n_pages, size_bits)
+        ids = [model.add_vmr_node(ads_id, vmr_type, 1, size_bits) for _ in range(n_pages)]
+        return range(ids[0], ids[-1] + 1)
+
+    def hold_edges(perms, holder_id, res_type, space_id, res_ids):
+        if lazy:
+            model.add_hold_edges(perms, holder_id, res_type, space_id, res_ids)
+        else:
+            for res_id in res_ids:
+                model.add_hold_edge(perms, holder_id, res_type, space_id, res_id)
+
+    def map_edges(res_ids_1, res_ids_2, covered=None, covered_step=0):
+        if lazy:
+            model.add_map_edge_range(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, device_id, res_ids_1, res_ids_2, covered, covered_step)
+            return
+        count = len(res_ids_1) if isinstance(res_ids_1, range) else len(res_ids_2)
+        for i in range(count):
+            edge_covered = covered
+            if covered is not None and covered_step != 0:
+                edge_covered = (covered[0] + covered_step * i, covered[0] + covered_step * (i + 1))
+            model.add_map_edge(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, device_id,
+                               res_ids_1[i] if isinstance(res_ids_1, range) else res_ids_1,
+                               res_ids_2[i] if isinstance(res_ids_2, range) else res_ids_2, edge_covered)
+
+    mo_ids = mo_nodes(0x200000, 8, 12, 2)
+    huge_mo_ids = mo_nodes(0x400000, 2, 21, None)
+    single_mo_ids = mo_nodes(0x800000, 1, 12, 3)
+    for res_ids in [mo_ids, huge_mo_ids, single_mo_ids]:
+        hold_edges(gm.perms_all, kernel_id, gm.ResourceType.MO, device_id, res_ids)
+
+    heap_ids = vmr_nodes(gm.VmrType.HEAP, 8, 12)
+    hold_edges(gm.perms_all, kernel_id, gm.ResourceType.VMR, ads_id, heap_ids)
+    hold_edges(gm.Permissions({gm.Permission.R, gm.Permission.W}), pd_id, gm.ResourceType.VMR, ads_id, heap_ids)
+    vmr_node_id = model.add_vmr_node(ads_id, gm.VmrType.LIB, 6)
+    stack_ids = vmr_nodes(gm.VmrType.STACK, 3, 12)
+    hold_edges(gm.perms_all, kernel_id, gm.ResourceType.VMR, ads_id, stack_ids)
+
+    # Page to page, pages to one node with a range each, one node to pages, and a run with no edges
+    map_edges(heap_ids, mo_ids)
+    map_edges(stack_ids, mo_node_id, (0x100000, 0x103000), 0x1000)
+    map_edges(vmr_node_id, huge_mo_ids)
+    map_edges(stack_ids[1:], single_mo_ids[0], (0x800000, 0x801000))
+    model.add_map_edge(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, device_id)
+
+    return model
+
+def csv_rows(model: gm.ModelGraph) -> list[list[str]]:
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "model.csv")
+        model.to_csv(filename)
+        with open(filename, newline='') as file:
+            return list(csv.reader(file))
+
+def edge_list(g) -> list:
+    return sorted((node_from, node_to, sorted(data.items())) for node_from, node_to, data in g.edges(data=True))
+
+def test_ranges():
+    """
+    Compare a model with nodes and edges kept as ranges against the same model built one node and edge at a time
+    """
+    lazy = build(True)
+    eager = build(False)
+
+    check("ranges kept", True, len(lazy.node_ranges) > 0 and len(lazy.edge_ranges) > 0)
+    check("number of nodes", eager.g.number_of_nodes(), lazy.number_of_nodes())
+    check("number of edges", eager.g.number_of_edges(), lazy.number_of_edges())
+
+    check("get_node", dict(eager.g.nodes(data=True)), {node: lazy.get_node(node) for node in eager.g.nodes})
+    check("get_node missing", [None] * 5, [lazy.get_node(string_id) for string_id in
+                                            ["MO_1_99", "VMR_2_0", "MO_1_x", "PD_9", "VMR_SPACE_3"]])
+
+    # Rows of ranges are written after the rest, so only the header has to be in the same place
+    lazy_rows = csv_rows(lazy)
+    eager_rows = csv_rows(eager)
+    check("to_csv header", eager_rows[0], lazy_rows[0])
+    check("to_csv rows", sorted(eager_rows[1:]), sorted(lazy_rows[1:]))
+
+    lazy.expand()
+    check("expand ranges", ({}, []), (lazy.node_ranges, lazy.edge_ranges))
+    check("expand nodes", sorted(eager.g.nodes(data=True)), sorted(lazy.g.nodes(data=True)))
+    check("expand edges", edge_list(eager.g), edge_list(lazy.g))
+    check("to_csv after expand", sorted(eager_rows[1:]), sorted(csv_rows(lazy)[1:]))
+
+if __name__ == "__main__":
+    boundary()
+    test_ranges()
+    boundary()
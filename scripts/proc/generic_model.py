@@ -1,9 +1,11 @@
 from enum import Enum
 import networkx as nx
+import bisect
 import csv
+import itertools
 
 ## Constants
-page_size = 4096 # Assume all 4k pages for now
+page_size = 4096 # Default page size, huge pages carry their own size
 page_size_bits = 12 
 
 class NodeType(Enum):
@@ -83,12 +85,109 @@ class EasyDict():
     def __repr__(self):
         return self.__dict__.__str__()
         
+def covered_extra(start: int, end: int) -> str:
+    """
+    The "extra" field of a map edge to a resource that only covers part of it, from the physical range covered
+    """
+    return f'{start:16x}_{end:16x}'
+
+class NodeRange:
+    """
+    Stands for consecutive one-page resource nodes in a space, which are only expanded to nodes when needed
+    Node i has the ID prefix + (first ID + i), and the extra phys_addr + page_size * i followed by extra_suffix,
+    or just extra_suffix if there is no phys_addr
+    """
+    
+    def __init__(self, res_type: ResourceType, prefix: str, res_ids: range, space_string_id: str, extra_suffix: str, 
+                 phys_addr: int | None = None, page_size: int = page_size):
+        self.res_type = res_type
+        self.prefix = prefix
+        self.res_ids = res_ids
+        self.space_string_id = space_string_id # Every node has a subset edge to the space
+        self.extra_suffix = extra_suffix
+        self.phys_addr = phys_addr
+        self.page_size = page_size
+        self.holds = [] # (PD string ID, permissions) for the hold edges to every node
+    
+    def string_id(self, i: int) -> str:
+        return f'{self.prefix}{self.res_ids[i]}'
+    
+    def node_data(self, i: int) -> dict:
+        """
+        Attributes of node i, as they would be in the graph
+        """
+        extra = self.extra_suffix if self.phys_addr is None else f'{self.phys_addr + self.page_size * i:16x}{self.extra_suffix}'
+        return {"type": NodeType.RESOURCE.name, "data": self.res_type.name, "extra": extra}
+    
+    def edges(self):
+        """
+        Iterate over the (from, to, data) of the subset and hold edges of every node
+        """
+        subset_data = {"type": EdgeType.SUBSET.name, "data": "NONE"}
+        hold_data = [(pd_string_id, {"type": EdgeType.HOLD.name, "data": perms}) for pd_string_id, perms in self.holds]
+        
+        for i in range(len(self.res_ids)):
+            string_id = self.string_id(i)
+            yield string_id, self.space_string_id, subset_data
+            for pd_string_id, data in hold_data:
+                yield pd_string_id, string_id, data
+
+class EdgeRange:
+    """
+    Stands for count map edges, from a run of resources or a single resource in one space
+    to a run of resources or a single resource in another
+    Edge i goes from prefix_1 + (first_1 + step_1 * i) to prefix_2 + (first_2 + step_2 * i), where a step is 0 for a single resource
+    If there is a covered range, edge i covers [start + covered_step * i, start + covered_step * (i + 1)) of it,
+    or all of it if covered_step is 0
+    """
+    
+    def __init__(self, prefix_1: str, first_1: int, step_1: int, prefix_2: str, first_2: int, step_2: int, count: int, 
+                 covered: tuple[int,int] | None = None, covered_step: int = 0):
+        self.prefix_1 = prefix_1
+        self.first_1 = first_1
+        self.step_1 = step_1
+        self.prefix_2 = prefix_2
+        self.first_2 = first_2
+        self.step_2 = step_2
+        self.count = count
+        self.covered = covered
+        self.covered_step = covered_step
+        
+    def edge_data(self, i: int) -> dict:
+        """
+        Attributes of edge i, as they would be in the graph
+        """
+        if self.covered is None:
+            return {"type": EdgeType.MAP.name, "data": "NONE"}
+        
+        (start, end) = self.covered
+        if self.covered_step != 0:
+            (start, end) = (start + self.covered_step * i, start + self.covered_step * (i + 1))
+        return {"type": EdgeType.MAP.name, "data": "NONE", "extra": covered_extra(start, end)}
+        
+    def edges(self):
+        """
+        Iterate over the (from, to, data) of every edge
+        """
+        data = self.edge_data(0)
+        for i in range(self.count):
+            yield (f'{self.prefix_1}{self.first_1 + self.step_1 * i}', f'{self.prefix_2}{self.first_2 + self.step_2 * i}', 
+                   data if self.covered_step == 0 else self.edge_data(i))
+
 class ModelGraph:
+    """
+    Model state graph
+    The one-page nodes added with add_mo_nodes and add_vmr_nodes, their hold edges, and map edges between runs of them,
+    are kept as ranges instead of in the networkx graph g, so the memory they take follows the number of runs.
+    They are expanded by to_csv as it writes them, by get_node for one node, or by expand for all of them
+    """
     def __init__(self):
         self.g = nx.MultiDiGraph()
         self.pd_counter = 0
         self.space_counter = 0
         self.resource_counters = {}
+        self.node_ranges = {} # ID prefix to a list of NodeRange, in order of their first ID
+        self.edge_ranges = [] # list of EdgeRange
         
     def __resource_string_id(self, res_type: ResourceType, space_id: int, res_id: int):
         return f'{res_type.name}_{space_id}_{res_id}'
@@ -122,33 +221,144 @@ class ModelGraph:
         
         return res_id
     
-    def add_vmr_node(self, space_id: int, vmr_type: VmrType, n_pages: int) -> int:
+    def add_vmr_node(self, space_id: int, vmr_type: VmrType, n_pages: int, size_bits: int = page_size_bits) -> int:
         """
         Add a VMR node to a model state graph, including the subset edge to the address space
         
         :param space_id: ID of the address space to add the VMR to
         :param vmr_type: The type of VMR reservation (CODE, STACK, etc.)
-        :param n_pages: Number of 4k pages in the VMR
+        :param n_pages: Number of pages in the VMR
+        :param size_bits: log2 of the size of the pages, 4k by default
         :return: the resource ID
         """
         
         # This is formatted to match the CellulOS output
-        extra = f'{vmr_type.name}_{n_pages}_{page_size_bits}'
+        extra = f'{vmr_type.name}_{n_pages}_{size_bits}'
         return self.add_resource_node(ResourceType.VMR, space_id, None, extra)
     
-    def add_mo_node(self, space_id: int, phys_addr: int, n_pages: int) -> int:
+    def add_mo_node(self, space_id: int, phys_addr: int, n_pages: int, size_bits: int = page_size_bits, mapcount: int | None = None) -> int:
         """
         Add an MO node to a model state graph, including the subset edge to the device
         
         :param space_id: ID of the device's physical memory space to add the MO to
         :param phys_addr: Physical address of this MO
-        :param n_pages: Number of 4k pages in the MO
+        :param n_pages: Number of pages in the MO
+        :param size_bits: log2 of the size of the pages, 4k by default
+        :param mapcount: Number of times the MO's pages are mapped, if known
         :return: the resource ID
         """
         
-        # This is formatted to match the CellulOS output
-        extra = f'{phys_addr:16x}_{n_pages}_{page_size_bits}'
+        # This is formatted to match the CellulOS output, with the map count appended if known
+        extra = f'{phys_addr:16x}_{n_pages}_{size_bits}'
+        if mapcount is not None:
+            extra += f'_{mapcount}'
         return self.add_resource_node(ResourceType.MO, space_id, None, extra)
+    
+    def add_mo_nodes(self, space_id: int, phys_addr: int, n_pages: int, size_bits: int = page_size_bits, mapcount: int | None = None) -> range:
+        """
+        Add an MO node for every page of a physical range at once, like calling add_mo_node for each page
+        The nodes are kept as a range, see ModelGraph
+        
+        :param space_id: ID of the device's physical memory space to add the MOs to
+        :param phys_addr: Physical address of the first page
+        :param n_pages: Number of pages, and of MO nodes
+        :param size_bits: log2 of the size of the pages, 4k by default
+        :param mapcount: Number of times the pages are mapped, if known
+        :return: the resource IDs, in order of the pages
+        """
+        extra_suffix = f'_1_{size_bits}' if mapcount is None else f'_1_{size_bits}_{mapcount}'
+        return self.add_node_range(ResourceType.MO, space_id, n_pages, extra_suffix, phys_addr, 1 << size_bits)
+    
+    def add_vmr_nodes(self, space_id: int, vmr_type: VmrType, n_pages: int, size_bits: int = page_size_bits) -> range:
+        """
+        Add a VMR node for every page of a virtual range at once, like calling add_vmr_node for each page
+        The nodes are kept as a range, see ModelGraph
+        
+        :param space_id: ID of the address space to add the VMRs to
+        :param vmr_type: The type of VMR reservation (CODE, STACK, etc.)
+        :param n_pages: Number of pages, and of VMR nodes
+        :param size_bits: log2 of the size of the pages, 4k by default
+        :return: the resource IDs, in order of the pages
+        """
+        return self.add_node_range(ResourceType.VMR, space_id, n_pages, f'{vmr_type.name}_1_{size_bits}')
+    
+    def add_node_range(self, res_type: ResourceType, space_id: int, n_nodes: int, extra_suffix: str, 
+                       phys_addr: int | None = None, page_size: int = page_size) -> range:
+        """
+        Add consecutive one-page resource nodes to a space, with new IDs, as a NodeRange
+        
+        :param res_type: The resource nodes' type
+        :param space_id: ID of the space to add the resources to
+        :param n_nodes: Number of nodes
+        :param extra_suffix: End of the "extra" field of every node
+        :param phys_addr: Physical address of the first node, at the start of the "extra" field, if any
+        :param page_size: Difference in the physical address of each node
+        :return: the resource IDs, which are consecutive
+        """
+        res_ids = range(self.resource_counters[space_id] + 1, self.resource_counters[space_id] + 1 + n_nodes)
+        self.resource_counters[space_id] += n_nodes
+        
+        if n_nodes > 0:
+            # The string IDs only differ in the resource ID at the end
+            prefix = self.__resource_string_id(res_type, space_id, "")
+            node_range = NodeRange(res_type, prefix, res_ids, self.__space_string_id(res_type, space_id), extra_suffix, phys_addr, page_size)
+            self.node_ranges.setdefault(prefix, []).append(node_range)
+        
+        return res_ids
+    
+    def __find_node_range(self, prefix: str, res_id: int) -> NodeRange | None:
+        """
+        Find the NodeRange with a resource, if it is in one
+        """
+        node_ranges = self.node_ranges.get(prefix, [])
+        i = bisect.bisect_right(node_ranges, res_id, key=lambda node_range: node_range.res_ids.start) - 1
+        
+        if i >= 0 and res_id in node_ranges[i].res_ids:
+            return node_ranges[i]
+        return None
+    
+    def get_node(self, string_id: str) -> dict | None:
+        """
+        Get the attributes of a node, including one that is only in a range
+        
+        :param string_id: the node's string ID, as in the CSV
+        :return: dict of the node's type, data, and extra, or None if there is no such node
+        """
+        if string_id in self.g:
+            return self.g.nodes[string_id]
+        
+        prefix, _, res_id = string_id.rpartition("_")
+        if not res_id.isdigit():
+            return None
+        
+        node_range = self.__find_node_range(prefix + "_", int(res_id))
+        if node_range is None:
+            return None
+        return node_range.node_data(int(res_id) - node_range.res_ids.start)
+    
+    def number_of_nodes(self) -> int:
+        return self.g.number_of_nodes() + sum(len(node_range.res_ids) for node_ranges in self.node_ranges.values() for node_range in node_ranges)
+    
+    def number_of_edges(self) -> int:
+        return (self.g.number_of_edges() 
+                + sum(len(node_range.res_ids) * (1 + len(node_range.holds)) for node_ranges in self.node_ranges.values() for node_range in node_ranges)
+                + sum(edge_range.count for edge_range in self.edge_ranges))
+    
+    def expand(self):
+        """
+        Add all of the nodes and edges kept as ranges to the networkx graph g, for when the whole graph is needed
+        """
+        for node_ranges in self.node_ranges.values():
+            for node_range in node_ranges:
+                self.g.add_nodes_from((node_range.string_id(i), node_range.node_data(i)) for i in range(len(node_range.res_ids)))
+        for node_ranges in self.node_ranges.values():
+            for node_range in node_ranges:
+                self.g.add_edges_from(node_range.edges())
+        for edge_range in self.edge_ranges:
+            self.g.add_edges_from(edge_range.edges())
+        
+        self.node_ranges = {}
+        self.edge_ranges = []
         
     def add_pd_node(self, name: str, pd_id: int | None = None) -> int:
         """
@@ -190,7 +400,7 @@ class ModelGraph:
         
         return space_id
     
-    def __add_edge(self, edge_type: EdgeType, string_id_from: str, string_id_to: str, data: str | None = "NONE"):
+    def __add_edge(self, edge_type: EdgeType, string_id_from: str, string_id_to: str, data: str | None = "NONE", extra: str | None = None):
         """
         Internal function to add an edge to the model state
         
@@ -199,8 +409,12 @@ class ModelGraph:
         :param string_id_to: the string ID of the 'from' node
         :param data: any data string to add to the edge
         :type data: string or None
+        :param extra: any string to put in the edge's "extra" field
         """
-        self.g.add_edge(string_id_from, string_id_to, type=edge_type.name, data=data)
+        if extra is None:
+            self.g.add_edge(string_id_from, string_id_to, type=edge_type.name, data=data)
+        else:
+            self.g.add_edge(string_id_from, string_id_to, type=edge_type.name, data=data, extra=extra)
         
     def add_hold_edge(self, perms: Permission, pd_id: int, res_type: ResourceType, space_id: int, res_id: int | None = None):
         """
@@ -221,7 +435,25 @@ class ModelGraph:
         
         self.__add_edge(EdgeType.HOLD, pd_string_id, target_string_id, str(perms))
         
-    def add_map_edge(self, res_type_1: int, res_type_2: int, space_id_1: int, space_id_2: int, res_id_1: int | None = None, res_id_2: int | None = None):
+    def add_hold_edges(self, perms: Permission, pd_id: int, res_type: ResourceType, space_id: int, res_ids: range):
+        """
+        Add hold edges from a PD to the resources of a range from add_mo_nodes or add_vmr_nodes,
+        like calling add_hold_edge for each
+        
+        :param pd_id: The PD's unique ID
+        :param res_type: The resource space's type
+        :param space_id: The resource space's unique ID
+        :param res_ids: The resources' unique IDs, as returned when adding them
+        """
+        if len(res_ids) == 0:
+            return
+        
+        node_range = self.__find_node_range(self.__resource_string_id(res_type, space_id, ""), res_ids.start)
+        assert node_range is not None and node_range.res_ids == res_ids, "Hold edges can only be added to a whole range of nodes"
+        node_range.holds.append((self.__pd_string_id(pd_id), str(perms)))
+        
+    def add_map_edge(self, res_type_1: int, res_type_2: int, space_id_1: int, space_id_2: int, res_id_1: int | None = None, res_id_2: int | None = None, 
+                     covered: tuple[int,int] | None = None):
         """
         Add a map edge from a PD to a resource to a resource or a resource space to a resource space
         
@@ -233,6 +465,8 @@ class ModelGraph:
                 Optional: if None, the map edge is for a resource space
         :param res_id_1: The destination resource's unique ID
                 Optional: if None, the map edge is for a resource space
+        :param covered: The physical range of the destination resource that the source maps to
+                Optional: if None, the source maps to all of it
         """
         source_string_id = ""
         dest_string_id = ""
@@ -244,7 +478,34 @@ class ModelGraph:
             source_string_id = self.__resource_string_id(res_type_1, space_id_1, res_id_1)
             dest_string_id = self.__resource_string_id(res_type_2, space_id_2, res_id_2)
         
-        self.__add_edge(EdgeType.MAP, source_string_id, dest_string_id)
+        self.__add_edge(EdgeType.MAP, source_string_id, dest_string_id, extra=None if covered is None else covered_extra(*covered))
+    
+    def add_map_edge_range(self, res_type_1: ResourceType, res_type_2: ResourceType, space_id_1: int, space_id_2: int, 
+                           res_ids_1: range | int, res_ids_2: range | int, covered: tuple[int,int] | None = None, covered_step: int = 0):
+        """
+        Add map edges from each resource of a run to the matching resource of another run, kept as an EdgeRange
+        Either side can be a single resource instead, which is then mapped from / to every resource of the other run
+        
+        :param res_type_1: The source resource space's type
+        :param res_type_2: The destination resource space's type
+        :param space_id_1: The source resource space's unique ID
+        :param space_id_2: The destination resource space's unique ID
+        :param res_ids_1: The source resources' unique IDs, with step 1, or a single ID
+        :param res_ids_2: The destination resources' unique IDs, with step 1, or a single ID
+        :param covered: The physical range of the destination resource(s) that the sources map to, if not all of them
+        :param covered_step: If not 0, each edge only covers this much of the range, after the part covered by the edge before
+        """
+        count = len(res_ids_1) if isinstance(res_ids_1, range) else len(res_ids_2) if isinstance(res_ids_2, range) else 1
+        assert not isinstance(res_ids_2, range) or len(res_ids_2) == count, "The runs of resources must be the same length"
+        
+        if count == 0:
+            return
+        
+        (first_1, step_1) = (res_ids_1.start, 1) if isinstance(res_ids_1, range) else (res_ids_1, 0)
+        (first_2, step_2) = (res_ids_2.start, 1) if isinstance(res_ids_2, range) else (res_ids_2, 0)
+        self.edge_ranges.append(EdgeRange(self.__resource_string_id(res_type_1, space_id_1, ""), first_1, step_1, 
+                                          self.__resource_string_id(res_type_2, space_id_2, ""), first_2, step_2, count, 
+                                          covered, covered_step))
     
     def add_request_edge(self, source_pd_id: int, dest_pd_id: int, res_type: ResourceType, space_id: int):
         """
@@ -279,5 +540,16 @@ class ModelGraph:
             for node, data in self.g.nodes(data=True):
                 writer.writerow([data.get("type"), node, data.get("data"), None, None, None, data.get("extra")])
             
-            for node_from, node_to, data in self.g.edges(data=True):
+            # The nodes and edges kept as ranges are expanded as they are written
+            for node_ranges in self.node_ranges.values():
+                for node_range in node_ranges:
+                    for i in range(len(node_range.res_ids)):
+                        data = node_range.node_data(i)
+                        writer.writerow([data.get("type"), node_range.string_id(i), data.get("data"), None, None, None, data.get("extra")])
+            
+            edges = itertools.chain(self.g.edges(data=True), 
+                                    (edge for node_ranges in self.node_ranges.values() for node_range in node_ranges for edge in node_range.edges()),
+                                    (edge for edge_range in self.edge_ranges for edge in edge_range.edges()))
+            
+            for node_from, node_to, data in edges:
                 writer.writerow([None, None, data.get("data"), data.get("type"), node_from, node_to, data.get("extra")]) 
\ No newline at end of file
@@ -1,7 +1,9 @@
 #!/bin/python3
 
+import bisect
+import random
 import utils 
-from utils import insert_with_split
+from utils import insert_with_split, insert_many_with_split
 
 
 def boundary():
@@ -83,6 +85,222 @@ def test_merge():
    
     return
 
+def check(name, expected, actual):
+    print(f'Checking {name}', end ="\t" )
+    if (expected != actual):
+        print(f'FAIL {expected} != {actual}')
+    else:
+        print("PASS")
+
+def test_blocked_list():
+    """
+    Compare a BlockedSortedList with small blocks against a plain sorted list
+    """
+    rng = random.Random(0)
+    blocked = utils.BlockedSortedList()
+    blocked.block_size = 4
+    expected = []
+    
+    for _ in range(1000):
+        x = rng.randrange(2000)
+        blocked.add(x)
+        if x not in expected:
+            bisect.insort(expected, x)
+    
+    check("blocked list contents", expected, list(blocked))
+    check("blocked list split", True, len(blocked.blocks) > 1 and all(len(b) < 8 for b in blocked.blocks))
+    
+    floors, highers, iters = [], [], []
+    for x in range(-1, 2001, 7):
+        i = bisect.bisect_right(expected, x)
+        floors.append(expected[i - 1] if i > 0 else None)
+        highers.append(expected[i] if i < len(expected) else None)
+        iters.append(expected[bisect.bisect_left(expected, x):])
+    check("blocked list floor", floors, [blocked.floor(x) for x in range(-1, 2001, 7)])
+    check("blocked list higher", highers, [blocked.higher(x) for x in range(-1, 2001, 7)])
+    check("blocked list iter_from", iters, [list(blocked.iter_from(x)) for x in range(-1, 2001, 7)])
+
+def test_interval_dict_scale():
+    """
+    Put many intervals in a random order, so the markers are spread over many blocks
+    """
+    rng = random.Random(0)
+    d = utils.IntervalDict()
+    starts = list(range(0, 300000, 3))
+    rng.shuffle(starts)
+    
+    for start in starts:
+        d.put(start, start + 2, str(start))
+    
+    check("many intervals items", [((s, s + 2), str(s)) for s in range(0, 300000, 3)], d.items())
+    check("many intervals get", [((s, s + 2), str(s)) for s in starts[:100]], [d.get(s + 1) for s in starts[:100]])
+    check("many intervals gap", ((None, None), None), d.get(starts[0] + 2))
+    check("many intervals get_interval", [((s, s + 2), str(s)) for s in range(1500, 1530, 3)], d.get_interval(1501, 1530))
+
+def test_from_sorted():
+    """
+    Build from sorted intervals in one pass, and check that it matches building with put
+    """
+    intervals = [((1, 5), 'x'), ((5, 8), 'y'), ((8, 8), 'empty'), ((10, 14), 'z'), ((100, 500), 'w')]
+    d = utils.IntervalDict()
+    for (start, end), value in intervals:
+        d.put(start, end, value)
+    bulk = utils.IntervalDict.from_sorted(intervals)
+    
+    check("from_sorted items", d.items(), bulk.items())
+    check("from_sorted markers", list(d.markers), list(bulk.markers))
+    check("from_sorted get", d.get(6), bulk.get(6))
+    check("from_sorted get_interval", d.get_interval(4, 12), bulk.get_interval(4, 12))
+    
+    many = [((s, s + 2), str(s)) for s in range(0, 300000, 3)]
+    check("from_sorted many", many, utils.IntervalDict.from_sorted(many).items())
+    
+    for name, bad in [("overlap", [((1, 5), 'x'), ((4, 8), 'y')]), ("unsorted", [((10, 14), 'x'), ((1, 5), 'y')])]:
+        try:
+            utils.IntervalDict.from_sorted(bad)
+            check(f"from_sorted {name}", "ValueError", None)
+        except ValueError:
+            check(f"from_sorted {name}", "ValueError", "ValueError")
+
+def test_insert_many():
+    """
+    Insert a batch of overlapping intervals at once, and check that it matches inserting them one at a time
+    """
+    rng = random.Random(0)
+    
+    for n_existing, n_new in [(0, 50), (20, 200), (200, 20), (2000, 5)]:
+        existing = []
+        for s in sorted(rng.sample(range(0, 100000, 10), n_existing)):
+            existing.append(((s, s + rng.randint(1, 10)), {"name": f"old {s}"}))
+        new = []
+        for _ in range(n_new):
+            s = rng.randrange(0, 100000)
+            new.append((s, s + rng.randint(0, 3000), {"name": f"new {s}"}))
+        
+        one_at_a_time = utils.IntervalDict.from_sorted(existing)
+        for (start, end, info) in new:
+            insert_with_split(one_at_a_time, start, end, info)
+        batch = utils.IntervalDict.from_sorted(existing)
+        insert_many_with_split(batch, new)
+        
+        check(f"insert_many {n_existing}+{n_new} items", one_at_a_time.items(), batch.items())
+        check(f"insert_many {n_existing}+{n_new} shared values", [v for (_, v) in one_at_a_time.items()], [v for (_, v) in batch.items()])
+        
+        mutated = [batch.mutate(start) for ((start, _), _) in batch.items()]
+        check(f"insert_many {n_existing}+{n_new} distinct after mutate", len(mutated), len({id(v) for v in mutated}))
+    
+    # The parts of a new interval around an existing one share the new value
+    d = utils.IntervalDict.from_sorted([((10, 20), {"name": "old"})])
+    insert_many_with_split(d, [(0, 30, {"name": "new"})])
+    check("insert_many around", [((0, 10), {"name": "new"}), ((10, 20), {"name": "old"}), ((20, 30), {"name": "new"})], d.items())
+    check("insert_many around shared", True, d.get(5)[1] is d.get(25)[1])
+
+def test_coalesce():
+    """
+    Merge touching intervals with equal values, but not across gaps or different values
+    """
+    d = utils.IntervalDict.from_sorted([((0, 10), 'x'), ((10, 20), 'x'), ((20, 25), 'x'), ((25, 30), 'y'), 
+                                        ((40, 50), 'y'), ((50, 60), 'y'), ((70, 80), 'x')])
+    remap = d.coalesce(lambda a, b: a == b)
+    
+    check("coalesce items", [((0, 25), 'x'), ((25, 30), 'y'), ((40, 60), 'y'), ((70, 80), 'x')], d.items())
+    check("coalesce remap", {10: 0, 20: 0, 50: 40}, remap)
+    check("coalesce get", ((40, 60), 'y'), d.get(55))
+    check("coalesce again", {}, d.coalesce(lambda a, b: a == b))
+
+def test_lazy_split():
+    """
+    Split intervals share their value until one of them is changed through mutate
+    """
+    value = {"name": "x"}
+    d = utils.IntervalDict()
+    d.put(0, 100, value)
+    d.split_interval(40)
+    d.split_interval(70)
+    check("split shared", True, d.get(50)[1] is value and d.get(80)[1] is value)
+    
+    middle = d.mutate(40)
+    middle["name"] = "y"
+    check("mutate copies", [((0, 40), {"name": "x"}), ((40, 70), {"name": "y"}), ((70, 100), {"name": "x"})], d.items())
+    check("mutate again keeps", True, d.mutate(40) is middle)
+    check("mutate shared copies", False, d.mutate(0) is value)
+    check("mutate last holder keeps", True, d.mutate(70) is value)
+    check("mutate distinct", 3, len({id(d.mutate(start)) for start in [0, 40, 70]}))
+    
+    d = utils.IntervalDict.from_sorted([((s, s + 2), str(s)) for s in range(0, 100, 3)])
+    check("iter_interval", d.get_interval(10, 50), list(d.iter_interval(10, 50)))
+    check("iter_interval empty", [], list(d.iter_interval(200, 300)))
+
+def test_persistent():
+    """
+    Compare a PersistentIntervalDict against an IntervalDict, and check that snapshots do not change
+    """
+    rng = random.Random(0)
+    d = utils.IntervalDict()
+    p = utils.PersistentIntervalDict()
+    
+    for _ in range(500):
+        start = rng.randrange(0, 10000)
+        end = start + rng.randint(0, 300)
+        insert_with_split(d, start, end, str(start))
+        insert_with_split(p, start, end, str(start))
+    
+    check("persistent items", d.items(), p.items())
+    check("persistent get", [d.get(k) for k in range(0, 10400, 7)], [p.get(k) for k in range(0, 10400, 7)])
+    check("persistent get_interval", [d.get_interval(k, k + 500) for k in range(0, 10400, 97)], 
+          [p.get_interval(k, k + 500) for k in range(0, 10400, 97)])
+    check("persistent from_sorted", p.items(), utils.PersistentIntervalDict.from_sorted(p.items()).items())
+    
+    snapshot = p.snapshot()
+    before = snapshot.items()
+    insert_with_split(p, 20000, 20100, "new")
+    p.split_interval(20050)
+    (start, end), _ = p.items()[10]
+    p.delete(start)
+    (changed_start, changed_end), _ = p.items()[20]
+    p.mutate(changed_start)
+    
+    check("persistent snapshot unchanged", before, snapshot.items())
+    check("persistent len", len(before) + 1, len(p))
+    check("persistent diff", [((start, end), before[10][1], None), ((20000, 20050), None, "new"), ((20050, 20100), None, "new")], 
+          [change for change in snapshot.diff(p) if change[1] is None or change[2] is None])
+    check("persistent diff same", [], list(p.diff(utils.PersistentIntervalDict.from_sorted(p.items()))))
+
+def test_delete():
+    """
+    Delete intervals and put new ones in the gaps, and compare against a PersistentIntervalDict
+    """
+    rng = random.Random(1)
+    d = utils.IntervalDict()
+    p = utils.PersistentIntervalDict()
+    
+    for _ in range(500):
+        start = rng.randrange(0, 10000)
+        end = start + rng.randint(0, 300)
+        insert_with_split(d, start, end, str(start))
+        insert_with_split(p, start, end, str(start))
+    
+    for _ in range(300):
+        (start, end), _ = rng.choice(d.items())
+        d.delete(start)
+        p.delete(start)
+        # Part of the gap gets a new interval, so markers left behind would make put fail
+        if rng.random() < 0.5:
+            d.put(start, (start + end) // 2 + 1, "gap")
+            p.put(start, (start + end) // 2 + 1, "gap")
+    
+    check("delete items", p.items(), d.items())
+    check("delete len", len(p), len(d))
+    check("delete markers", sorted({k for (interval, _) in d.items() for k in interval}), list(d.markers))
+
 if __name__ == "__main__":
     test_interval_dict()
-    test_merge()
\ No newline at end of file
+    test_merge()
+    test_blocked_list()
+    test_interval_dict_scale()
+    test_from_sorted()
+    test_insert_many()
+    test_coalesce()
+    test_lazy_split()
+    test_persistent()
+    test_delete()
@@ -0,0 +1,368 @@
+#!/bin/python3
+
+"""
+Benchmarks for extracting model state from /proc
+Usage: sudo -E env PATH="./venv/bin:$PATH" python proc-bench.py <benchmark>
+"""
+
+import argparse
+import copy
+import glob
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+
+import proc_model as pm
+from read_pagemap import PAMap, ProcArray, KernelPME, PageMapping, _PM_PRESENT
+
+
+def boundary():
+    print ("----------------------")
+
+# Child process with a THP-heavy heap: the memory is mapped with MADV_HUGEPAGE, then every page is touched
+thp_workload = """
+import mmap, sys, time
+m = mmap.mmap(-1, int(sys.argv[1]) << 20, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+m.madvise(mmap.MADV_HUGEPAGE)
+for i in range(0, len(m), mmap.PAGESIZE):
+    m[i] = 1
+print("ready", flush=True)
+time.sleep(600)
+"""
+
+def bench_thp(size_mb: int):
+    """
+    Compare the size of the model for a THP-heavy process with and without huge page detection
+
+    :param size_mb: size of the THP-backed heap, in MiB
+    """
+    process = subprocess.Popen([sys.executable, "-c", thp_workload, str(size_mb)], stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()
+
+    try:
+        for huge_pages in [False, True]:
+            pm.huge_pages = huge_pages
+
+            data = pm.ProcFsData()
+            start = time.perf_counter()
+            pm.extract_process_data(data, process.pid, "thp")
+            extract_time = time.perf_counter() - start
+
+            boundary()
+            print(f"Huge pages: {huge_pages}, extract: {extract_time:.3f}s, PMRs: {len(data.pmrs.items())}")
+
+            for mapping_type in [pm.MappingType.CONTIGUOUS, pm.MappingType.CO_CONTIGUOUS, pm.MappingType.PER_PAGE]:
+                start = time.perf_counter()
+                model = data.to_generic_model(mapping_type, mapping_type)
+                model_time = time.perf_counter() - start
+
+                print(f"{mapping_type.name:>14}: {model.number_of_nodes():8d} nodes, "
+                      f"{model.number_of_edges():8d} edges, {model_time:.3f}s")
+        boundary()
+    finally:
+        pm.terminate_process(process.pid)
+
+# Child process with an ordinary heap, every page is touched
+touch_workload = """
+import mmap, sys, time
+m = mmap.mmap(-1, int(sys.argv[1]) << 20, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+for i in range(0, len(m), mmap.PAGESIZE):
+    m[i] = 1
+print("ready", flush=True)
+time.sleep(600)
+"""
+
+def bench_parallel(n_procs: int, size_mb: int, n_workers: int):
+    """
+    Compare reading many processes one at a time against reading them with a process pool
+    
+    :param n_procs: number of processes to read
+    :param size_mb: size of the heap of each process, in MiB
+    :param n_workers: number of pool workers, or None for one per CPU
+    """
+    processes = [subprocess.Popen([sys.executable, "-c", touch_workload, str(size_mb)], stdout=subprocess.PIPE, text=True)
+                 for _ in range(n_procs)]
+    for process in processes:
+        process.stdout.readline()
+    pids = [process.pid for process in processes]
+    
+    try:
+        data = pm.ProcFsData()
+        start = time.perf_counter()
+        for pid in pids:
+            pm.extract_process_data(data, pid, "touch")
+        serial_time = time.perf_counter() - start
+        
+        data = pm.ProcFsData()
+        start = time.perf_counter()
+        pm.extract_processes_data(data, pids, ["touch"] * n_procs, n_workers=n_workers)
+        pool_time = time.perf_counter() - start
+        
+        boundary()
+        print(f"Processes: {n_procs}, PMRs: {len(data.pmrs.items())}")
+        print(f"Serial: {serial_time:.3f}s, pool: {pool_time:.3f}s, speedup: {serial_time / pool_time:.2f}x")
+        boundary()
+    finally:
+        for pid in pids:
+            pm.terminate_process(pid)
+
+# Child process with a large heap, which writes to the first pages of the heap on every line of input
+write_workload = """
+import mmap, sys
+m = mmap.mmap(-1, int(sys.argv[1]) << 20, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+for i in range(0, len(m), mmap.PAGESIZE):
+    m[i] = 1
+print("ready", flush=True)
+for line in sys.stdin:
+    for i in range(0, int(line) << 20, mmap.PAGESIZE):
+        m[i] = 2
+    print("written", flush=True)
+"""
+
+def bench_soft_dirty(size_mb: int, dirty_mb: int, rounds: int):
+    """
+    Compare reading a process again from scratch against updating it from its soft-dirty bits
+    
+    :param size_mb: size of the heap of the process, in MiB
+    :param dirty_mb: amount of the heap written between snapshots, in MiB
+    :param rounds: number of snapshots to take after the baseline
+    """
+    process = subprocess.Popen([sys.executable, "-c", write_workload, str(size_mb)], 
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()
+    
+    try:
+        data = pm.ProcFsData()
+        start = time.perf_counter()
+        pm.extract_process_data(data, process.pid, "write", incremental=True)
+        boundary()
+        print(f"Baseline: {time.perf_counter() - start:.3f}s")
+        
+        for i in range(rounds):
+            process.stdin.write(f"{dirty_mb}\n")
+            process.stdin.flush()
+            process.stdout.readline()
+            
+            start = time.perf_counter()
+            pm.update_process_data(data, process.pid)
+            update_time = time.perf_counter() - start
+            
+            full_data = pm.ProcFsData()
+            start = time.perf_counter()
+            pm.extract_process_data(full_data, process.pid, "write")
+            full_time = time.perf_counter() - start
+            
+            model = data.to_generic_model(pm.MappingType.CO_CONTIGUOUS, pm.MappingType.CO_CONTIGUOUS)
+            full_model = full_data.to_generic_model(pm.MappingType.CO_CONTIGUOUS, pm.MappingType.CO_CONTIGUOUS)
+            print(f"Round {i}: update: {update_time:.3f}s ({model.number_of_nodes()} nodes), "
+                  f"full: {full_time:.3f}s ({full_model.number_of_nodes()} nodes)")
+        boundary()
+    finally:
+        pm.terminate_process(process.pid)
+
+def bench_snapshot(size_mb: int, dirty_mb: int, rounds: int):
+    """
+    Compare snapshots of persistent data against deep copies, and diffing the PMRs of two snapshots against
+    comparing all of their items
+    
+    :param size_mb: size of the heap of the process, in MiB
+    :param dirty_mb: amount of the heap written between snapshots, in MiB
+    :param rounds: number of snapshots to take after the baseline
+    """
+    process = subprocess.Popen([sys.executable, "-c", write_workload, str(size_mb)], 
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()
+    
+    try:
+        data = pm.ProcFsData(persistent=True)
+        pm.extract_process_data(data, process.pid, "write", incremental=True)
+        boundary()
+        
+        for i in range(rounds):
+            start = time.perf_counter()
+            snapshot = data.snapshot()
+            snapshot_time = time.perf_counter() - start
+            
+            start = time.perf_counter()
+            copy.deepcopy(data)
+            copy_time = time.perf_counter() - start
+            
+            process.stdin.write(f"{dirty_mb}\n")
+            process.stdin.flush()
+            process.stdout.readline()
+            pm.update_process_data(data, process.pid)
+            
+            start = time.perf_counter()
+            changes = list(snapshot.pmrs.diff(data.pmrs))
+            diff_time = time.perf_counter() - start
+            
+            start = time.perf_counter()
+            snapshot.pmrs.items() == data.pmrs.items()
+            items_time = time.perf_counter() - start
+            
+            print(f"Round {i}: snapshot: {snapshot_time * 1e3:.3f}ms, deep copy: {copy_time * 1e3:.1f}ms, "
+                  f"{len(changes)} of {len(data.pmrs)} PMRs changed, diff: {diff_time * 1e3:.1f}ms, compare items: {items_time * 1e3:.1f}ms")
+        boundary()
+    finally:
+        pm.terminate_process(process.pid)
+
+# Child process with a large reservation, like a VM's guest memory, where only a few regions are touched
+reserve_workload = """
+import mmap, sys, time
+m = mmap.mmap(-1, int(sys.argv[1]) << 20, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS | 0x4000) # MAP_NORESERVE
+for i in range(0, len(m), int(sys.argv[2]) << 20):
+    m[i:i + (1 << 20)] = bytes(1 << 20)
+print(hex(len(m)), flush=True)
+time.sleep(600)
+"""
+
+def bench_scan(size_mb: int, stride_mb: int):
+    """
+    Compare reading the pagemap of a large, mostly untouched reservation with and without PAGEMAP_SCAN
+    
+    :param size_mb: size of the reservation, in MiB
+    :param stride_mb: 1MiB is touched every stride_mb MiB
+    """
+    process = subprocess.Popen([sys.executable, "-c", reserve_workload, str(size_mb), str(stride_mb)], stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()
+    
+    try:
+        boundary()
+        for scan in [False, True]:
+            PAMap.scan_supported = scan
+            m = PAMap(process.pid)
+            
+            start = time.perf_counter()
+            n_runs = 0
+            for line in open(f"/proc/{process.pid}/maps"):
+                (vaddr, vaend) = (int(addr, 16) for addr in line.split()[0].split("-"))
+                if vaend - vaddr >= size_mb << 20:
+                    n_runs = len(m.pa_runs(vaddr, (vaend - vaddr) // m.page_size)[0])
+            print(f"PAGEMAP_SCAN: {PAMap.scan_supported}, runs: {n_runs}, {time.perf_counter() - start:.3f}s")
+        boundary()
+    finally:
+        pm.terminate_process(process.pid)
+
+def bench_pme(n_pages: int):
+    """
+    Per-page overhead of decoding a synthetic pagemap file: with a KernelPME and PageMapping for every page,
+    as the debug printing path does, and by finding the runs on the raw entries, as the scan does
+    
+    :param n_pages: number of entries in the file
+    """
+    # Runs of present pages with consecutive PFNs, separated by jumps in the PFN and by pages that are not present
+    rng = random.Random(0)
+    entries = array("Q")
+    pfn = 1 << 20
+    while len(entries) < n_pages:
+        for _ in range(rng.randint(1, 64)):
+            entries.append((1 << _PM_PRESENT) | pfn)
+            pfn += 1
+        pfn += rng.randint(1, 1024)
+        entries.extend([0] * rng.randint(0, 16))
+    del entries[n_pages:]
+    
+    with tempfile.NamedTemporaryFile() as f:
+        entries.tofile(f)
+        f.flush()
+        m = PAMap()
+        m.pagemap = ProcArray(f.name)
+        
+        def per_page(name, fn):
+            start = time.perf_counter()
+            fn()
+            print(f"{name:>24}: {(time.perf_counter() - start) * 1e9 / n_pages:8.1f} ns/page")
+        
+        def mapping_objects():
+            raw = m.pagemap.read_range(0, n_pages)
+            for (i, e) in enumerate(raw):
+                mapping = PageMapping(va=i * m.page_size)
+                mapping.size = m.page_size
+                mapping.pte = KernelPME(e, pagemap=m)
+        
+        boundary()
+        print(f"Pages: {n_pages}, runs: {len(m.read_runs(0, n_pages)[0])}")
+        per_page("PAMap.mapping per page", lambda: [m.mapping(i * m.page_size) for i in range(n_pages)])
+        per_page("Objects per page", mapping_objects)
+        per_page("Runs of raw entries", lambda: m.read_runs(0, n_pages))
+        boundary()
+
+def bench_pathnames(outputs_dir: str, repeat: int):
+    """
+    Time classifying the VMR pathnames recorded in our outputs, with and without the classifier's cache
+    
+    :param outputs_dir: directory with the recorded outputs, which list pathnames as "- Pathname: <pathname>"
+    :param repeat: number of times to classify every pathname
+    """
+    pathnames = []
+    for path in glob.glob(os.path.join(outputs_dir, "**", "*"), recursive=True):
+        if os.path.isfile(path):
+            with open(path, errors="replace") as f:
+                pathnames += [line[len("- Pathname:"):].strip() for line in f if line.startswith("- Pathname:")]
+    pathnames = [pathname for pathname in pathnames if pathname] * repeat
+    
+    def per_call(name, fn):
+        start = time.perf_counter()
+        for pathname in pathnames:
+            fn(pathname)
+        print(f"{name:>10}: {(time.perf_counter() - start) * 1e9 / len(pathnames):8.1f} ns/pathname")
+    
+    boundary()
+    print(f"Pathnames: {len(pathnames) // repeat} ({len(set(pathnames))} distinct), repeated {repeat} times")
+    per_call("Uncached", pm.vmr_classifier.classify_uncached)
+    per_call("Cached", pm.vmr_classifier.classify)
+    boundary()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the proc model state")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    thp_parser = subparsers.add_parser("thp", help="Model size for a THP-heavy process")
+    thp_parser.add_argument("--size", type=int, default=1024, help="Size of the THP-backed heap, in MiB")
+
+    parallel_parser = subparsers.add_parser("parallel", help="Serial vs. process pool extraction of many processes")
+    parallel_parser.add_argument("--procs", type=int, default=16, help="Number of processes to read")
+    parallel_parser.add_argument("--size", type=int, default=256, help="Size of the heap of each process, in MiB")
+    parallel_parser.add_argument("--jobs", type=int, help="Number of pool workers, defaults to the number of CPUs")
+
+    soft_dirty_parser = subparsers.add_parser("soft-dirty", help="Full vs. incremental snapshots of a process")
+    soft_dirty_parser.add_argument("--size", type=int, default=1024, help="Size of the heap of the process, in MiB")
+    soft_dirty_parser.add_argument("--dirty", type=int, default=4, help="Amount of the heap written between snapshots, in MiB")
+    soft_dirty_parser.add_argument("--rounds", type=int, default=3, help="Number of snapshots after the baseline")
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="Snapshots and diffs of persistent data vs. deep copies")
+    snapshot_parser.add_argument("--size", type=int, default=1024, help="Size of the heap of the process, in MiB")
+    snapshot_parser.add_argument("--dirty", type=int, default=4, help="Amount of the heap written between snapshots, in MiB")
+    snapshot_parser.add_argument("--rounds", type=int, default=3, help="Number of snapshots after the baseline")
+
+    scan_parser = subparsers.add_parser("scan", help="Pagemap reads of a large reservation, with and without PAGEMAP_SCAN")
+    scan_parser.add_argument("--size", type=int, default=16384, help="Size of the reservation, in MiB")
+    scan_parser.add_argument("--stride", type=int, default=256, help="1MiB is touched every stride MiB")
+
+    pme_parser = subparsers.add_parser("pme", help="Per-page overhead of decoding a synthetic pagemap file")
+    pme_parser.add_argument("--pages", type=int, default=1 << 20, help="Number of entries in the file")
+
+    pathnames_parser = subparsers.add_parser("pathnames", help="Classifying the VMR pathnames of the recorded outputs")
+    pathnames_parser.add_argument("--outputs", type=str, default="outputs", help="Directory with the recorded outputs")
+    pathnames_parser.add_argument("--repeat", type=int, default=10000, help="Number of times to classify every pathname")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "thp":
+        bench_thp(args.size)
+    elif args.benchmark == "parallel":
+        bench_parallel(args.procs, args.size, args.jobs)
+    elif args.benchmark == "soft-dirty":
+        bench_soft_dirty(args.size, args.dirty, args.rounds)
+    elif args.benchmark == "snapshot":
+        bench_snapshot(args.size, args.dirty, args.rounds)
+    elif args.benchmark == "scan":
+        bench_scan(args.size, args.stride)
+    elif args.benchmark == "pme":
+        bench_pme(args.pages)
+    elif args.benchmark == "pathnames":
+        bench_pathnames(args.outputs, args.repeat)
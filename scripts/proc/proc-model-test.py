@@ -0,0 +1,177 @@
+#!/bin/python3
+
+import random
+import generic_model as gm
+import proc_model as pm
+
+
+def boundary():
+    print ("----------------------")
+
+def check(name, expected, actual):
+    print(f'Checking {name}', end ="\t" )
+    if (expected != actual):
+        print(f'FAIL {expected} != {actual}')
+    else:
+        print("PASS")
+
+def chain_pathname_to_vmr_type(pathname: str):
+    """
+    The if / elif chain that pathname_to_vmr_type used before the rules were compiled, without the warning
+    """
+    if pathname is None or len(pathname) == 0:
+        return gm.VmrType.NONE
+    if pathname == "[heap]":
+        return gm.VmrType.HEAP
+    elif pathname == "[stack]":
+        return gm.VmrType.STACK
+    elif pathname == "[vvar]":
+        return gm.VmrType.VVAR
+    elif pathname == "[vdso]":
+        return gm.VmrType.VDSO
+    elif pathname == "[vsyscall]":
+        return gm.VmrType.VSYSCALL
+    elif any([(f"OSmosis/scripts/proc/{program_name}" in pathname) for program_name in pm.program_names.__dict__.values()]) \
+        or "/host/bin" in pathname \
+            or pathname.startswith("/root/proc") \
+                or pathname.startswith("/usr/bin"):
+        return gm.VmrType.PROGRAM
+    elif pathname.startswith("/dev/shm"):
+        return gm.VmrType.SHM
+    elif pathname.startswith("/dev/"):
+        return gm.VmrType.DEV
+    elif ":kvm-vcpu" in pathname:
+        return gm.VmrType.KVM
+    elif pathname.startswith("/usr/lib/") \
+         or pathname.endswith(".a") \
+            or pathname.endswith(".so") \
+                or pathname.startswith("/usr/libexec") \
+                    or pathname.startswith("/lib/") \
+                        or "/lib/" in pathname \
+                            or ".so." in pathname:
+        return gm.VmrType.LIB
+    else:
+        return gm.VmrType.UNKNOWN
+
+def test_pathnames():
+    """
+    Compare the compiled rules against the old chain, for pathnames of every type and where rules of different kinds overlap
+    """
+    cases = [
+        (None, gm.VmrType.NONE),
+        ("", gm.VmrType.NONE),
+        ("[heap]", gm.VmrType.HEAP),
+        ("[stack]", gm.VmrType.STACK),
+        ("[vvar]", gm.VmrType.VVAR),
+        ("[vdso]", gm.VmrType.VDSO),
+        ("[vsyscall]", gm.VmrType.VSYSCALL),
+        ("[heap] ", gm.VmrType.UNKNOWN),                          # Exact rules only match the whole pathname
+        ("[anon:glibc malloc]", gm.VmrType.UNKNOWN),
+        ("/memfd:buffer (deleted)", gm.VmrType.UNKNOWN),
+        ("/home/user/OSmosis/scripts/proc/hello", gm.VmrType.PROGRAM),
+        ("/home/user/OSmosis/scripts/proc/hello_malloc", gm.VmrType.PROGRAM),
+        ("/home/user/OSmosis/scripts/proc/hello.so", gm.VmrType.PROGRAM), # Program substring over the library suffix
+        ("/host/bin/sh", gm.VmrType.PROGRAM),
+        ("/root/proc", gm.VmrType.PROGRAM),                       # A prefix can be the whole pathname
+        ("/root/procfs/lib/x.so", gm.VmrType.PROGRAM),             # Program prefix over the library rules
+        ("/usr/bin/python3.12", gm.VmrType.PROGRAM),
+        ("/usr/bin", gm.VmrType.PROGRAM),
+        ("/usr/bi", gm.VmrType.UNKNOWN),                          # Shorter than the prefix
+        ("/dev/shm/data", gm.VmrType.SHM),
+        ("/dev/shm/libx.so", gm.VmrType.SHM),                     # Shared memory prefix over the library suffix
+        ("/dev/shm", gm.VmrType.SHM),
+        ("/dev/zero (deleted)", gm.VmrType.DEV),
+        ("/dev/dri/renderD128", gm.VmrType.DEV),
+        ("/dev/", gm.VmrType.DEV),
+        ("/dev", gm.VmrType.UNKNOWN),
+        ("/dev/x:kvm-vcpu:0", gm.VmrType.DEV),                    # Device prefix over the KVM substring
+        ("anon_inode:kvm-vcpu:0", gm.VmrType.KVM),
+        ("/lib/kvm:kvm-vcpu.so", gm.VmrType.KVM),                 # KVM substring over the library rules
+        ("/usr/lib/x86_64-linux-gnu/libc.so.6", gm.VmrType.LIB),
+        ("/usr/libexec/helper", gm.VmrType.LIB),
+        ("/usr/lib", gm.VmrType.UNKNOWN),
+        ("/lib/ld-linux.so.2", gm.VmrType.LIB),
+        ("/opt/app/lib/plugin", gm.VmrType.LIB),
+        ("/tmp/libfoo.a", gm.VmrType.LIB),
+        ("/tmp/libfoo.so", gm.VmrType.LIB),
+        ("/tmp/libfoo.so.1.2", gm.VmrType.LIB),
+        ("/tmp/libfoo.sox", gm.VmrType.UNKNOWN),
+        ("/tmp/so", gm.VmrType.UNKNOWN),
+        (".so", gm.VmrType.LIB),                                  # A suffix can be the whole pathname
+    ]
+
+    actual = [pm.pathname_to_vmr_type(pathname) for (pathname, _) in cases] # Warns about each unknown pathname
+    check("pathname table", [expected for (_, expected) in cases], actual)
+    check("pathname old chain", [chain_pathname_to_vmr_type(pathname) for (pathname, _) in cases], actual)
+    check("pathname uncached", [pm.vmr_classifier.classify(pathname) for (pathname, _) in cases if pathname],
+          [pm.vmr_classifier.classify_uncached(pathname) for (pathname, _) in cases if pathname])
+
+    # New rules take effect at once, even for pathnames already in the cache, and the lowest priority wins
+    classifier = pm.default_pathname_classifier()
+    before = [classifier.classify(pathname) for pathname in ["/opt/app/bin/run", "/opt/app/lib/x.so", "[heap]"]]
+    classifier.register_rule("prefix", "/opt/app/", gm.VmrType.PROGRAM, 0)
+    classifier.register_rule("exact", "[heap]", gm.VmrType.SHM, 1000)
+    after = [classifier.classify(pathname) for pathname in ["/opt/app/bin/run", "/opt/app/lib/x.so", "[heap]"]]
+    check("pathname rules registered", ([None, gm.VmrType.LIB, gm.VmrType.HEAP], [gm.VmrType.PROGRAM, gm.VmrType.PROGRAM, gm.VmrType.HEAP]),
+          (before, after))
+
+    try:
+        classifier.register_rule("glob", "*", gm.VmrType.LIB)
+        check("pathname unknown kind", "ValueError", None)
+    except ValueError:
+        check("pathname unknown kind", "ValueError", "ValueError")
+
+def unit_shared_ranges(mappings):
+    """
+    Shared ranges found one address at a time, as (start, end, mappings), for mappings over small addresses
+    """
+    mappings = [mapping for mapping in mappings if mapping[3] > 0]
+    order = sorted(range(len(mappings)), key=lambda i: (mappings[i][2], i))
+    shared = []
+    for addr in range(max((paddr + size for (_, _, paddr, size) in mappings), default=0)):
+        active = tuple(i for i in order if mappings[i][2] <= addr < mappings[i][2] + mappings[i][3])
+        if len(active) < 2:
+            continue
+        if shared and shared[-1][1] == addr and shared[-1][2] == active:
+            shared[-1][1] += 1
+        else:
+            shared.append([addr, addr + 1, active])
+    return [(start, end, [(mappings[i][0], mappings[i][1] + start - mappings[i][2]) for i in active]) for (start, end, active) in shared]
+
+def test_shared_ranges():
+    """
+    Check finding the physical ranges mapped more than once
+    """
+    def found(mappings):
+        return [(r.start, r.end, r.mappings) for r in pm.find_shared_ranges(iter(mappings))]
+
+    cases = [
+        ("none", [], []),
+        ("one mapping", [(1, 0x1000, 0, 100)], []),
+        ("touching", [(1, 0x1000, 0, 100), (2, 0x2000, 100, 100)], []),
+        ("same range", [(1, 0x1000, 0, 100), (2, 0x2000, 0, 100)], [(0, 100, [(1, 0x1000), (2, 0x2000)])]),
+        ("partial overlap", [(1, 0x1000, 0, 100), (2, 0x2000, 50, 100)], [(50, 100, [(1, 0x1000 + 50), (2, 0x2000)])]),
+        ("nested", [(1, 0x1000, 0, 100), (1, 0x5000, 20, 10)], [(20, 30, [(1, 0x1000 + 20), (1, 0x5000)])]),
+        ("three deep", [(1, 0, 0, 100), (2, 0, 10, 80), (3, 0, 20, 10)],
+         [(10, 20, [(1, 10), (2, 0)]), (20, 30, [(1, 20), (2, 10), (3, 0)]), (30, 90, [(1, 30), (2, 20)])]),
+        ("one ends where another starts", [(1, 0, 0, 100), (2, 0, 0, 50), (3, 0, 50, 50)],
+         [(0, 50, [(1, 0), (2, 0)]), (50, 100, [(1, 50), (3, 0)])]),
+        ("empty mapping", [(1, 0, 0, 100), (2, 0, 50, 0)], []),
+    ]
+    for (name, mappings, expected) in cases:
+        check(f"shared ranges {name}", expected, found(mappings))
+
+    rng = random.Random(4)
+    mismatches = 0
+    for _ in range(300):
+        mappings = [(rng.randint(1, 3), rng.randrange(0, 1 << 20, 0x1000), rng.randrange(0, 200), rng.randint(0, 60))
+                    for _ in range(rng.randint(0, 12))]
+        if found(mappings) != unit_shared_ranges(mappings):
+            mismatches += 1
+    check("shared ranges random against one address at a time", 0, mismatches)
+
+if __name__ == "__main__":
+    boundary()
+    test_pathnames()
+    test_shared_ranges()
+    boundary()
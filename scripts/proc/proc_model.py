@@ -6,10 +6,13 @@ import subprocess
 from enum import Enum
 import time
 import math
-from dataclasses import dataclass, field
+import functools
+from dataclasses import dataclass, field, replace
+from typing import Iterator
 import traceback
-from utils import EasyDict, IntervalDict, sizeof_fmt, insert_with_split
-from read_pagemap import get_va_pa_mappings, PageMapObj
+import multiprocessing
+from utils import EasyDict, IntervalDict, PersistentIntervalDict, sizeof_fmt, insert_many_with_split
+from read_pagemap import iter_va_pa_columns, get_va_pa_columns, PageMapRow, PageMapColumns, clear_soft_dirty, soft_dirty_supported, soft_dirty_vmrs, max_mapcount, clear_kpageflags_cache
 import generic_model as gm
 import sys
 import pprint  as pp
@@ -24,6 +27,7 @@ pfs_obj = pypfs.procfs() # Interface to the PFS library
 
 ### CONFIGURATION ###
 print_logs = False
+huge_pages = True # Model transparent / hugetlbfs huge pages with their own page size
 
 class ProcessStartType(Enum):
     """
@@ -71,49 +75,149 @@ temp_output_file = "temp.txt" # used to get output from some c programs
 ### MODEL HELPER FUNCTIONS ###
 
 
+class PathnameClassifier():
+    """
+    Classifies VMR pathnames into VMR reservation types, with rules compiled into lookup structures
+    Each rule matches the whole pathname, a prefix, a suffix, or a substring, and the matching rule
+    with the lowest priority wins, then the one registered first
+    Results are kept in an LRU cache by pathname, which is cleared when a rule is registered
+    """
+    
+    kinds = ("exact", "prefix", "suffix", "substring")
+    
+    def __init__(self, cache_size: int = 4096):
+        self.exact = {} # pathname to rule
+        self.prefixes = {} # trie of dicts by character, where the rule for a prefix is under the key None
+        self.suffixes = {} # suffix to rule
+        self.suffix_lengths = set()
+        self.substrings = [] # (substring, rule), sorted by rule
+        self.n_rules = 0
+        self.cached_classify = functools.lru_cache(maxsize=cache_size)(self.classify_uncached)
+    
+    def register_rule(self, kind: str, pattern: str, vmr_type: gm.VmrType, priority: int = 0):
+        """
+        Add a rule, which takes effect immediately
+        
+        :param kind: one of kinds, how the pattern is matched against a pathname
+        :param pattern: string to match
+        :param vmr_type: type of the VMRs whose pathnames match
+        :param priority: rules with lower priorities are checked first, the built-in rules start from 100
+        """
+        # A rule is (priority, order registered, type), so that the lowest is the one that wins
+        rule = (priority, self.n_rules, vmr_type)
+        self.n_rules += 1
+        
+        if kind == "exact":
+            self.exact[pattern] = min(rule, self.exact.get(pattern, rule))
+        elif kind == "prefix":
+            node = self.prefixes
+            for char in pattern:
+                node = node.setdefault(char, {})
+            node[None] = min(rule, node.get(None, rule))
+        elif kind == "suffix":
+            self.suffixes[pattern] = min(rule, self.suffixes.get(pattern, rule))
+            self.suffix_lengths.add(len(pattern))
+        elif kind == "substring":
+            self.substrings.append((pattern, rule))
+            self.substrings.sort(key=lambda substring: substring[1])
+        else:
+            raise ValueError(f"Unknown kind of pathname rule '{kind}'")
+        
+        self.cached_classify.cache_clear()
+    
+    def classify_uncached(self, pathname: str) -> gm.VmrType | None:
+        """
+        Find the type for a pathname from the rules, without the cache
+        
+        :return: the type of the matching rule that wins, or None if no rule matches
+        """
+        best = self.exact.get(pathname)
+        
+        node = self.prefixes
+        for char in pathname:
+            if None in node and (best is None or node[None] < best):
+                best = node[None]
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            if None in node and (best is None or node[None] < best):
+                best = node[None]
+        
+        for length in self.suffix_lengths:
+            rule = self.suffixes.get(pathname[-length:])
+            if rule is not None and (best is None or rule < best):
+                best = rule
+        
+        # Sorted, so the first match is the best substring rule
+        for substring, rule in self.substrings:
+            if best is not None and rule > best:
+                break
+            if substring in pathname:
+                best = rule
+                break
+        
+        return None if best is None else best[2]
+    
+    def classify(self, pathname: str) -> gm.VmrType | None:
+        """
+        Find the type for a pathname from the rules
+        
+        :return: the type of the matching rule that wins, or None if no rule matches
+        """
+        return self.cached_classify(pathname)
+
+def default_pathname_classifier() -> PathnameClassifier:
+    """
+    Make a classifier with the built-in rules, for the pathnames seen on Linux and for the programs in program_names
+    """
+    classifier = PathnameClassifier()
+    rules = [
+        (gm.VmrType.HEAP, "exact", ["[heap]"]),
+        (gm.VmrType.STACK, "exact", ["[stack]"]),
+        (gm.VmrType.VVAR, "exact", ["[vvar]"]), # what is this?
+        (gm.VmrType.VDSO, "exact", ["[vdso]"]), # what is this?
+        (gm.VmrType.VSYSCALL, "exact", ["[vsyscall]"]), # what is this?
+        # I don't think code and data are separated
+        (gm.VmrType.PROGRAM, "substring", [f"OSmosis/scripts/proc/{program_name}" for program_name in program_names.__dict__.values()] + ["/host/bin"]),
+        (gm.VmrType.PROGRAM, "prefix", ["/root/proc", "/usr/bin"]),
+        (gm.VmrType.SHM, "prefix", ["/dev/shm"]),
+        (gm.VmrType.DEV, "prefix", ["/dev/"]),
+        (gm.VmrType.KVM, "substring", [":kvm-vcpu"]),
+        (gm.VmrType.LIB, "prefix", ["/usr/lib/", "/usr/libexec", "/lib/"]),
+        (gm.VmrType.LIB, "suffix", [".a", ".so"]),
+        (gm.VmrType.LIB, "substring", ["/lib/", ".so."]),
+    ]
+    
+    # Rules for the same type share a priority, and types earlier in the list take precedence
+    priority = 100
+    for i, (vmr_type, kind, patterns) in enumerate(rules):
+        if i > 0 and vmr_type != rules[i - 1][0]:
+            priority += 100
+        for pattern in patterns:
+            classifier.register_rule(kind, pattern, vmr_type, priority)
+    
+    return classifier
+
+vmr_classifier = default_pathname_classifier() # Add rules for more pathnames with vmr_classifier.register_rule
+
 def pathname_to_vmr_type(pathname: str):
     """
     Convert a pathname to a VMR reservation type
     
     :param pathname: pathname of a VMR, as read from the /proc/pid/maps file
     """
-    global program_names
-    
     if pathname is None or len(pathname) == 0:
         return gm.VmrType.NONE
-    if pathname == "[heap]":
-        return gm.VmrType.HEAP
-    elif pathname == "[stack]":
-        return gm.VmrType.STACK
-    elif pathname == "[vvar]": # what is this?
-        return gm.VmrType.VVAR
-    elif pathname == "[vdso]": # what is this?
-        return gm.VmrType.VDSO
-    elif pathname == "[vsyscall]": # what is this?
-        return gm.VmrType.VSYSCALL
-    elif any([(f"OSmosis/scripts/proc/{program_name}" in pathname) for program_name in program_names.__dict__.values()]) \
-        or "/host/bin" in pathname \
-            or pathname.startswith("/root/proc") \
-                or pathname.startswith("/usr/bin"):
-        return gm.VmrType.PROGRAM # I don't think code and data are separated
-    elif pathname.startswith("/dev/shm"):
-        return gm.VmrType.SHM
-    elif pathname.startswith("/dev/"):
-        return gm.VmrType.DEV
-    elif ":kvm-vcpu" in pathname:
-        return gm.VmrType.KVM
-    elif pathname.startswith("/usr/lib/") \
-         or pathname.endswith(".a") \
-            or pathname.endswith(".so") \
-                or pathname.startswith("/usr/libexec") \
-                    or pathname.startswith("/lib/") \
-                        or "/lib/" in pathname \
-                            or ".so." in pathname:
-        return gm.VmrType.LIB
-    else:
+    
+    vmr_type = vmr_classifier.classify(pathname)
+    
+    if vmr_type is None:
         print(f"Warning: unknown pathname '{pathname}' for VMR")
         return gm.VmrType.UNKNOWN
     
+    return vmr_type
+    
 def perms_to_model_perms(perm: pypfs.mem_perm):
     """ 
     Convert a set of permissions from PFS to the generic model's Permissions object
@@ -133,17 +237,38 @@ def perms_to_model_perms(perm: pypfs.mem_perm):
     
     return gm.Permissions(perm_set)
 
-def size_to_pages(size: int) -> int:
+def perms_key(perm: pypfs.mem_perm) -> tuple:
+    """
+    Get a comparable tuple for a set of permissions from PFS
+    """
+    return (perm.can_read, perm.can_write, perm.can_execute, perm.is_private, perm.is_shared)
+
+def size_to_pages(size: int, page_size: int = gm.page_size) -> int:
         """
-        Convert the size of a region to the number of pages, assuming 4k pages
+        Convert the size of a region to the number of pages, assuming 4k pages by default
         
         :return: the number of pages
         """
         
-        n_pages = size / gm.page_size
+        n_pages = size / page_size
         assert(n_pages % 1 == 0)
         return math.ceil(n_pages)
 
+def page_size_to_bits(page_size: int) -> int:
+    """
+    Convert a page size to the size bits used in the model, e.g. 12 for 4k pages
+    """
+    return page_size.bit_length() - 1
+
+def region_page_size(start: int, end: int, page_size: int) -> int:
+    """
+    Get the page size to model a region with
+    This is the region's own page size, unless the region was split somewhere that is not aligned to it
+    """
+    if start % page_size != 0 or end % page_size != 0:
+        return gm.page_size
+    return page_size
+
 ### DATA STORAGE CLASSES ###
 
 @dataclass
@@ -151,6 +276,7 @@ class SubVMR:
     """Tracks a single contiguous mapping of a VMR to a contiguous PMR, or an unmapped VMR"""
     mapped: bool = False # Whether or not this VMR is mapped to a PMR
     pmr: tuple[int,int] = None # The PMR range that this VMR maps to
+    page_size: int = gm.page_size # Size of the pages in this mapping, larger for huge pages
     
 @dataclass
 class VMR:
@@ -159,7 +285,7 @@ class VMR:
     perms: pypfs.mem_perm # Store of permissions for the VMR as given by pfs
     sub_vmrs: IntervalDict = field(default_factory=lambda: IntervalDict()) # Dict of contiguous mappings within this VMR
     # Address range is tracked by the IntervalDict
-    model_id: list[int] = field(default_factory=list) # The ID(s) of this node in the model state, once added
+    model_id: list[int | range] = field(default_factory=list) # The ID(s) of this node in the model state, once added, with a range for each run of per-page nodes
     
 @dataclass
 class ProcAddressSpace:
@@ -212,21 +338,56 @@ class Device:
     """Tracks a physical memory device in the system"""
     size: int           # Size of the device, in bytes
     # Address range is tracked by the IntervalDict
-    model_id: int = 0 # The ID of this node in the model state, once added
+    model_id: int = field(default=0, compare=False) # The ID of this node in the model state, once added, not part of what is compared by diff
 
 @dataclass
 class PMR:
     """Tracks a PMR in the system"""
     device: Device # The Device this PMR is from
     # Address range is tracked by the IntervalDict
-    model_id: list[int] = field(default_factory=list) # The ID(s) of this node in the model state, once added
+    model_id: list[int] = field(default_factory=list, compare=False) # The ID(s) of this node in the model state, once added, not part of what is compared by diff
+    page_size: int = gm.page_size # Size of the pages in this PMR, larger for huge pages
+    mapcount: int = 0 # Largest number of times any of the pages is mapped, more than 1 if shared
     
     # Define copy for when PMRs get split
     def __copy__(self):
-        result = PMR(self.device)
+        result = PMR(self.device, page_size=self.page_size, mapcount=self.mapcount)
         
         return result
 
+@dataclass
+class SharedRange:
+    """A physical range that is mapped more than once, by one or more processes"""
+    start: int # Start of the physical range
+    end: int # End of the physical range
+    mappings: list[tuple[int,int]] # (PID, vaddr of the start of the range) for every mapping of the range
+
+@dataclass
+class MapPerm:
+    """Picklable copy of the permissions of a pfs mem_region"""
+    can_read: bool
+    can_write: bool
+    can_execute: bool
+    is_private: bool
+    is_shared: bool
+
+@dataclass
+class MapEntry:
+    """Picklable copy of the fields of a pfs mem_region that we use"""
+    start_address: int
+    end_address: int
+    pathname: str
+    perm: MapPerm
+
+@dataclass
+class ProcessCapture:
+    """Everything read from procfs for one process, as returned by a capture worker"""
+    pid: int # PID of the process in the global namespace
+    name: str # Name of the process
+    pid_in_ns: int # PID of the process according to its own PID namespace
+    maps: list[MapEntry] # The parsed /proc/pid/maps file
+    pagemap: PageMapColumns # The VA and VA->PA regions, for all of the VMRs
+
 # Different ways to display VA / PA nodes in the graph
 class MappingType(Enum):
     PER_PAGE = 1        # Every node is exactly one page
@@ -239,30 +400,233 @@ class ProcFsData():
     This object can be converted to the generic ModelGraph
     """
     
-    def __init__(self):
+    def __init__(self, persistent: bool = False):
+        """
+        :param persistent: if true, keep the data in PersistentIntervalDicts, so that snapshot can be used
+        """
+        self.persistent = persistent
+        self.interval_dict = PersistentIntervalDict if persistent else IntervalDict # Class of all the interval dicts
         self.namespaces = {} # dict from namespace handle to Namespace
         self.procs = {} # dict from PID to Process
-        self.pmrs = IntervalDict() # list of PMR
-        self.devices = IntervalDict() # list of physical memory devices, ProcDev
+        self.pmrs = self.interval_dict() # list of PMR
+        self.devices = self.interval_dict() # list of physical memory devices, ProcDev
+        self.pmr_runs = None # contiguous runs of PMRs, while converting to a model with contiguous PMRs
+    
+    def new_process(self, name: str, pid_in_ns: int = 0) -> Process:
+        """
+        Make a Process with an empty address space of the right kind for this data object
+        """
+        return Process(name, ads=ProcAddressSpace(self.interval_dict()), pid_in_ns=pid_in_ns)
     
-    def __map_vmr_to_pmrs(self, mapped_devices: set, ads_id: int, vmr_node_id: int, pmr_range_start: int, pmr_range_end: int):
+    def snapshot(self) -> 'ProcFsData':
+        """
+        Take a snapshot of a persistent data object, which later updates to either one do not change
+        The interval dicts are shared with the snapshot, so this is O(number of processes)
+        The values in them are shared as well. to_generic_model copies the PMRs and VMRs before setting their model IDs,
+        but sets the model IDs of the devices in place, since PMRs refer to their device by identity
+        """
+        if not self.persistent:
+            raise ValueError("Only a persistent ProcFsData can be snapshot")
+        
+        result = ProcFsData(persistent=True)
+        result.namespaces = dict(self.namespaces)
+        result.procs = {pid: replace(process, ads=replace(process.ads, vmrs=process.ads.vmrs.snapshot())) 
+                        for pid, process in self.procs.items()}
+        result.pmrs = self.pmrs.snapshot()
+        result.devices = self.devices.snapshot()
+        
+        return result
+    
+    def __map_vmr_to_pmrs(self, mapped_devices: set, ads_id: int, vmr_node_id: int | range, pmr_range_start: int, pmr_range_end: int):
         """
         Helper function during conversion to generic model
-        Maps a VMR node to the co-contiguous PMRs within a range
+        Maps a VMR node, or every node of a run of per-page VMR nodes, to the co-contiguous PMRs within a range
         
         :param mapped_devices: set of devices to update
         :param ads_id: ID of the VMR's address space in the model
-        :param vmr_node_id: ID of the VMR's node in the model
+        :param vmr_node_id: ID of the VMR's node in the model, or the range of IDs of the VMR's page nodes
         :param pmr_range_start: start of the PMR range to map to
         :param pmr_range_end: end of the PMR range to map to
         """
         
         # Iterate through all PMR regions (may have been split)
-        pmrs = self.pmrs.get_interval(pmr_range_start, pmr_range_end)
+        for (pmr_start, pmr_end), pmr_info in self.pmrs.iter_interval(pmr_range_start, pmr_range_end):
+            mapped_devices.add(pmr_info.device.model_id)
+            if isinstance(vmr_node_id, range):
+                self.model.add_map_edge_range(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, pmr_info.device.model_id, vmr_node_id, pmr_info.model_id[0])
+            else:
+                self.model.add_map_edge(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, pmr_info.device.model_id, vmr_node_id, pmr_info.model_id[0])
+            
+    def __map_vmr_to_pmr_runs(self, mapped_devices: set, run_covers: dict, ads_id: int, vmr_node_ids: range | int, 
+                              paddr_start: int, paddr_end: int, page_size: int):
+        """
+        Helper function during conversion to generic model
+        Maps a VMR node, or each page of a run of per-page VMR nodes, to the contiguous PMR runs backing it
+        Each map edge carries the physical range of the run it covers, so the runs are not split where VMRs map them
+        A single VMR node can map a run through several of its sub-VMRs, so its covered ranges are only collected
+        in run_covers, for __add_run_map_edges to join
+        
+        :param mapped_devices: set of devices to update
+        :param run_covers: dict of (VMR node ID, device ID, run node ID) to the ranges covered, to update
+        :param ads_id: ID of the VMR's address space in the model
+        :param vmr_node_ids: IDs of the VMR node for each page, or the ID of one VMR node for the whole range
+        :param paddr_start: start of the physical range to map to
+        :param paddr_end: end of the physical range to map to
+        :param page_size: size of the pages, if there is a VMR node for each
+        """
+        
+        for (run_start, run_end), run_info in self.pmr_runs.iter_interval(paddr_start, paddr_end):
+            mapped_devices.add(run_info.device.model_id)
+            covered_start = max(paddr_start, run_start)
+            covered_end = min(paddr_end, run_end)
+            
+            if not isinstance(vmr_node_ids, range):
+                run_covers.setdefault((vmr_node_ids, run_info.device.model_id, run_info.model_id[0]), []).append((covered_start, covered_end))
+                continue
+            
+            # The pages wholly in the run each cover their own page of it
+            first = (covered_start - paddr_start + page_size - 1) // page_size
+            end = (covered_end - paddr_start) // page_size
+            if first < end:
+                self.model.add_map_edge_range(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, run_info.device.model_id, 
+                                              vmr_node_ids[first:end], run_info.model_id[0], 
+                                              (paddr_start + page_size * first, paddr_start + page_size * end), page_size)
+            
+            # The pages partly in the run cover the part of them that is
+            partial = sorted({(covered_start - paddr_start) // page_size, (covered_end - 1 - paddr_start) // page_size})
+            for i in partial:
+                if first <= i < end:
+                    continue
+                
+                page_paddr = paddr_start + page_size * i
+                self.model.add_map_edge(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, run_info.device.model_id, vmr_node_ids[i], 
+                                        run_info.model_id[0], (max(page_paddr, run_start), min(page_paddr + page_size, run_end)))
+    
+    def __add_run_map_edges(self, ads_id: int, run_covers: dict):
+        """
+        Helper function during conversion to generic model
+        Adds the map edges from single VMR nodes to PMR runs collected by __map_vmr_to_pmr_runs
+        Covered ranges which touch or overlap are joined, so there is one edge per separate part of a run a VMR node maps
+        
+        :param ads_id: ID of the VMRs' address space in the model
+        :param run_covers: dict of (VMR node ID, device ID, run node ID) to the ranges covered
+        """
+        for (vmr_node_id, device_id, run_node_id), ranges in run_covers.items():
+            ranges.sort()
+            covered_start, covered_end = ranges[0]
+            for (start, end) in ranges[1:] + [(None, None)]:
+                if start is not None and start <= covered_end:
+                    covered_end = max(covered_end, end)
+                    continue
+                
+                self.model.add_map_edge(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, device_id, vmr_node_id, run_node_id, 
+                                        (covered_start, covered_end))
+                covered_start, covered_end = start, end
+    
+    def __map_vmr_pages_to_pmr_pages(self, mapped_devices: set, ads_id: int, vmr_node_ids: range | int, n_pages: int, paddr_start: int, page_size: int):
+        """
+        Helper function during conversion to generic model
+        Maps each page of a run of contiguous pages to every per-page PMR node backing it
+        The PMRs are looked up once for the whole run, and the pages are joined with the node IDs of each PMR
         
-        for (pmr_start, pmr_end), pmr_info  in pmrs:
+        :param mapped_devices: set of devices to update
+        :param ads_id: ID of the VMR's address space in the model
+        :param vmr_node_ids: IDs of the VMR node for each page of the run, or the ID of one VMR node for all of them
+        :param n_pages: number of pages in the run
+        :param paddr_start: physical address of the first page of the run
+        :param page_size: size of the pages of the run
+        """
+        paddr_end = paddr_start + page_size * n_pages
+        
+        for (pmr_start, pmr_end), pmr_info in self.pmrs.iter_interval(paddr_start, paddr_end):
             mapped_devices.add(pmr_info.device.model_id)
-            self.model.add_map_edge(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, pmr_info.device.model_id, vmr_node_id, pmr_info.model_id[0])
+            pmr_page_size = region_page_size(pmr_start, pmr_end, pmr_info.page_size)
+            
+            # The pages of the run that overlap this PMR
+            first = (max(paddr_start, pmr_start) - paddr_start) // page_size
+            last = (min(paddr_end, pmr_end) - 1 - paddr_start) // page_size
+            
+            if pmr_page_size == page_size and (pmr_start - paddr_start) % page_size == 0:
+                # Each page is one page of the PMR, so the pages line up with a slice of the PMR's node IDs
+                first_pmr_page = (paddr_start + page_size * first - pmr_start) // page_size
+                pmr_node_ids = pmr_info.model_id[first_pmr_page:first_pmr_page + last + 1 - first]
+                page_vmr_node_ids = vmr_node_ids[first:last + 1] if isinstance(vmr_node_ids, range) else vmr_node_ids
+                self.model.add_map_edge_range(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, pmr_info.device.model_id, page_vmr_node_ids, pmr_node_ids)
+            else:
+                # Find the model state IDs for the PMR pages overlapping each page
+                for i in range(first, last + 1):
+                    page_paddr = paddr_start + page_size * i
+                    first_page = (max(page_paddr, pmr_start) - pmr_start) // pmr_page_size
+                    last_page = (min(page_paddr + page_size, pmr_end) - 1 - pmr_start) // pmr_page_size
+                    page_vmr_node_id = vmr_node_ids[i] if isinstance(vmr_node_ids, range) else vmr_node_ids
+                    self.model.add_map_edge_range(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, pmr_info.device.model_id, 
+                                                  page_vmr_node_id, pmr_info.model_id[first_page:last_page + 1])
+        
+    def shared_pmrs(self, min_mapcount: int = 2) -> list[tuple[tuple[int,int], PMR]]:
+        """
+        Get the PMRs mapped at least min_mapcount times, as found from /proc/kpagecount
+        This does not need the model to be built, or the processes sharing the PMRs to have been extracted
+        """
+        return [(pmr_range, pmr_info) for pmr_range, pmr_info in self.pmrs.items() if pmr_info.mapcount >= min_mapcount]
+    
+    def shared_ranges(self) -> list[SharedRange]:
+        """
+        Find the physical ranges mapped more than once, by any of the processes
+        """
+        return find_shared_ranges((pid, sub_start, sub_vmr_info.pmr[0], sub_end - sub_start)
+                                  for pid, process_info in self.procs.items()
+                                  for _, vmr_info in process_info.ads.vmrs.items()
+                                  for (sub_start, sub_end), sub_vmr_info in vmr_info.sub_vmrs.items() if sub_vmr_info.mapped)
+    
+    def prune_pmrs_in(self, ranges: list[tuple[int,int]]):
+        """
+        Drop the PMRs within some physical ranges that no page table maps anymore, such as the ones that the
+        sub-VMRs replaced by update_process_data used to map
+        Only the PMRs in the ranges are looked at, and /proc/kpagecount is read for them, so this does not go through
+        every PMR and sub-VMR. A PMR still mapped by a process that is not in this data is kept
+        
+        :param ranges: list of (start, end) physical ranges, which can overlap
+        """
+        merged = []
+        for (start, end) in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        
+        unmapped = [pmr_start for (start, end) in merged for (pmr_start, pmr_end), _ in self.pmrs.iter_interval(start, end)
+                    if start <= pmr_start and pmr_end <= end and max_mapcount(pmr_start, pmr_end - pmr_start) == 0]
+        for pmr_start in unmapped:
+            self.pmrs.delete(pmr_start)
+        
+    def coalesce_pmrs(self) -> dict[int,int]:
+        """
+        Merge touching PMRs from the same device, with the same page size and mapcount, into one
+        The model then has one MO node for each merged PMR instead of one for each split
+        
+        :return: dict from the old start of every PMR that was merged away to the start of the merged PMR
+        """
+        return self.pmrs.coalesce(lambda a, b: a.device is b.device and a.page_size == b.page_size and a.mapcount == b.mapcount)
+    
+    def contiguous_pmrs(self) -> IntervalDict:
+        """
+        Get the runs of touching PMRs from the same device, whichever VMRs map them, without changing the PMRs
+        Each run has the page size of its PMRs if they all have the same one, and their largest mapcount
+        
+        :return: IntervalDict of a new PMR for each run
+        """
+        runs = []
+        for (start, end), pmr_info in self.pmrs.items():
+            if len(runs) > 0 and runs[-1][0][1] == start and runs[-1][1].device is pmr_info.device:
+                (run_start, _), run_info = runs[-1]
+                runs[-1] = ((run_start, end), run_info)
+                if run_info.page_size != pmr_info.page_size:
+                    run_info.page_size = gm.page_size
+                run_info.mapcount = max(run_info.mapcount, pmr_info.mapcount)
+            else:
+                runs.append(((start, end), PMR(pmr_info.device, page_size=pmr_info.page_size, mapcount=pmr_info.mapcount)))
+        
+        return IntervalDict.from_sorted(runs)
         
     def to_generic_model(self, vmr_mapping_type: MappingType, pmr_mapping_type: MappingType) -> gm.ModelGraph:
         """
@@ -283,21 +647,29 @@ class ProcFsData():
             device_info.model_id = self.model.add_resource_space_node(gm.ResourceType.MO)
                     
         # Add the PMRs
-        for (start, end), pmr_info in self.pmrs.items():
-            n_pages = size_to_pages(end - start)
+        pmrs = self.pmrs
+        if pmr_mapping_type is MappingType.CONTIGUOUS:
+            # Each run of touching PMRs is a node, and the PMRs themselves are not added
+            self.pmr_runs = self.contiguous_pmrs()
+            pmrs = self.pmr_runs
             
-            if pmr_mapping_type is MappingType.CO_CONTIGUOUS:
+        for (start, end), pmr_info in pmrs.items():
+            # Split PMRs share their value until here, when each gets its own model IDs
+            pmr_info = pmrs.mutate(start)
+            pmr_info.model_id = []
+            page_size = region_page_size(start, end, pmr_info.page_size)
+            size_bits = page_size_to_bits(page_size)
+            n_pages = size_to_pages(end - start, page_size)
+            
+            if pmr_mapping_type is MappingType.CO_CONTIGUOUS or pmr_mapping_type is MappingType.CONTIGUOUS:
                 # The region is a node
-                # PMR regions have already been split to be co-contiguous
-                pmr_node_id = self.model.add_mo_node(pmr_info.device.model_id, start, n_pages)
+                # PMR regions have already been split to be co-contiguous, or are whole runs
+                pmr_node_id = self.model.add_mo_node(pmr_info.device.model_id, start, n_pages, size_bits, pmr_info.mapcount)
                 pmr_info.model_id.append(pmr_node_id)
                 self.model.add_hold_edge(gm.perms_all, kernel_id, gm.ResourceType.MO, pmr_info.device.model_id, pmr_node_id)
-            elif pmr_mapping_type is MappingType.CONTIGUOUS:
-                assert 0, "Contiguous mapping type for PMR is not currently supported"
             elif pmr_mapping_type is MappingType.PER_PAGE:
-                # Every page is a node
-                for i in range(n_pages):
-                    pmr_info.model_id.append(self.model.add_mo_node(pmr_info.device.model_id, start + gm.page_size * i, 1))
+                # Every page is a node, and the IDs are consecutive, so the range of them maps each page to its node
+                pmr_info.model_id = self.model.add_mo_nodes(pmr_info.device.model_id, start, n_pages, size_bits, pmr_info.mapcount)
                 
         # Add the processes
         for process_info in self.procs.values():
@@ -308,68 +680,75 @@ class ProcFsData():
             process_info.ads.model_id = self.model.add_resource_space_node(gm.ResourceType.VMR)
             ads_id = process_info.ads.model_id
             mapped_devices = set()
+            run_covers = {}
             
             # PD can request from its address space
             self.model.add_request_edge(pd_id, kernel_id, gm.ResourceType.VMR, ads_id)
             
             # Add the VMRs
             for (start, end), vmr_info in process_info.ads.vmrs.items():
-                n_pages = size_to_pages(end - start)
                 perms = perms_to_model_perms(vmr_info.perms)
+                vmr_type = pathname_to_vmr_type(vmr_info.pathname)
                 
                 vmr_node_id = 0
+                vmr_info = process_info.ads.vmrs.mutate(start)
+                vmr_info.model_id = []
                 
                 # Contiguous VMR level
                 if vmr_mapping_type is MappingType.CONTIGUOUS:
-                    vmr_node_id = self.model.add_vmr_node(ads_id, pathname_to_vmr_type(vmr_info.pathname), n_pages)
+                    # Use huge pages if the whole VMR is mapped with them
+                    page_sizes = {sub_vmr_info.page_size for _, sub_vmr_info in vmr_info.sub_vmrs.items()}
+                    page_size = region_page_size(start, end, page_sizes.pop()) if len(page_sizes) == 1 else gm.page_size
+                    n_pages = size_to_pages(end - start, page_size)
+                    vmr_node_id = self.model.add_vmr_node(ads_id, vmr_type, n_pages, page_size_to_bits(page_size))
                     self.model.add_hold_edge(gm.perms_all, kernel_id, gm.ResourceType.VMR, ads_id, vmr_node_id)
                     self.model.add_hold_edge(perms, pd_id, gm.ResourceType.VMR, ads_id, vmr_node_id)
                     vmr_info.model_id.append(vmr_node_id)
                 
                 for (sub_start, sub_end), sub_vmr_info in vmr_info.sub_vmrs.items():
-                    sub_n_pages = size_to_pages(sub_end - sub_start)
+                    sub_page_size = sub_vmr_info.page_size
+                    sub_size_bits = page_size_to_bits(sub_page_size)
+                    sub_n_pages = size_to_pages(sub_end - sub_start, sub_page_size)
                     
                     # Co-contiguous VMR level
                     if vmr_mapping_type is MappingType.CO_CONTIGUOUS:
-                        vmr_node_id = self.model.add_vmr_node(ads_id, pathname_to_vmr_type(vmr_info.pathname), sub_n_pages)
+                        vmr_node_id = self.model.add_vmr_node(ads_id, vmr_type, sub_n_pages, sub_size_bits)
                         self.model.add_hold_edge(gm.perms_all, kernel_id, gm.ResourceType.VMR, ads_id, vmr_node_id)
                         self.model.add_hold_edge(perms, pd_id, gm.ResourceType.VMR, ads_id, vmr_node_id)
                         vmr_info.model_id.append(vmr_node_id)
                         
                     if vmr_mapping_type is MappingType.PER_PAGE or pmr_mapping_type is MappingType.PER_PAGE:
                         # Need to iterate through all the pages
-                        for i in range(sub_n_pages):
-                            page_vaddr = sub_start + gm.page_size * i
-                            
-                            if vmr_mapping_type is MappingType.PER_PAGE:
-                                vmr_node_id = self.model.add_vmr_node(ads_id, pathname_to_vmr_type(vmr_info.pathname), 1)
-                                self.model.add_hold_edge(gm.perms_all, kernel_id, gm.ResourceType.VMR, ads_id, vmr_node_id)
-                                self.model.add_hold_edge(perms, pd_id, gm.ResourceType.VMR, ads_id, vmr_node_id)
-                                vmr_info.model_id.append(vmr_node_id)
+                        if vmr_mapping_type is MappingType.PER_PAGE:
+                            vmr_node_ids = self.model.add_vmr_nodes(ads_id, vmr_type, sub_n_pages, sub_size_bits)
+                            self.model.add_hold_edges(gm.perms_all, kernel_id, gm.ResourceType.VMR, ads_id, vmr_node_ids)
+                            self.model.add_hold_edges(perms, pd_id, gm.ResourceType.VMR, ads_id, vmr_node_ids)
+                            vmr_info.model_id.append(vmr_node_ids)
+                        else:
+                            # Every page is in the same VMR node
+                            vmr_node_ids = vmr_node_id
                         
-                            if sub_vmr_info.mapped:
-                                if pmr_mapping_type is MappingType.PER_PAGE:
-                                    sub_pmr_start = sub_vmr_info.pmr[0]
-                                    page_paddr = sub_pmr_start + gm.page_size * i
-                                    
-                                    # Fetch the pmr every time, since the PMR may have been split
-                                    (pmr_start, pmr_end), pmr_info = self.pmrs.get(page_paddr)
-                                    mapped_devices.add(pmr_info.device.model_id)
-                                
-                                    # Maps to one page
-                                    pmr_page_idx = size_to_pages(page_paddr - pmr_start)
-                                    pmr_node_id = pmr_info.model_id[pmr_page_idx]
-                                    
-                                    # Find the model state ID for the relevant page in the PMR
-                                    self.model.add_map_edge(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, pmr_info.device.model_id, vmr_node_id, pmr_node_id)
-                                else:
-                                    self.__map_vmr_to_pmrs(mapped_devices, ads_id, vmr_node_id, *sub_vmr_info.pmr)
+                        if sub_vmr_info.mapped:
+                            if pmr_mapping_type is MappingType.PER_PAGE:
+                                # Maps each page to the PMR page(s) backing it
+                                self.__map_vmr_pages_to_pmr_pages(mapped_devices, ads_id, vmr_node_ids, sub_n_pages, sub_vmr_info.pmr[0], sub_page_size)
+                            elif pmr_mapping_type is MappingType.CONTIGUOUS:
+                                self.__map_vmr_to_pmr_runs(mapped_devices, run_covers, ads_id, vmr_node_ids, *sub_vmr_info.pmr, sub_page_size)
+                            else:
+                                self.__map_vmr_to_pmrs(mapped_devices, ads_id, vmr_node_ids, *sub_vmr_info.pmr)
                     elif sub_vmr_info.mapped:
-                        self.__map_vmr_to_pmrs(mapped_devices, ads_id, vmr_node_id, *sub_vmr_info.pmr)
+                        if pmr_mapping_type is MappingType.CONTIGUOUS:
+                            self.__map_vmr_to_pmr_runs(mapped_devices, run_covers, ads_id, vmr_node_id, *sub_vmr_info.pmr, sub_page_size)
+                        else:
+                            self.__map_vmr_to_pmrs(mapped_devices, ads_id, vmr_node_id, *sub_vmr_info.pmr)
                 
+            self.__add_run_map_edges(ads_id, run_covers)
+            
             # Add map edge from address space to the devices
             for device_id in mapped_devices:
                 self.model.add_map_edge(gm.ResourceType.VMR, gm.ResourceType.MO, ads_id, device_id)
+        
+        self.pmr_runs = None
     
         return self.model
 
@@ -539,51 +918,54 @@ def extract_namespaces(data: ProcFsData, pid: int, should_print: bool = False):
             
     data.procs[pid].namespaces = namespaces
     
-def understanding_pagemap(results):
+def understanding_pagemap(results, pid: int = None):
     assert_increasing_vaddrs(results)
-    overlapping_mappings(results)
-
-def overlapping_mappings(results):
-
-        for idx1 in range(len(results)):
-            pm1 = results[idx1]
-
-            if pm1.paddr is None:
-                continue
-
-            start_va = pm1.vaddr
-            end_va = pm1.vaddr + pm1.size
-
-            start_pa = pm1.paddr
-            end_pa = pm1.paddr + pm1.size
-
-            for idx2 in range(len(results)):
-                pm2 = results[idx2]
-
-                if pm2.paddr is None:
-                    continue
-
-                if idx1 == idx2:
-                    continue
-
-                ## Does idx'1 PMR overlab with any other PMR
-
-                assert (pm2.paddr is not None)
-                # Check for start
-                if pm2.paddr < start_pa and \
-                    start_pa < (pm2.paddr + pm2.size):
-                    print("===Overlapping Detected at START")
-                    print(f'New Range: {pm1.paddr:16x}- {pm1.paddr+pm1.size:16x} ')
-                    print(f'Old Range: {pm2.paddr:16x}- {pm2.paddr+pm2.size:16x} ')
-
-
-                # Check for end
-                if pm2.paddr < end_pa and end_pa < (pm2.paddr + pm2.size):
-                    print("===Overlapping Detected at END")
-                    print(f'New Range: {pm1.paddr:16x}- {pm1.paddr+pm1.size:16x} ')
-                    print(f'Old Range: {pm2.paddr:16x}- {pm2.paddr+pm2.size:16x} ')
+    
+    for shared in overlapping_mappings({pid: results}):
+        print(f"===Shared Range: {shared.start:16x}-{shared.end:16x}")
+        for (_, vaddr) in shared.mappings:
+            print(f"Mapped at: {vaddr:16x}")
 
+def overlapping_mappings(results_by_pid: dict) -> list[SharedRange]:
+    """
+    Find the physical ranges mapped more than once in the pagemap results of one or more processes
+    
+    :param results_by_pid: dict from PID to the pagemap rows of the process, as from read_pagemap_file
+    :return: the shared ranges, as for find_shared_ranges
+    """
+    return find_shared_ranges((pid, pagemap.vaddr, pagemap.paddr, pagemap.size)
+                              for pid, results in results_by_pid.items()
+                              for pagemap in results if pagemap.mapped)
 
+def find_shared_ranges(mappings) -> list[SharedRange]:
+    """
+    Find the physical ranges mapped more than once, with a sweep over the sorted ends of the mappings
+    This takes O(n log n), plus the size of the output
+    
+    :param mappings: iterable of (PID, vaddr, paddr, size) for every mapping of a VA range to a PA range
+    :return: the shared ranges, in order of physical address. The ends of the ranges are the points where the
+             set of mappings changes, so they are also the points where the PMRs have to be split
+    """
+    mappings = [mapping for mapping in mappings if mapping[3] > 0]
+    
+    # The ends of the ranges sort before the starts at the same address, since the ranges are half-open
+    events = sorted([(paddr, 1, i) for (i, (_, _, paddr, _)) in enumerate(mappings)]
+                    + [(paddr + size, 0, i) for (i, (_, _, paddr, size)) in enumerate(mappings)])
+    
+    shared = []
+    active = {} # Mappings covering the current address, in the order they started
+    prev = None
+    for (addr, is_start, i) in events:
+        if prev is not None and addr > prev and len(active) > 1:
+            shared.append(SharedRange(prev, addr, [(mappings[j][0], mappings[j][1] + prev - mappings[j][2]) for j in active]))
+        prev = addr
+        
+        if is_start:
+            active[i] = None
+        else:
+            del active[i]
+        
+    return shared
 
 def assert_increasing_vaddrs(results):
         prev_va : int = 0
@@ -594,47 +976,148 @@ def assert_increasing_vaddrs(results):
             assert (curr_va > prev_va)
             prev_va = curr_va
 
-def read_pagemap_file(pid: int, should_print: bool = False) -> list[PageMapObj]:
+def read_pagemap_file(pid: int, should_print: bool = False, sparse: bool = False, vmrs: set = None) -> Iterator[PageMapRow]:
     """
-    Parse a /proc/pid/pagemaps file
+    Parse a /proc/pid/pagemaps file, one VMR at a time
     
     :param process: a process returned from run_process
     :param should_print: if true, prints the raw and parsed file
-    :return: a list of objects representing the VA and VA->PA regions in the process' address space
+    :param sparse: if true, skip reading the pagemap for VMRs with nothing resident
+    :param vmrs: if given, a set of (vaddr, vaend) and only these VMRs are read
+    :return: a generator of rows representing the VA and VA->PA regions in the process' address space,
+             in increasing VA order
     """
-    results = get_va_pa_mappings(pid)
-
-    # understanding_pagemap(results)
-    
     if should_print:
         print(f'{"VMR":<16} {"    VA_START":<16} {"     VA_END":<16} : {"SZ":<16}{" PA_START":<16}{"PA_END":<16}')
         print("-" * 80)
-        for pagemap in results:
-            print(f'{"VMR":<16} {pagemap.vaddr:16x} {(pagemap.vaddr + pagemap.size):>16x} : {sizeof_fmt(pagemap.size):10}', end="")
-            if pagemap.mapped:
-                print(f'{pagemap.paddr:16x} {(pagemap.paddr + pagemap.size):16x}')
-            else:
-                print()
+        
+    for (_, _, vmr_results) in iter_va_pa_columns(pid, sparse=sparse, huge_pages=huge_pages, vmrs=vmrs):
+        for pagemap in vmr_results:
+            if should_print:
+                print(f'{"VMR":<16} {pagemap.vaddr:16x} {(pagemap.vaddr + pagemap.size):>16x} : {sizeof_fmt(pagemap.size):10}', end="")
+                if pagemap.mapped:
+                    print(f'{pagemap.paddr:16x} {(pagemap.paddr + pagemap.size):16x}')
+                else:
+                    print()
+            yield pagemap
+            
+    if should_print:
         print("-" * 40)
     
-    return results
-    
-def extract_memory_data(data: ProcFsData, pid: int, should_print = False):
+def extract_memory_data(data: ProcFsData, pid: int, should_print = False, sparse = False):
     """
     Get the VMR, PMR, and Device data for a particular process
     
     :param data: the data object
     :param pid: the process to query about
+    :param sparse: if true, skip reading the pagemap for VMRs with nothing resident
     """
     
     print(f"Extract memory data for process {pid}")
 
     # Array where each element is a line in the /proc/[PID]/maps file
     maps = read_maps_file(pid, should_print) 
-    pagemaps = read_pagemap_file(pid, should_print)
-    pagemap_iter = iter(pagemaps)
+    
+    # The pagemap is read one VMR at a time, as we go
+    pagemap_iter = read_pagemap_file(pid, should_print, sparse)
+    
+    add_memory_data(data, pid, maps, pagemap_iter)
+
+def pagemap_sub_vmr(data: ProcFsData, pagemap: PageMapRow, pmrs: list) -> tuple[tuple[int,int], SubVMR]:
+    """
+    Make the sub-VMR for a pagemap row, adding its device if it is not already tracked
+    
+    :param data: the data object
+    :param pagemap: the row
+    :param pmrs: list of (start, end, PMR) to add the PMR of a mapped row to, to be merged into data.pmrs later
+    :return: ((start, end), SubVMR) for the sub-VMR
+    """
+    
+    # Simple tracking of unmapped region
+    # Memory outside System RAM has no device to be a PMR of, so it is tracked as unmapped as well
+    if not pagemap.mapped or pagemap.device_size == 0:
+        return ((pagemap.vaddr, pagemap.vaddr + pagemap.size), SubVMR(mapped=False))
+    
+    # Insert the device, if not already tracked
+    _, device_info = data.devices.get(pagemap.device_addr)
+    
+    if device_info is None:
+        device_info = Device(size=pagemap.device_size)
+        data.devices.put(pagemap.device_addr, pagemap.device_addr + pagemap.device_size, device_info)
+
+    pmr_start_addr = pagemap.paddr
+    pmr_end_addr = pagemap.paddr + pagemap.size
+
+    log(f"Checking PMR {pagemap.paddr:16x}-{pagemap.paddr + pagemap.size:16x}")
+    pmrs.append((pmr_start_addr, pmr_end_addr, PMR(device_info, page_size=pagemap.page_size, mapcount=pagemap.mapcount)))
+    
+    return ((pagemap.vaddr, pagemap.vaddr + pagemap.size), 
+            SubVMR(mapped=True, pmr = (pmr_start_addr, pmr_end_addr), page_size=pagemap.page_size))
+
+def sub_vmr_part(sub_vmr_info: SubVMR, sub_start: int, start: int, end: int) -> SubVMR:
+    """
+    Make the sub-VMR for part [start, end) of a sub-VMR that starts at sub_start, mapping the matching part of its PMR range
+    """
+    if not sub_vmr_info.mapped:
+        return SubVMR(mapped=False)
+    pmr_start = sub_vmr_info.pmr[0] + (start - sub_start)
+    return SubVMR(mapped=True, pmr=(pmr_start, pmr_start + (end - start)), page_size=sub_vmr_info.page_size)
+
+def replace_sub_vmrs(sub_vmrs: IntervalDict, start: int, end: int, new_sub_vmrs: list) -> list[tuple[int,int]]:
+    """
+    Replace the sub-VMRs within [start, end) with new ones, for when that part of a VMR was read again
+    The sub-VMRs crossing start or end are trimmed, and the new sub-VMRs at start and end are merged with the ones
+    next to them where the mapping carries on, so the sub-VMRs are the same as if the whole VMR had been read again
+    This only touches the sub-VMRs in and next to [start, end)
+    
+    :param sub_vmrs: the VMR's sub-VMRs, which are changed in place
+    :param start: start of the range that was read again
+    :param end: end of the range that was read again
+    :param new_sub_vmrs: list of ((start, end), SubVMR) covering the range, in order
+    :return: the PMR ranges that the replaced parts of the old sub-VMRs mapped
+    """
+    unmapped = []
+    for (sub_start, sub_end), sub_vmr_info in sub_vmrs.get_interval(start, end):
+        sub_vmrs.delete(sub_start)
+        if sub_start < start:
+            sub_vmrs.put(sub_start, start, sub_vmr_part(sub_vmr_info, sub_start, sub_start, start))
+        if end < sub_end:
+            sub_vmrs.put(end, sub_end, sub_vmr_part(sub_vmr_info, sub_start, end, sub_end))
+        if sub_vmr_info.mapped:
+            unmapped.append(sub_vmr_part(sub_vmr_info, sub_start, max(start, sub_start), min(end, sub_end)).pmr)
+    
+    for (sub_start, sub_end), sub_vmr_info in new_sub_vmrs:
+        sub_vmrs.put(sub_start, sub_end, sub_vmr_info)
+    
+    # Merge across the ends of the range
+    for at in (start, end):
+        (left_start, left_end), left = sub_vmrs.get(at - 1)
+        (right_start, right_end), right = sub_vmrs.get(at)
+        if left is None or right is None or left_end != right_start or left.mapped != right.mapped:
+            continue
+        if left.mapped and (left.pmr[1] != right.pmr[0] or left.page_size != right.page_size):
+            continue
+        sub_vmrs.delete(left_start)
+        sub_vmrs.delete(right_start)
+        pmr = (left.pmr[0], right.pmr[1]) if left.mapped else None
+        sub_vmrs.put(left_start, right_end, SubVMR(mapped=left.mapped, pmr=pmr, page_size=left.page_size))
+    
+    return unmapped
+
+def add_memory_data(data: ProcFsData, pid: int, maps: list, pagemap_iter: Iterator[PageMapRow]):
+    """
+    Add the VMR, PMR, and Device data for a particular process, from its parsed maps and pagemap
+    
+    :param data: the data object
+    :param pid: the process the data is for
+    :param maps: the parsed /proc/pid/maps file, from read_maps_file or a ProcessCapture
+    :param pagemap_iter: the pagemap rows of the process, in increasing VA order
+    """
     next_pagemap = next(pagemap_iter, None)
     
+    # The PMRs of the whole process are merged into data.pmrs at once, after all the VMRs
+    pmrs = []
+    
     for map_entry in maps:
         vmr_info = VMR(map_entry.pathname, map_entry.perm)  
         vmr_start_addr = map_entry.start_address
@@ -644,6 +1127,9 @@ def extract_memory_data(data: ProcFsData, pid: int, should_print = False):
         
         # Could get permissions here
         
+        # The rows come sorted by VA, so the sub-VMRs are built all at once
+        sub_vmrs = []
+        
         # Find all PMRs for this VMR
         while next_pagemap is not None:
             pagemap = next_pagemap
@@ -655,29 +1141,13 @@ def extract_memory_data(data: ProcFsData, pid: int, should_print = False):
                 break
             
             next_pagemap = next(pagemap_iter, None)
-
-            # Simple tracking of unmapped region
-            if not pagemap.mapped:
-                vmr_info.sub_vmrs.put(pagemap.vaddr, pagemap.vaddr + pagemap.size, SubVMR(mapped=False))
-                continue
-            
-            # Insert the device, if not already tracked
-            _, device_info = data.devices.get(pagemap.device_addr)
-            
-            if device_info is None:
-                device_info = Device(size=pagemap.device_size)
-                data.devices.put(pagemap.device_addr, pagemap.device_addr + pagemap.device_size, device_info)
-
-            pmr_start_addr = pagemap.paddr
-            pmr_end_addr = pagemap.paddr + pagemap.size
-            vmr_info.sub_vmrs.put(pagemap.vaddr, pagemap.vaddr + pagemap.size, 
-                               SubVMR(mapped=True, pmr = (pmr_start_addr, pmr_end_addr)))
-
-            log(f"Checking PMR {pagemap.paddr:16x}-{pagemap.paddr + pagemap.size:16x}")
-            insert_with_split(data.pmrs, pmr_start_addr, pmr_end_addr, PMR(device_info))
+            sub_vmrs.append(pagemap_sub_vmr(data, pagemap, pmrs))
                         
+        vmr_info.sub_vmrs = data.interval_dict.from_sorted(sub_vmrs)
         data.procs[pid].ads.vmrs.put(vmr_start_addr, vmr_end_addr, vmr_info)
     
+    insert_many_with_split(data.pmrs, pmrs)
+    
     if print_logs:
         print(data.procs[pid].ads.vmrs)
         print(data.pmrs)
@@ -689,28 +1159,186 @@ def extract_memory_data(data: ProcFsData, pid: int, should_print = False):
 
 
 
-def extract_from_status(data: ProcFsData, pid: int, should_print = False):
+def read_pid_in_ns(pid: int, should_print = False) -> int:
+    """
+    Find the PID of a process according to its own PID namespace
+    """
     status = read_status_file(pid, should_print)
     assert pid == status.ns_pid[0], "PID from status should have been the same as the given PID"
-    data.procs[pid].pid_in_ns = status.ns_pid[1] if len(status.ns_pid) > 1 else pid
+    return status.ns_pid[1] if len(status.ns_pid) > 1 else pid
+
+def extract_from_status(data: ProcFsData, pid: int, should_print = False):
+    data.procs[pid].pid_in_ns = read_pid_in_ns(pid, should_print)
     
-def extract_process_data(data: ProcFsData, pid: int, name: str, should_print = False):
+def extract_process_data(data: ProcFsData, pid: int, name: str, should_print = False, sparse = False, incremental = False):
     """
     Extract data from procfs for a particular process
     
     :param data: the data object
     :param pid_in_parent: PID of the process in the global namespace
     :param pid_in_child: PID of the process in the child namespace
+    :param sparse: if true, skip reading the pagemap for VMRs with nothing resident
+    :param incremental: if true, clear the soft-dirty bits of the process, so that it can be brought
+                        up to date later with update_process_data
     """
-    process = Process(name)
+    process = data.new_process(name)
     data.procs[pid] = process
     
     # extract_namespaces(data, pid, should_print) # namespaces do not get incorporated into the generic model state yet
     extract_from_status(data, pid, should_print)
-    extract_memory_data(data, pid, should_print)
+    
+    # Clear before reading, so pages written during the read are also read again by the next update
+    if incremental and soft_dirty_supported():
+        clear_soft_dirty(pid)
+    clear_kpageflags_cache()
+    extract_memory_data(data, pid, should_print, sparse)
     
     if should_print:
         print(f"Extracted process {pid}: {data.procs[pid].name}")
+
+def update_process_data(data: ProcFsData, pid: int, should_print = False, sparse = False):
+    """
+    Bring the data for a process up to date, after extract_process_data with incremental set
+    Only the pages written since the last extract / update are read again, and their sub-VMRs and PMRs patched,
+    along with the VMRs that changed in /proc/pid/maps. Everything else is reused as it is, so the cost follows
+    the write activity
+    Pages which become or stop being resident without being written to (e.g. read faults, reclaim) are not noticed
+    
+    :param data: the data object, which is updated in place
+    :param pid: the process to update
+    :param sparse: if true, skip reading the pagemap for VMRs with nothing resident
+    """
+    process = data.procs[pid]
+    maps = read_maps_file(pid, should_print)
+    clear_kpageflags_cache()
+    
+    # Find the written pages, then start tracking writes for the next update
+    if soft_dirty_supported():
+        dirty = soft_dirty_vmrs(pid)
+        clear_soft_dirty(pid)
+    else:
+        print("Warning: the kernel does not track soft-dirty pages, reading all VMRs again")
+        dirty = None
+    
+    # Keep the VMRs that did not change, and collect the rest to read again
+    old_vmrs = process.ads.vmrs
+    process.ads.vmrs = data.interval_dict()
+    changed = []
+    written = {} # (vaddr, vaend) of each kept VMR with written pages, to the ranges of them
+    for map_entry in maps:
+        vmr_range = (map_entry.start_address, map_entry.end_address)
+        old_range, vmr_info = old_vmrs.get(map_entry.start_address)
+        
+        if (dirty is not None and old_range == vmr_range and vmr_info.pathname == map_entry.pathname
+            and perms_key(vmr_info.perms) == perms_key(map_entry.perm)):
+            process.ads.vmrs.put(*vmr_range, vmr_info)
+            if vmr_range in dirty:
+                written[vmr_range] = dirty[vmr_range]
+        else:
+            changed.append(map_entry)
+    
+    print(f"Update memory data for process {pid}: {len(changed)} of {len(maps)} VMRs changed, {len(written)} written to")
+    
+    # The PMRs that the VMRs which are gone or read again whole used to map
+    unmapped = [sub_vmr_info.pmr for (start, end), vmr_info in old_vmrs.items() if process.ads.vmrs.get(start)[1] is not vmr_info
+                for _, sub_vmr_info in vmr_info.sub_vmrs.items() if sub_vmr_info.mapped]
+    
+    # Read the written pages again, and patch the sub-VMRs of their VMRs
+    pmrs = []
+    rows = read_pagemap_file(pid, should_print, sparse, written)
+    next_row = next(rows, None)
+    for (vmr_start, vmr_end), ranges in written.items():
+        vmr_info = process.ads.vmrs.mutate(vmr_start)
+        if data.persistent:
+            # The sub-VMRs are shared with the snapshots as well
+            vmr_info.sub_vmrs = vmr_info.sub_vmrs.snapshot()
+        
+        for (start, end) in ranges:
+            new_sub_vmrs = []
+            while next_row is not None and next_row.vaddr < end:
+                new_sub_vmrs.append(pagemap_sub_vmr(data, next_row, pmrs))
+                next_row = next(rows, None)
+            unmapped += replace_sub_vmrs(vmr_info.sub_vmrs, start, end, new_sub_vmrs)
+    
+    # Drop the PMRs that the replaced sub-VMRs mapped, if nothing maps them anymore, then add the ones read again
+    data.prune_pmrs_in(unmapped)
+    insert_many_with_split(data.pmrs, pmrs)
+    
+    pagemap_iter = read_pagemap_file(pid, should_print, sparse, {(map_entry.start_address, map_entry.end_address) for map_entry in changed})
+    add_memory_data(data, pid, changed, pagemap_iter)
+    
+def capture_process(pid: int, name: str = None, sparse = False) -> ProcessCapture:
+    """
+    Read everything we need from procfs for a particular process, without touching a ProcFsData
+    This runs in a worker process of extract_processes_data, so the result only holds picklable data
+    
+    :param pid: the process to read
+    :param name: name of the process, or None to look it up
+    :param sparse: if true, skip reading the pagemap for VMRs with nothing resident
+    """
+    if name is None:
+        name = psutil.Process(pid).name()
+        
+    maps = [MapEntry(map.start_address, map.end_address, map.pathname, 
+                     MapPerm(map.perm.can_read, map.perm.can_write, map.perm.can_execute, map.perm.is_private, map.perm.is_shared)) 
+            for map in read_maps_file(pid)]
+    
+    # Kernel threads have no address space, and their pagemap cannot be opened
+    pagemap = get_va_pa_columns(pid, sparse=sparse, huge_pages=huge_pages) if maps else PageMapColumns()
+    
+    return ProcessCapture(pid, name, read_pid_in_ns(pid), maps, pagemap)
+
+def _capture_process_worker(args: tuple) -> ProcessCapture:
+    """
+    Pool entry point for capture_process
+    Returns None if the process exited before we could read it, or we are not allowed to read it
+    """
+    pid = args[0]
+    
+    try:
+        return capture_process(*args)
+    except PermissionError:
+        return None
+    except Exception:
+        if psutil.pid_exists(pid):
+            raise
+        return None
+
+def add_process_capture(data: ProcFsData, capture: ProcessCapture):
+    """
+    Add a process read by capture_process to the data object
+    PMRs and devices are shared with the processes already in the data object
+    """
+    data.procs[capture.pid] = data.new_process(capture.name, capture.pid_in_ns)
+    add_memory_data(data, capture.pid, capture.maps, iter(capture.pagemap))
+
+def extract_processes_data(data: ProcFsData, pids: list[int], names: list[str] = None, sparse = False, n_workers: int = None):
+    """
+    Extract data from procfs for many processes at once
+    Reading procfs is syscall-bound, so each process is read by a worker in a process pool,
+    and the results are merged into the data object in the order of pids, as they arrive
+    
+    :param data: the data object
+    :param pids: PIDs of the processes in the global namespace
+    :param names: names of the processes, or None to look them up
+    :param sparse: if true, skip reading the pagemap for VMRs with nothing resident
+    :param n_workers: number of worker processes, defaults to the number of CPUs
+    """
+    if names is None:
+        names = [None] * len(pids)
+    
+    # The workers start from the cache as it is here, and keep theirs for every process they read
+    clear_kpageflags_cache()
+    with multiprocessing.Pool(n_workers) as pool:
+        captures = pool.imap(_capture_process_worker, [(pid, name, sparse) for pid, name in zip(pids, names)])
+        
+        for pid, capture in zip(pids, captures):
+            if capture is None:
+                print(f"Skipping process {pid}, it could not be read")
+                continue
+            
+            print(f"Extract memory data for process {pid}")
+            add_process_capture(data, capture)
     
 def terminate_process(pid: int):
     """ 
@@ -721,42 +1349,54 @@ def terminate_process(pid: int):
 if __name__ == "__main__":
     # Define the argument parser
     parser = argparse.ArgumentParser(description="OSmosis Model state from multiple subsystems")
-    parser.add_argument('--pid', type=int, help='PID of the process to extract data for')
+    parser.add_argument('--pid', type=int, nargs='+', help='PID(s) of the process(es) to extract data for')
+    parser.add_argument('--all', action='store_true', help='Extract data for every process in the system')
+    parser.add_argument('--jobs', type=int, help='Number of worker processes reading procfs, defaults to the number of CPUs')
     parser.add_argument('--csv', type=str, required=True, help='CSV to output the model state in')
+    parser.add_argument('--sparse', action='store_true', help='Skip reading the pagemap for VMRs with nothing resident')
+    parser.add_argument('--coalesce', action='store_true', help='Merge touching PMRs of the same device into one MO node')
+    parser.add_argument('--contiguous', action='store_true', help='Model each run of touching PMRs as one MO node, with map edges to the parts of it')
 
     # Parse the arguments
     args = parser.parse_args()
 
-    # Use the pid argument in your script
-    pid = args.pid
-
     data_main = ProcFsData()
+    
+    user_pids = args.all or args.pid is not None
 
-    if args.pid is not None:
+    if args.all:
+        print("Extracting every process")
+        pids = [pid for pid in psutil.pids() if pid != os.getpid()]
+    elif args.pid is not None:
         print(f"PID provided: {args.pid}")
-        pids = [args.pid]
+        pids = args.pid
     else:
         print("Starting processes from this script")
         pids =  [run_process(name, start_type) for (name, start_type) in to_run]
     
-    assert (len(pids) == 1)
+    names = None if user_pids else [name for (name, _) in to_run]
 
     try:
-        if args.pid:
-                p = psutil.Process(pid)
-                extract_process_data(data_main, pid, p.name(), True)
+        if len(pids) == 1:
+            # A single process is read directly, with all of the files printed
+            pid = pids[0]
+            name = psutil.Process(pid).name() if user_pids else names[0]
+            extract_process_data(data_main, pid, name, True, args.sparse)
+            # read_mountinfo_file(pid, True)  # mountinfo is not part of the model state, but we can view it
         else:
-            for (name, _), pid in zip(to_run, pids):
-                extract_process_data(data_main, pid, name, True)
-                # read_mountinfo_file(pid, True)  # mountinfo is not part of the model state, but we can view it
+            extract_processes_data(data_main, pids, names, args.sparse, args.jobs)
     except Exception as e:
         print(repr(e))
         traceback.print_exc()
         exit (1)
     
     # If the pid not user provided.
-    if args.pid is None:
+    if not user_pids:
         for pid in pids:
             terminate_process(pid)
     
-    data_main.to_generic_model(MappingType.CONTIGUOUS, MappingType.CO_CONTIGUOUS).to_csv(args.csv)       
\ No newline at end of file
+    if args.coalesce:
+        data_main.coalesce_pmrs()
+    
+    pmr_mapping_type = MappingType.CONTIGUOUS if args.contiguous else MappingType.CO_CONTIGUOUS
+    data_main.to_generic_model(MappingType.CONTIGUOUS, pmr_mapping_type).to_csv(args.csv)
@@ -0,0 +1,178 @@
+#!/bin/python3
+
+import random
+import tempfile
+from array import array
+import read_pagemap as rp
+from read_pagemap import PAMap, ProcArray, SystemRAMMap, PageMapColumns, pagemap_runs, huge_page_segments
+
+
+def boundary():
+    print ("----------------------")
+
+def check(name, expected, actual):
+    print(f'Checking {name}', end ="\t" )
+    if (expected != actual):
+        print(f'FAIL {expected} != {actual}')
+    else:
+        print("PASS")
+
+present = 1 << rp._PM_PRESENT
+
+def page_by_page_runs(entries):
+    """
+    Runs of pages found one page at a time, as (start, length)
+    """
+    runs = []
+    for (i, e) in enumerate(entries):
+        key = (e & rp._PM_PFRAME_MASK) - i if e & present else None
+        if runs and runs[-1][2] == key:
+            runs[-1][1] += 1
+        else:
+            runs.append([i, 1, key])
+    return [(start, length) for (start, length, _) in runs]
+
+def as_pairs(runs):
+    return list(zip(*runs))
+
+def random_entries(rng, n):
+    """
+    Present runs with PFN jumps, flag bits that do not end a run, and pages that are not present or swapped out
+    """
+    entries = array("Q")
+    pfn = rng.randrange(rp._PM_PFRAME_MASK)
+    while len(entries) < n:
+        kind = rng.random()
+        if kind < 0.6:
+            flags = rng.choice([0, 1 << rp._PM_SOFT_DIRTY, 1 << rp._PM_MMAP_EXCLUSIVE, 1 << rp._PM_FILE])
+            entries.append(present | flags | pfn)
+            pfn = (pfn + 1) & rp._PM_PFRAME_MASK
+        elif kind < 0.7:
+            pfn = rng.choice([rng.randrange(rp._PM_PFRAME_MASK), (pfn - 1) & rp._PM_PFRAME_MASK, rp._PM_PFRAME_MASK])
+        else:
+            entries.append(rng.choice([0, 1 << rp._PM_SOFT_DIRTY, (1 << rp._PM_SWAP) | rng.randrange(rp._PM_PFRAME_MASK)]))
+    return entries
+
+def test_pagemap_runs():
+    """
+    Check the runs of co-contiguous pages found in raw pagemap entries
+    """
+    cases = [
+        ("empty", [], []),
+        ("one page", [present | 5], [(0, 1)]),
+        ("one missing page", [0], [(0, 1)]),
+        ("consecutive", [present | 5, present | 6, present | 7], [(0, 3)]),
+        ("PFN jump", [present | 5, present | 6, present | 9, present | 10], [(0, 2), (2, 2)]),
+        ("PFN backwards", [present | 5, present | 4], [(0, 1), (1, 1)]),
+        ("same PFN twice", [present | 5, present | 5], [(0, 1), (1, 1)]),
+        ("not present between", [present | 5, 0, 0, present | 8], [(0, 1), (1, 2), (3, 1)]),
+        ("not present kept together", [0, 1 << rp._PM_SWAP | 7, 1 << rp._PM_SOFT_DIRTY, present | 1], [(0, 3), (3, 1)]),
+        ("flags inside a run", [present | 5, present | (1 << rp._PM_SOFT_DIRTY) | 6, present | (1 << rp._PM_FILE) | 7], [(0, 3)]),
+        ("swap with the next PFN", [present | 5, (1 << rp._PM_SWAP) | 6], [(0, 1), (1, 1)]),
+        ("top PFN", [present | rp._PM_PFRAME_MASK - 1, present | rp._PM_PFRAME_MASK, present], [(0, 2), (2, 1)]),
+    ]
+    for (name, entries, expected) in cases:
+        check(f"runs {name}", expected, as_pairs(pagemap_runs(array("Q", entries))))
+
+    rng = random.Random(2)
+    mismatches = 0
+    for _ in range(500):
+        entries = random_entries(rng, rng.randint(0, 300))
+        if as_pairs(pagemap_runs(entries)) != page_by_page_runs(entries) or pagemap_runs(memoryview(entries)) != pagemap_runs(entries):
+            mismatches += 1
+    check("runs random against page by page", 0, mismatches)
+
+def test_read_runs():
+    """
+    Check that runs carry on across the separate reads of a long range, and that a tail that can't be read is its own run
+    """
+    rng = random.Random(3)
+    entries = random_entries(rng, 1000)
+    expected_starts, expected_lengths = pagemap_runs(entries)
+
+    with tempfile.NamedTemporaryFile() as f:
+        entries.tofile(f)
+        f.flush()
+        m = PAMap()
+        m.pagemap = ProcArray(f.name)
+        m.max_read_pages = 7
+
+        (starts, lengths, heads) = m.read_runs(0, len(entries))
+        check("read_runs in chunks", (list(expected_starts), list(expected_lengths), [entries[start] for start in expected_starts]),
+              (list(starts), list(lengths), heads))
+
+        (starts, lengths, heads) = m.read_runs(0, len(entries) + 20)
+        check("read_runs past the end", ((len(entries), 20, None), len(expected_starts) + 1), ((starts[-1], lengths[-1], heads[-1]), len(starts)))
+
+def test_addr_index_many():
+    """
+    Check finding the System RAM range of many physical addresses at once, against one at a time
+    """
+    iomem = ["00000000-00000fff : Reserved\n",
+             "00001000-0009ffff : System RAM\n",
+             "000a0000-000fffff : Reserved\n",
+             "00100000-3fffffff : System RAM\n",
+             "  01000000-01ffffff : Kernel code\n",
+             "100000000-13fffffff : System RAM\n"]
+    sysram = SystemRAMMap(iomem)
+    check("iomem ranges", [(0x1000, 0x9f000), (0x100000, 0x3ff00000), (0x100000000, 0x40000000)],
+          [(r.start, r.size) for r in sysram.ranges])
+
+    # Before, at the edges of, between, and after the ranges, out of order and repeated
+    pas = [0x0, 0xfff, 0x1000, 0x9ffff, 0xa0000, 0xfffff, 0x100000, 0x1234567, 0x3fffffff, 0x40000000,
+           0xffffffff, 0x100000000, 0x13fffffff, 0x140000000, 1 << 60, 0x1000, 0x0]
+    indices = [None, None, 0, 0, None, None, 1, 1, 1, None, None, 2, 2, None, None, 0, None]
+    check("addr_index_many", indices, [r and r.index for r in sysram.addr_index_many(pas)])
+    check("addr_index_many reversed", indices[::-1], [r and r.index for r in sysram.addr_index_many(pas[::-1])])
+    check("addr_index_many against addr_index", [sysram.addr_index(pa) for pa in pas], sysram.addr_index_many(pas))
+    check("addr_index_many empty", [], sysram.addr_index_many([]))
+    check("addr_index_many no RAM", [None, None], SystemRAMMap([]).addr_index_many([0, 0x1000]))
+
+    # A mapped row outside System RAM has no device
+    columns = PageMapColumns(sysram.ranges)
+    columns.append(0x1000, 0x1000, 0x40000000, PageMapColumns.MAPPED)
+    columns.append(0x2000, 0x1000, 0x100000, PageMapColumns.MAPPED, device=1)
+    check("row without a device", [(0, 0), (0x100000, 0x3ff00000)], [(row.device_addr, row.device_size) for row in columns])
+
+def test_huge_page_segments():
+    """
+    Check splitting a run of pages into regular and huge pages from their compound page flags
+    Compound pages of 4 pages stand in for huge pages, so the cases stay small
+    """
+    page_size = 4096
+    head = (1 << rp._KPF_COMPOUND_HEAD)
+    tail = (1 << rp._KPF_COMPOUND_TAIL)
+    thp = head | (1 << rp._KPF_THP)
+    hugetlb = head | (1 << rp._KPF_HUGE)
+    huge = [thp, tail, tail, tail]
+
+    # (name, VA, number of pages, flags of the pages and the page after, segments)
+    cases = [
+        ("regular", 0, 3, [0, 0, 0, 0], [(0, 3, page_size)]),
+        ("THP", 0, 4, huge + [0], [(0, 4, 4 * page_size)]),
+        ("hugetlbfs", 0, 4, [hugetlb, tail, tail, tail, 0], [(0, 4, 4 * page_size)]),
+        ("two huge pages together", 0, 8, huge + huge + [0], [(0, 8, 4 * page_size)]),
+        ("huge page between regular pages", 0, 9, [0] * 4 + huge + [0, 0],
+         [(0, 4, page_size), (4, 4, 4 * page_size), (8, 1, page_size)]),
+        ("huge page followed by the next huge page", 0, 4, huge + [thp], [(0, 4, 4 * page_size)]),
+        ("compound page that is not huge", 0, 4, [head, tail, tail, tail, 0], [(0, 4, page_size)]),
+        ("VA not aligned", page_size, 4, huge + [0], [(0, 4, page_size)]),
+        ("run ends inside the huge page", 0, 4, huge + [tail], [(0, 4, page_size)]),
+        ("run starts inside the huge page", 0, 3, [tail, tail, tail, 0], [(0, 3, page_size)]),
+        ("huge page cut short", 0, 3, [thp, tail, tail, 0], [(0, 3, page_size)]),
+        ("not a power of two", 0, 6, [thp, tail, tail, tail, tail, tail, 0], [(0, 6, page_size)]),
+        ("head alone", 0, 2, [thp, 0, 0], [(0, 2, page_size)]),
+        ("flags not all read", 0, 8, huge, [(0, 4, 4 * page_size), (4, 4, page_size)]),
+        ("no flags read", 0, 4, [], [(0, 4, page_size)]),
+        ("no pages", 0, 0, [0], []),
+    ]
+    for (name, vaddr, n_pages, flags, expected) in cases:
+        check(f"huge pages {name}", expected, huge_page_segments(vaddr, n_pages, array("Q", flags), page_size))
+
+if __name__ == "__main__":
+    boundary()
+    test_pagemap_runs()
+    test_read_runs()
+    test_addr_index_many()
+    test_huge_page_segments()
+    boundary()
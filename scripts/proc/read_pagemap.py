@@ -20,7 +20,8 @@ So this is not suitable (in general) for getting physical addresses
 to program into MMU-less devices.
 """
 
-import os, sys, struct
+import os, sys, struct, bisect, errno, fcntl
+from array import array
 
 
 """
@@ -41,6 +42,24 @@ _PM_SWAP            = 62
 _PM_PRESENT         = 63
 
 
+"""
+Linux 6.7+ can also scan the pagemap with the PAGEMAP_SCAN ioctl, which finds the ranges of pages
+in a set of categories in one call, without returning their PFNs.
+include/uapi/linux/fs.h defines the struct pm_scan_arg it takes and the PAGE_IS_ categories.
+"""
+_PAGEMAP_SCAN       = 0xc0606610  # _IOWR('f', 16, struct pm_scan_arg)
+_PM_SCAN_ARG        = "12Q"       # size, flags, start, end, walk_end, vec, vec_len, max_pages,
+                                  # category_inverted, category_mask, category_anyof_mask, return_mask
+_PAGE_IS_WPALLOWED  = 1 << 0
+_PAGE_IS_WRITTEN    = 1 << 1
+_PAGE_IS_FILE       = 1 << 2
+_PAGE_IS_PRESENT    = 1 << 3
+_PAGE_IS_SWAPPED    = 1 << 4
+_PAGE_IS_PFNZERO    = 1 << 5
+_PAGE_IS_HUGE       = 1 << 6
+_PAGE_IS_SOFT_DIRTY = 1 << 7
+
+
 """
 Further information about the physical page can be found in
   /proc/kpageflags
@@ -62,6 +81,7 @@ _KPF_SWAPBACKED     = 14
 _KPF_COMPOUND_HEAD  = 15
 _KPF_COMPOUND_TAIL  = 16
 _KPF_HUGE           = 17
+_KPF_THP            = 22
 # Following are documented in include/linux/kernel-page-flags.h
 _KPF_RESERVED       = 32       # i.e. the page is reserved (PageReserved)
 _KPF_MAPPEDTODISK   = 34
@@ -91,13 +111,15 @@ class KernelPME:
     Page Map Entry as managed by the kernel and accessed via /proc/x/pagemap.
     This file is exported by fs/proc/task_mmu.c.
     """
+    __slots__ = ("raw", "pagemap", "page_size", "pfn")
     entry_size = 8
+    default_page_size = os.sysconf("SC_PAGE_SIZE") # Looked up once, rather than for every entry
 
     def __init__(self, raw, size=None, pagemap=None):
         self.raw = raw
         self.pagemap = pagemap
         if size is None:
-            size = os.sysconf("SC_PAGE_SIZE")
+            size = self.default_page_size
         self.page_size = size
         if self.is_present():
             self.pfn = self.raw & _PM_PFRAME_MASK
@@ -150,6 +172,8 @@ class PageMapping:
     Mapping of one VA range to a contiguous PA range (if mapped).
     The PTE should be for the first page in the range, and other pages should have similar properties.
     """
+    __slots__ = ("n_pages", "va", "pte", "size")
+
     def __init__(self, va=None):
         self.n_pages = 1
         self.va = va
@@ -196,10 +220,15 @@ class ProcArray:
     Manage a memory properties array as exported in procfs.
     This is suitable for /proc/self/pagemap, /proc/kpageflags etc.
     """
+    # array typecodes for the supported entry sizes
+    typecodes = {8: "Q", 4: "I"}
+
     def __init__(self, fn, entry_size=8):
         self.entry_size = entry_size
         self.fn = fn
         self.fd = None
+        assert entry_size in self.typecodes, "unhandled entry size %u" % entry_size
+        assert array(self.typecodes[entry_size]).itemsize == entry_size
         self.fd = os.open(self.fn, os.O_RDONLY)
 
     def read(self, n):
@@ -221,6 +250,45 @@ class ProcArray:
             assert False, "unhandled entry size %u" % self.entry_size
         return data
 
+    def read_range(self, n, count):
+        """
+        Read count consecutive entries starting at entry n, with a single pread.
+        Returns an array of the decoded entries. This is shorter than count if the
+        kernel stopped the read early, or None if nothing could be read at all.
+        """
+        off = n * self.entry_size
+        try:
+            data = os.pread(self.fd, count * self.entry_size, off)
+        except OSError as e:
+            print("** %s: failed to read %u entries at 0x%x (%s)" % (self.fn, count, off, e), file=sys.stderr)
+            return None
+        if not data:
+            print("** %s: failed to read %u bytes at 0x%x" % (self.fn, count * self.entry_size, off), file=sys.stderr)
+            return None
+        entries = array(self.typecodes[self.entry_size])
+        entries.frombytes(data[:len(data) - (len(data) % self.entry_size)])
+        return entries
+
+    def read_into(self, n, count, buf):
+        """
+        Read count consecutive entries starting at entry n into a caller-owned buffer, with a single preadv.
+        Returns a zero-copy view of the decoded entries, which is shorter than count if the
+        kernel stopped the read early, or None if nothing could be read at all.
+
+        :param buf: writable memoryview of at least count * entry_size bytes
+        """
+        off = n * self.entry_size
+        nbytes = count * self.entry_size
+        try:
+            got = os.preadv(self.fd, [buf[:nbytes]], off)
+        except OSError as e:
+            print("** %s: failed to read %u entries at 0x%x (%s)" % (self.fn, count, off, e), file=sys.stderr)
+            return None
+        if got == 0:
+            print("** %s: failed to read %u bytes at 0x%x" % (self.fn, nbytes, off), file=sys.stderr)
+            return None
+        return buf[:got - (got % self.entry_size)].cast(self.typecodes[self.entry_size])
+
     def __del__(self):
         if self.fd is not None:
             os.close(self.fd)
@@ -234,6 +302,9 @@ class PAMap:
     We use OS file operations to avoid Python's buffering.
     """
     page_size = os.sysconf("SC_PAGE_SIZE")
+    max_read_pages = 1 << 18   # Largest number of entries to fetch with one read (2MiB of entries)
+    max_scan_ranges = 1 << 10  # Largest number of ranges to fetch with one PAGEMAP_SCAN
+    scan_supported = True      # Cleared the first time the kernel turns down PAGEMAP_SCAN
 
     def __init__(self, pid="self"):
         if pid == -1:
@@ -241,6 +312,8 @@ class PAMap:
         self.fn = "/proc/" + str(pid) + "/pagemap"
         self.pagemap = ProcArray(self.fn)
         self._kpageflags = None
+        self.buffer = bytearray() # Reused for every bulk read of the pagemap
+        self.scan_buffer = None # Reused for every PAGEMAP_SCAN, holds (start, end, categories) for each range
 
     def round_down(self, addr):
         return addr - (addr % self.page_size)
@@ -253,7 +326,7 @@ class PAMap:
         vp = va // self.page_size
         ebs = self.pagemap.read(vp)
         if ebs is not None:
-            pme = KernelPME(ebs, pagemap=self)
+            pme = KernelPME(ebs, size=self.page_size, pagemap=self)
             return pme
         else:
             return None
@@ -273,6 +346,21 @@ class PAMap:
         m.pte = self.entry(va)
         return m
 
+    def entries(self, va, n_pages):
+        """
+        Get the raw kernel PTEs for consecutive pages starting at a page-aligned VA,
+        with a single read into this PAMap's buffer. At most max_read_pages entries are read.
+        The buffer only grows when a larger read than any before comes along.
+        Returns a zero-copy view of the entries, which is only valid until the next call.
+        It is shorter than n_pages if the range was too large or the tail could not be read.
+        """
+        n_pages = min(n_pages, self.max_read_pages)
+        nbytes = n_pages * KernelPME.entry_size
+        if len(self.buffer) < nbytes:
+            # Replace rather than resize, since views of the old buffer may still be alive
+            self.buffer = bytearray(nbytes)
+        return self.pagemap.read_into(va // self.page_size, n_pages, memoryview(self.buffer))
+
     def pa(self, va):
         """
         Translate a VA to a PA.
@@ -285,12 +373,149 @@ class PAMap:
         else:
             return None
 
+    def scan(self, va, vaend, category_mask, return_mask=None):
+        """
+        Find the ranges of pages in [va, vaend) that are in all of the PAGE_IS_ categories in category_mask,
+        with the PAGEMAP_SCAN ioctl. The range must be page-aligned.
+        Returns a list of (start VA, end VA, categories) where touching ranges with the same categories
+        are merged, or None if the ioctl can't be used and the entries have to be read instead.
+        
+        :param return_mask: the categories to return for each range, defaults to category_mask
+        """
+        if not PAMap.scan_supported:
+            return None
+        if return_mask is None:
+            return_mask = category_mask
+        if self.scan_buffer is None:
+            self.scan_buffer = array("Q", bytes(24 * self.max_scan_ranges))
+        (vec, _) = self.scan_buffer.buffer_info()
+        
+        ranges = []
+        while va < vaend:
+            arg = bytearray(struct.pack(_PM_SCAN_ARG, struct.calcsize(_PM_SCAN_ARG), 0, va, vaend, 0, vec,
+                                        self.max_scan_ranges, 0, 0, category_mask, 0, return_mask))
+            try:
+                n = fcntl.ioctl(self.pagemap.fd, _PAGEMAP_SCAN, arg)
+            except OSError as e:
+                if e.errno == errno.ENOTTY:
+                    PAMap.scan_supported = False
+                return None
+            for i in range(0, 3 * n, 3):
+                (start, end, categories) = self.scan_buffer[i:i + 3]
+                if ranges and ranges[-1][1] == start and ranges[-1][2] == categories:
+                    # The range carries on from the previous scan
+                    ranges[-1] = (ranges[-1][0], end, categories)
+                else:
+                    ranges.append((start, end, categories))
+            (walk_end,) = struct.unpack_from("Q", arg, 32)
+            if walk_end <= va:
+                break
+            va = walk_end
+        return ranges
+
+    def pa_runs(self, va, n_pages):
+        """
+        Find the runs of co-contiguous pages among n_pages consecutive pages starting at a page-aligned VA.
+        Returns (starts, lengths, heads): for each run, the index of its first page, its number of pages,
+        and the raw PTE of its first page. If the tail of the range could not be read, it is returned as a
+        final run with a head of None.
+        When the kernel supports PAGEMAP_SCAN, only the entries of the present pages are read, and every
+        stretch of pages that are not present is a single run.
+        """
+        present = self.scan(va, va + n_pages * self.page_size, _PAGE_IS_PRESENT)
+        if present is None:
+            return self.read_runs(va, n_pages)
+        
+        starts, lengths, heads = array("Q"), array("Q"), []
+        done = 0
+        for (start, end, _) in present + [(va + n_pages * self.page_size, None, None)]:
+            first = (start - va) // self.page_size
+            if first > done:
+                # Pages that are not present are one run, but keep the real PTE of the first one
+                head = self.entries(va + done * self.page_size, 1)
+                starts.append(done)
+                lengths.append(first - done)
+                heads.append(head[0] if head else None)
+                done = first
+            if end is not None and (not heads or heads[-1] is not None):
+                (run_starts, run_lengths, run_heads) = self.read_runs(start, (end - start) // self.page_size)
+                starts.extend(first + run_start for run_start in run_starts)
+                lengths.extend(run_lengths)
+                heads.extend(run_heads)
+                done = (end - va) // self.page_size
+            if heads and heads[-1] is None:
+                # Could not read the rest of the range
+                lengths[-1] = n_pages - starts[-1]
+                break
+        return starts, lengths, heads
+
+    def read_runs(self, va, n_pages):
+        """
+        Find the runs of co-contiguous pages like pa_runs, by reading the entries of all the pages
+        """
+        starts, lengths, heads = array("Q"), array("Q"), []
+        done = 0
+        while done < n_pages:
+            entries = self.entries(va + done * self.page_size, n_pages - done)
+            if entries is None:
+                break
+            chunk_starts, chunk_lengths = pagemap_runs(entries)
+            for (start, length) in zip(chunk_starts, chunk_lengths):
+                head = entries[start]
+                if start == 0 and heads and pagemap_run_continues(heads[-1], lengths[-1], head):
+                    # The run carries on from the previous read
+                    lengths[-1] += length
+                else:
+                    starts.append(done + start)
+                    lengths.append(length)
+                    heads.append(head)
+            done += len(entries)
+            if len(entries) < min(n_pages - done + len(entries), self.max_read_pages):
+                break
+        if done < n_pages:
+            starts.append(done)
+            lengths.append(n_pages - done)
+            heads.append(None)
+        return starts, lengths, heads
+
+    def soft_dirty_ranges(self, va, n_pages):
+        """
+        Find the ranges of pages with their soft-dirty bit set, among n_pages consecutive pages starting at a
+        page-aligned VA, by reading their entries. This is for when PAGEMAP_SCAN can't be used.
+        Only the byte of each entry that holds the bit is looked at, so the entries are never unpacked.
+        If the entries can't be read, the rest of the pages are reported as dirty.
+        Returns a list of (start VA, end VA)
+        """
+        byte = _PM_SOFT_DIRTY // 8 if sys.byteorder == "little" else 7 - _PM_SOFT_DIRTY // 8
+        mask = 1 << (_PM_SOFT_DIRTY % 8)
+        is_dirty = bytes(1 if b & mask else 0 for b in range(256)) # Table to turn each byte into 1 if dirty, or 0
+        ranges = []
+        done = 0
+        while done < n_pages:
+            entries = self.entries(va + done * self.page_size, n_pages - done)
+            if not entries:
+                ranges.append((va + done * self.page_size, va + n_pages * self.page_size))
+                break
+            dirty = bytes(entries.cast("B")[byte::KernelPME.entry_size]).translate(is_dirty)
+            i = dirty.find(1)
+            while i >= 0:
+                end = dirty.find(0, i)
+                if end < 0:
+                    end = len(dirty)
+                (start_va, end_va) = (va + (done + i) * self.page_size, va + (done + end) * self.page_size)
+                if ranges and ranges[-1][1] == start_va:
+                    # The range carries on from the previous read
+                    ranges[-1] = (ranges[-1][0], end_va)
+                else:
+                    ranges.append((start_va, end_va))
+                i = dirty.find(1, end)
+            done += len(entries)
+        return ranges
+
     def pa_range(self, va, size):
         """
         Given a range of VAs (not necessarily page-aligned), find all the physical pages spanning the range.
         Return a list of PageMapping objects representing contiguous physical ranges.
-        Currently we do this simplistically, extending the current range one page at a time
-        when we discover the next page to be physically contiguous.
         """
         size += (va % self.page_size)
         if (size % self.page_size) != 0:
@@ -298,16 +523,13 @@ class PAMap:
         n_pages = size // self.page_size
         va = self.round_down(va)
         maps = []
-        for v in range(va, va+size, self.page_size):
-            m = self.mapping(v)
-            if m.is_mapped() and len(maps) >= 1 and m.pa() == maps[-1].end_pa():
-                maps[-1].n_pages += 1
-                maps[-1].size += self.page_size
-            elif not m.is_mapped() and len(maps) >= 1 and not maps[-1].is_mapped():
-                maps[-1].n_pages += 1
-                maps[-1].size += self.page_size
-            else:
-                maps.append(m)
+        for (start, length, head) in zip(*self.pa_runs(va, n_pages)):
+            m = PageMapping(va=va + start * self.page_size)
+            m.n_pages = length
+            m.size = length * self.page_size
+            if head is not None:
+                m.pte = KernelPME(head, size=self.page_size, pagemap=self)
+            maps.append(m)
         return maps
 
 
@@ -327,14 +549,15 @@ class SystemRAMRange:
         return "#%d PA:0x%x (%uMb)" % (self.index, self.start, self.size/(1024*1024))
 
 
-def system_RAM_ranges():
+def system_RAM_ranges(lines=None):
     """
     Get the physical ranges of System RAM known to the OS, by reading /proc/iomem.
+    If lines is given, parse those lines instead of reading the file.
     """
     page_size = os.sysconf("SC_PAGE_SIZE")
     assert page_size != 0, "cannot determine system page size"
-    f = open("/proc/iomem")
-    for ln in f:        
+    f = open("/proc/iomem") if lines is None else None
+    for ln in (f if lines is None else lines):        
         ln = ln.strip('\n')      
         if ln.endswith("System RAM"):
             toks = ln.split(None, 2)
@@ -352,7 +575,8 @@ def system_RAM_ranges():
                 assert (astart % page_size) == 0, "error: /proc/iomem entry not %u-aligned: %s" % (page_size, ln)
                 assert (size % page_size) == 0, "error: /proc/iomem entry size not multiple of %u: %s" % (page_size, ln)
             yield SystemRAMRange(astart, size)
-    f.close()
+    if f is not None:
+        f.close()
 
 
 class SystemRAMMap:
@@ -360,20 +584,56 @@ class SystemRAMMap:
     List of System RAM ranges (as described by /proc/iomem), so we can find
     out which range a given PFN is in.
     """
-    def __init__(self):
-        self.ranges = list(system_RAM_ranges())
+    def __init__(self, lines=None):
+        self.ranges = sorted(system_RAM_ranges(lines), key=lambda r: r.start)
         for (i, r) in enumerate(self.ranges):
             r.index = i
+        self.starts = [r.start for r in self.ranges]
         
     def addr_index(self, pa):
         """
         Given a PA, find the /proc/iomem range containing this PA.
         """
-        for r in self.ranges:
-            if r.contains(pa):
-                return r
+        i = bisect.bisect_right(self.starts, pa) - 1
+        if i >= 0 and self.ranges[i].contains(pa):
+            return self.ranges[i]
         return None
 
+    def addr_index_many(self, pas):
+        """
+        Given a sequence of PAs, find the /proc/iomem range containing each one.
+        The PAs are visited in sorted order, so the ranges are found in one pass.
+        Returns a list with the range (or None) for each PA, in the original order.
+        """
+        result = [None] * len(pas)
+        i = 0
+        for j in sorted(range(len(pas)), key=pas.__getitem__):
+            pa = pas[j]
+            while i < len(self.ranges) and self.ranges[i].start + self.ranges[i].size <= pa:
+                i += 1
+            if i < len(self.ranges) and self.ranges[i].contains(pa):
+                result[j] = self.ranges[i]
+        return result
+
+
+# The parsed /proc/iomem, and the contents it was parsed from
+_system_ram_map = None
+_system_ram_key = None
+
+def system_ram_map():
+    """
+    Get the SystemRAMMap for the system. It is only parsed again if /proc/iomem
+    has changed, i.e. after memory hotplug.
+    """
+    global _system_ram_map, _system_ram_key
+    with open("/proc/iomem") as f:
+        lines = f.readlines()
+    key = (os.stat("/proc/iomem").st_mtime_ns, lines)
+    if _system_ram_map is None or key != _system_ram_key:
+        _system_ram_map = SystemRAMMap(lines)
+        _system_ram_key = key
+    return _system_ram_map
+
 
 def show_system_RAM():
     print("Physical memory ranges")
@@ -384,6 +644,193 @@ def show_system_RAM():
 ### New Additions Below This Line
 
 from dataclasses import dataclass
+from collections import OrderedDict
+
+# Tables for bytes.translate, to look at one byte of every pagemap entry at once
+_BYTE_TOP_BIT = bytes(b >> 7 for b in range(256))       # 1 if the top bit is set, else 0
+_BYTE_LOW_BITS = bytes(b & 0x7f for b in range(256))    # Clears the top bit
+_BYTE_NONZERO = bytes(1 if b else 0 for b in range(256)) # 1 if any bit is set, else 0
+
+def pagemap_runs(entries):
+    """
+    Split raw pagemap entries into runs of pages that are either all not present,
+    or all present and mapped to consecutive PFNs.
+    The places where a run ends are found for every page at once, with a fixed number of passes over the
+    entries as bytes and as one big integer, so only the work for each run is done in Python:
+    the entries are turned into present bits and PFNs, and the PFNs plus one are compared to the next ones.
+    Returns (starts, lengths) arrays with the first page index and page count of each run.
+    """
+    n = len(entries)
+    starts = array("Q", [0] if n else [])
+    if n > 1:
+        if sys.byteorder == "big":
+            entries = array("Q", entries)
+            entries.byteswap()
+        raw = bytearray(memoryview(entries).cast("B"))
+        
+        # The present bit is the top bit of the last byte, and the PFN is everything below the soft-dirty bit
+        present = int.from_bytes(bytes(raw[7::8]).translate(_BYTE_TOP_BIT), "little")
+        raw[7::8] = bytes(n)
+        raw[6::8] = bytes(raw[6::8]).translate(_BYTE_LOW_BITS)
+        pfns = int.from_bytes(raw, "little")
+        
+        # Lane i of next_pfns is PFN i + 1, which never carries into the next lane, as PFNs are below 2^55
+        next_pfns = pfns + int.from_bytes((b"\x01" + bytes(7)) * n, "little")
+        jumps = ((pfns >> 64) ^ next_pfns).to_bytes(8 * n, "little")
+        jumped = 0 # Byte i is 1 if page i + 1 does not carry on from the PFN of page i
+        for byte in range(7):
+            jumped |= int.from_bytes(jumps[byte::8].translate(_BYTE_NONZERO), "little")
+        
+        # A run ends where the present bit changes, or the PFN jumps between present pages
+        ends = ((present ^ (present >> 8)) | ((present >> 8) & jumped)).to_bytes(n, "little")
+        i = ends.find(1, 0, n - 1)
+        while i >= 0:
+            starts.append(i + 1)
+            i = ends.find(1, i + 1, n - 1)
+    
+    lengths = array("Q", [b - a for (a, b) in zip(starts, starts[1:])])
+    if n:
+        lengths.append(n - starts[-1])
+    return starts, lengths
+
+
+def pagemap_run_continues(head, length, next_head):
+    """
+    Check if the run of pages with the given first PTE and length is continued by a run starting with next_head
+    """
+    present = 1 << _PM_PRESENT
+    if not (head & present) or not (next_head & present):
+        return not (head & present) and not (next_head & present)
+    return (next_head & _PM_PFRAME_MASK) == (head & _PM_PFRAME_MASK) + length
+
+
+def read_pfn_runs(pfn_array, runs):
+    """
+    Read the entries of many PFN runs from a PFN-indexed kernel array such as /proc/kpagecount.
+    The runs are sorted and merged first, so each PFN is read once, with one read per stretch of touching runs.
+
+    :param pfn_array: the ProcArray to read
+    :param runs: list of (first PFN, number of pages)
+    :return: list of an array of the entries of each run, which is shorter than the run if they could not all be read
+    """
+    merged = [] # [start PFN, end PFN, runs] of each read
+    for (pfn, n_pages) in sorted(set(runs)):
+        if merged and pfn <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], pfn + n_pages)
+            merged[-1][2].append((pfn, n_pages))
+        else:
+            merged.append([pfn, pfn + n_pages, [(pfn, n_pages)]])
+
+    values = {}
+    for (start, end, merged_runs) in merged:
+        data = pfn_array.read_range(start, end - start)
+        if data is None:
+            data = array(ProcArray.typecodes[pfn_array.entry_size])
+        for (pfn, n_pages) in merged_runs:
+            values[(pfn, n_pages)] = data[pfn - start:pfn - start + n_pages]
+
+    return [values[run] for run in runs]
+
+
+class PFNArrayCache:
+    """
+    Bounded cache of a PFN-indexed kernel array such as /proc/kpageflags.
+    The array is cached in fixed-size blocks of PFNs, so any run within cached blocks is sliced out of them,
+    whether or not the same run was read before (e.g. a shared library mapped by many processes, or split
+    differently by their VMRs). The least recently used blocks are dropped once the cache holds max_entries entries.
+    The entries are only as fresh as the last clear, as the kernel frees and reuses PFNs.
+    """
+    def __init__(self, fn, max_entries=1 << 18, block_pages=512):
+        self.array = ProcArray(fn)
+        self.block_pages = block_pages
+        self.max_blocks = max(1, max_entries // block_pages)
+        self.blocks = OrderedDict() # PFN // block_pages -> array of the entries of the block
+
+    def clear(self):
+        """
+        Drop all the cached entries
+        """
+        self.blocks.clear()
+
+    def load_runs(self, runs):
+        """
+        Get the entries for many PFN runs at once.
+        The blocks that are not cached are read with read_pfn_runs, so touching blocks are read together.
+
+        :param runs: list of (first PFN, number of pages)
+        :return: list of an array of the entries of each run, which is shorter than the run if they could not all be read
+        """
+        block_pages = self.block_pages
+        blocks = {} # block -> array of the entries, for the blocks of these runs
+        missing = []
+        for (pfn, n_pages) in runs:
+            for block in range(pfn // block_pages, (pfn + n_pages - 1) // block_pages + 1):
+                if block in blocks:
+                    continue
+                block_values = self.blocks.get(block)
+                if block_values is None:
+                    missing.append(block)
+                    blocks[block] = None
+                else:
+                    self.blocks.move_to_end(block)
+                    blocks[block] = block_values
+
+        missing.sort()
+        for (block, block_values) in zip(missing, read_pfn_runs(self.array, [(block * block_pages, block_pages) for block in missing])):
+            blocks[block] = block_values
+            # Blocks that could not be read whole are read again next time
+            if len(block_values) == block_pages:
+                self.blocks[block] = block_values
+                if len(self.blocks) > self.max_blocks:
+                    self.blocks.popitem(last=False)
+
+        result = []
+        for (pfn, n_pages) in runs:
+            values = array(ProcArray.typecodes[self.array.entry_size])
+            for block in range(pfn // block_pages, (pfn + n_pages - 1) // block_pages + 1):
+                block_start = block * block_pages
+                block_values = blocks[block]
+                lo = max(pfn, block_start) - block_start
+                hi = min(pfn + n_pages, block_start + block_pages) - block_start
+                values.extend(block_values[lo:hi])
+                if len(block_values) < hi:
+                    break
+            result.append(values)
+        return result
+
+
+# /proc/kpageflags is cached across the processes read in one round by this Python process, which is cleared
+# at the start of every round. Each worker of a process pool has its own. /proc/kpagecount changes with every
+# map and unmap, so it is always read afresh
+_kpageflags_cache = None
+
+def kpageflags_cache():
+    """
+    Get the cache of /proc/kpageflags for this round
+    """
+    global _kpageflags_cache
+    if _kpageflags_cache is None:
+        _kpageflags_cache = PFNArrayCache("/proc/kpageflags")
+    return _kpageflags_cache
+
+def clear_kpageflags_cache():
+    """
+    Start a new round of reads, so pages freed and reused since the last one are not given their old flags
+    """
+    if _kpageflags_cache is not None:
+        _kpageflags_cache.clear()
+
+_kpagecount_array = None
+
+def kpagecount_array():
+    """
+    Get /proc/kpagecount, the number of times each page is mapped, as a ProcArray
+    """
+    global _kpagecount_array
+    if _kpagecount_array is None:
+        _kpagecount_array = ProcArray("/proc/kpagecount")
+    return _kpagecount_array
+
 
 @dataclass
 class PageMapObj:
@@ -402,11 +849,208 @@ class PageMapObj:
     device_addr: int = 0 # the start address of the device the physical mem is from
     device_size: int = 0 # the size in bytes of the device the physical mem is from
     kflags: int = 0 # kflags for this mapping
+    page_size: int = PAMap.page_size # size of the pages backing this mapping, larger for huge pages
+    mapcount: int = 0 # largest number of times any of the physical pages is mapped, from /proc/kpagecount
 
-def get_va_pa_mappings(pid, should_print = False):
+def smaps_usage(pidstr):
     """
-    Scan the virtual address space of the given process. None means self. -1 means kernel.
-    Returns the list of PAMap objects
+    Read the memory usage of every VMR from /proc/pid/smaps
+    
+    :param pidstr: PID of the process, or "self"
+    :return: dict from (vaddr, vaend) to a dict of the sizes reported for that VMR in bytes,
+             e.g. {"Rss": ..., "Swap": ..., "AnonHugePages": ..., "KernelPageSize": ...}
+    """
+    usage = {}
+    vmr = None
+    with open("/proc/" + pidstr + "/smaps") as f:
+        for ln in f:
+            k = ln.split()
+            if not k[0].endswith(':'):
+                # Start of a new VMR
+                (addr, aend) = k[0].split('-')
+                vmr = (int(addr, 16), int(aend, 16))
+                usage[vmr] = {}
+            elif len(k) == 3 and k[2] == "kB":
+                usage[vmr][k[0][:-1]] = int(k[1]) * 1024
+    return usage
+
+def huge_page_segments(vaddr, n_pages, kpageflags, page_size):
+    """
+    Split a run of co-contiguous pages into segments of regular pages and segments of huge pages
+    (transparent or hugetlbfs), using the compound page flags from /proc/kpageflags.
+    A compound page only counts as a huge page if it is mapped whole, and aligned to its size.
+    
+    :param vaddr: VA of the first page of the run
+    :param n_pages: number of pages in the run
+    :param kpageflags: /proc/kpageflags entries for the pages of the run, and the page after it
+    :param page_size: size of a regular page
+    :return: list of (first page index, number of regular pages, page size) for the segments
+    """
+    head = 1 << _KPF_COMPOUND_HEAD
+    tail = 1 << _KPF_COMPOUND_TAIL
+    huge = (1 << _KPF_HUGE) | (1 << _KPF_THP)
+
+    def page_flags(i):
+        return kpageflags[i] if i < len(kpageflags) else 0
+
+    segments = []
+    i = 0
+    while i < n_pages:
+        flags = page_flags(i)
+        size = 1
+        if (flags & head) and (flags & huge):
+            while i + size < n_pages and page_flags(i + size) & tail:
+                size += 1
+            whole = size > 1 and (size & (size - 1)) == 0 and not (page_flags(i + size) & tail)
+            if not whole or (vaddr // page_size + i) % size != 0:
+                size = 1
+        if segments and segments[-1][2] == size * page_size:
+            segments[-1][1] += size
+        else:
+            segments.append([i, size, size * page_size])
+        i += size
+    return [tuple(segment) for segment in segments]
+
+class PageMapRow:
+    """
+    Lightweight view of one row of a PageMapColumns, with the same fields as PageMapObj
+    """
+    __slots__ = ("columns", "i")
+    
+    def __init__(self, columns, i):
+        self.columns = columns
+        self.i = i
+        
+    @property
+    def vaddr(self):
+        return self.columns.vaddr[self.i]
+    
+    @property
+    def mapped(self):
+        return (self.columns.flags[self.i] & PageMapColumns.MAPPED) != 0
+    
+    @property
+    def missing_pte(self):
+        return (self.columns.flags[self.i] & PageMapColumns.MISSING_PTE) != 0
+    
+    @property
+    def paddr(self):
+        if self.mapped:
+            return self.columns.paddr[self.i]
+        return 0 if self.missing_pte else None
+    
+    @property
+    def size(self):
+        return self.columns.size[self.i]
+    
+    @property
+    def device_addr(self):
+        device = self.columns.device[self.i]
+        return self.columns.devices[device].start if device >= 0 else 0
+    
+    @property
+    def device_size(self):
+        device = self.columns.device[self.i]
+        return self.columns.devices[device].size if device >= 0 else 0
+    
+    @property
+    def kflags(self):
+        return self.columns.kflags[self.i]
+    
+    @property
+    def page_size(self):
+        return self.columns.page_size[self.i]
+    
+    @property
+    def mapcount(self):
+        return self.columns.mapcount[self.i]
+    
+    def to_obj(self):
+        return PageMapObj(self.vaddr, self.mapped, self.missing_pte, self.paddr, self.size,
+                          self.device_addr, self.device_size, self.kflags, self.page_size, self.mapcount)
+
+
+class PageMapColumns:
+    """
+    Structure-of-arrays form of the results of get_va_pa_mappings
+    
+    Row i holds the same data as one PageMapObj, but the rows are stored as typed array columns
+    instead of a list of objects. Devices are stored as an index into the devices list, or -1.
+    The rows for each scanned VMR can be sliced out cheaply with vmr_slices.
+    """
+    MAPPED = 1 << 0       # flags bit: the row is mapped to a physical region
+    MISSING_PTE = 1 << 1  # flags bit: we couldn't read the PTE for this row
+    
+    # The name and array typecode of each column
+    column_types = (("vaddr", "Q"), ("size", "Q"), ("paddr", "Q"), ("flags", "B"), ("device", "i"),
+               ("kflags", "Q"), ("page_size", "Q"), ("mapcount", "I"))
+    
+    def __init__(self, devices=None):
+        for (name, typecode) in self.column_types:
+            setattr(self, name, array(typecode))
+        self.devices = devices if devices is not None else [] # SystemRAMRange for each device index
+        self.vmrs = [] # (vaddr, vaend, first row, end row) for each scanned VMR
+        
+    def append(self, vaddr, size, paddr=0, flags=0, device=-1, kflags=0, page_size=PAMap.page_size, mapcount=0):
+        self.vaddr.append(vaddr)
+        self.size.append(size)
+        self.paddr.append(paddr)
+        self.flags.append(flags)
+        self.device.append(device)
+        self.kflags.append(kflags)
+        self.page_size.append(page_size)
+        self.mapcount.append(mapcount)
+        
+    def extend(self, other):
+        """
+        Append all the rows of another PageMapColumns, which must use the same devices
+        """
+        offset = len(self)
+        for (name, _) in self.column_types:
+            getattr(self, name).extend(getattr(other, name))
+        self.vmrs.extend((vaddr, vaend, start + offset, stop + offset) for (vaddr, vaend, start, stop) in other.vmrs)
+        
+    def slice(self, start, stop):
+        """
+        Get the rows [start, stop) as a PageMapColumns whose columns are zero-copy views of these ones
+        """
+        view = PageMapColumns(self.devices)
+        for (name, _) in self.column_types:
+            setattr(view, name, memoryview(getattr(self, name))[start:stop])
+        return view
+    
+    def vmr_slices(self):
+        """
+        Iterate through the scanned VMRs, as tuples of (vaddr, vaend, PageMapColumns view of the VMR's rows)
+        """
+        for (vaddr, vaend, start, stop) in self.vmrs:
+            yield (vaddr, vaend, self.slice(start, stop))
+        
+    def __len__(self):
+        return len(self.vaddr)
+    
+    def __getitem__(self, i):
+        return PageMapRow(self, i)
+    
+    def __iter__(self):
+        for i in range(len(self.vaddr)):
+            yield PageMapRow(self, i)
+
+
+def iter_va_pa_columns(pid, sparse = False, huge_pages = True, vmrs = None):
+    """
+    Scan the virtual address space of the given process one VMR at a time. None means self. -1 means kernel.
+    Each VMR's results are complete (with devices and kflags) when they are yielded, so only
+    one VMR's worth of results needs to be held at a time.
+    Yields a tuple of (vaddr, vaend, PageMapColumns) for every VMR
+    
+    :param sparse: if true, use /proc/pid/smaps to skip reading the pagemap for VMRs with nothing resident,
+                   and return one unmapped row for each of them
+    :param huge_pages: if true, return the transparent and hugetlbfs huge pages in VMRs that smaps
+                       reports as using them as separate rows with their own page size
+    :param vmrs: if given, a set of (vaddr, vaend) and only these VMRs are scanned,
+                 or a dict from (vaddr, vaend) to a list of page-aligned (start, end) in the VMR,
+                 and only those ranges of those VMRs are scanned, with rows for nothing else
     """
     if pid is None:
         pidstr = None
@@ -415,8 +1059,6 @@ def get_va_pa_mappings(pid, should_print = False):
     else:
         pidstr = str(pid)
         
-    results = []
-        
     # Show the VA and (I)PA of the current process address space
     def proc_maps(fn):
         f = open(fn)
@@ -431,7 +1073,7 @@ def get_va_pa_mappings(pid, should_print = False):
             (addr, aend) = k[0].split('-')
             yield (ln[:-1], int(addr, 16), int(aend, 16))
     m = PAMap(pid=pidstr)
-    sysram = SystemRAMMap()
+    sysram = system_ram_map()
     
     # Scan the virtual memory ranges allocated to the target process.
     if pid is None:
@@ -439,46 +1081,205 @@ def get_va_pa_mappings(pid, should_print = False):
     else:
         areas = proc_maps("/proc/" + pidstr + "/maps")
         
+    # Memory usage of the VMRs, for sparse scanning and finding huge pages
+    usage = smaps_usage(pidstr) if (sparse or huge_pages) and pid is not None else {}
+    kpageflags = kpageflags_cache()
+    kpagecount = kpagecount_array()
+        
     # Scan the VA ranges for the selected process, or for the kernel
     for (ln, vaddr, vaend) in areas:
-        assert (vaddr % m.page_size) == 0 and (vaend % m.page_size) == 0, "not 0x%x-aligned:" % (m.page_size, ln)
+        assert (vaddr % m.page_size) == 0 and (vaend % m.page_size) == 0, "not 0x%x-aligned: %s" % (m.page_size, ln)
+        if vmrs is not None and (vaddr, vaend) not in vmrs:
+            continue
+        vmr_usage = usage.get((vaddr, vaend), {})
+        spans = vmrs[(vaddr, vaend)] if isinstance(vmrs, dict) else [(vaddr, vaend)]
+        results = PageMapColumns(sysram.ranges)
+        results.vmrs.append((vaddr, vaend, 0, 0))
+        
+        # Nothing is resident, so there is no need to read the pagemap
+        if sparse and vmr_usage.get("Rss") == 0:
+            for (span_start, span_end) in spans:
+                results.append(span_start, span_end - span_start)
+            results.vmrs[0] = (vaddr, vaend, 0, len(results))
+            yield (vaddr, vaend, results)
+            continue
+        
+        # Only look for huge pages in VMRs that smaps says are using them
+        find_huge = huge_pages and (vmr_usage.get("AnonHugePages", 0) > 0
+                                    or vmr_usage.get("ShmemPmdMapped", 0) > 0
+                                    or vmr_usage.get("FilePmdMapped", 0) > 0
+                                    or vmr_usage.get("KernelPageSize", 0) > m.page_size)
+        
+        vmr_start = vaddr
+        pfn_runs = [] # (first PFN, number of pages) for every mapped run
+        runs = [] # (VA, number of pages, raw PTE of the first page) of every run
+        for (span_start, span_end) in spans:
+            (starts, lengths, heads) = m.pa_runs(span_start, (span_end - span_start) // m.page_size)
+            runs.extend((span_start + start * m.page_size, length, raw) for (start, length, raw) in zip(starts, lengths, heads))
+        if find_huge:
+            # The page after each run is needed to tell if a compound page ends with the run
+            huge_runs = [(raw & _PM_PFRAME_MASK, length + 1) for (_, length, raw) in runs
+                         if raw is not None and (raw >> _PM_PRESENT) & 1]
+            run_kflags = dict(zip(huge_runs, kpageflags.load_runs(huge_runs)))
+            head_kflags = [] # kflags of the first page of every mapped run, from the flags of the whole run
 
-        maps = m.pa_range(vaddr, vaend-vaddr)
-        for mapping in maps:
-            result_obj = PageMapObj()
+        # Build one result per run of co-contiguous pages
+        for (vaddr, length, raw) in runs:
+            size = length * m.page_size
             
-            # Record the VA & PA
-            result_obj.vaddr = vaddr
+            if raw is None:
+                print(f"Warning: Missing PTE for vaddr range [{vaddr:16x},{vaddr + size:16x}]")
+                results.append(vaddr, 0, flags=PageMapColumns.MISSING_PTE)
+                continue
             
-            if mapping.pte is None:
-                print(f"Warning: Missing PTE for vaddr range [{vaddr:16x},{vaddr + mapping.size:16x}]")
-                result_obj.missing_pte = mapping.pte is None
+            if not (raw >> _PM_PRESENT) & 1:
+                results.append(vaddr, size)
+                continue
+                
+            # Mapped runs are split where huge pages start and end
+            pfn = raw & _PM_PFRAME_MASK
+            if find_huge:
+                flags = run_kflags[(pfn, length + 1)]
+                segments = huge_page_segments(vaddr, length, flags, m.page_size)
             else:
-                result_obj.mapped = mapping.is_mapped()
-                result_obj.paddr = mapping.pa()
-                result_obj.size = mapping.size
-                vaddr += mapping.size
+                segments = [(0, length, m.page_size)]
                 
-            # Record details for mapped regions
-            if not result_obj.missing_pte and result_obj.mapped:
-                # Find the physical device
-                pa2 = mapping.pte.pfn * m.page_size
-                assert(pa2 == result_obj.paddr) # Sanity check
-                sram_range = sysram.addr_index(result_obj.paddr)    # /proc/iomem entry containing this PA
-                result_obj.device_addr = sram_range.start
-                result_obj.device_size = sram_range.size
+            for (seg_start, seg_pages, seg_page_size) in segments:
+                # Record the VA & PA
+                results.append(vaddr, seg_pages * m.page_size, (pfn + seg_start) * m.page_size,
+                               PageMapColumns.MAPPED, page_size=seg_page_size)
+                vaddr += seg_pages * m.page_size
                 
-                # Find the kflags
-                kflags = mapping.pte.kpageflags()
-                if kflags is not None:
-                    result_obj.kflags = kflags
-            
-            if should_print:
-                if result_obj.mapped:
-                    print(f'VA={mapping.va:16x}, PA={mapping.print_pa()}, Pages={mapping.n_pages:3d}, Device={result_obj.device_addr:16x}, kflags: {kpf_string(result_obj.kflags)}')
-                else:
-                    print(f'VA={mapping.va:16x}, PA={mapping.print_pa()}, Pages={mapping.n_pages:3d}')
+                # The device and kflags of mapped regions are found for all the runs at once, below
+                pfn_runs.append((pfn + seg_start, seg_pages))
+                if find_huge:
+                    head_kflags.append(flags[seg_start] if seg_start < len(flags) else None)
                 
-            results.append(result_obj)
+        results.vmrs[0] = (vmr_start, vaend, 0, len(results))
+    
+        mapped = [i for i in range(len(results)) if results.flags[i] & PageMapColumns.MAPPED]
+        
+        # Find the physical devices
+        sram_ranges = sysram.addr_index_many([results.paddr[i] for i in mapped])    # /proc/iomem entries containing the PAs
+        for (i, sram_range) in zip(mapped, sram_ranges):
+            # Memory outside System RAM (e.g. device memory mapped through /dev/mem) keeps -1, for no device
+            if sram_range is not None:
+                results.device[i] = sram_range.index
+        
+        # Find the kflags and the map counts, with one read per physical run in the VMR
+        if not find_huge:
+            head_kflags = [flags[0] if len(flags) > 0 else None for flags in kpageflags.load_runs(pfn_runs)]
+        counts = read_pfn_runs(kpagecount, pfn_runs)
+        for (i, kflags, run_counts) in zip(mapped, head_kflags, counts):
+            if kflags is not None:
+                results.kflags[i] = kflags
+            # A run counts as shared if any of its pages is
+            results.mapcount[i] = max(run_counts, default=0)
+                
+        yield (vmr_start, vaend, results)
+
+def clear_soft_dirty(pid):
+    """
+    Clear the soft-dirty bits of all the pages of a process, so the pages written from now on can be found
+    """
+    with open("/proc/" + str(pid) + "/clear_refs", "w") as f:
+        f.write("4")
+
+_soft_dirty_supported = None
+
+def soft_dirty_supported():
+    """
+    Check if the kernel tracks soft-dirty bits (CONFIG_MEM_SOFT_DIRTY), by writing to a new page of our own.
+    Without it the bits always read as clear, and clearing them does nothing.
+    """
+    global _soft_dirty_supported
+    if _soft_dirty_supported is None:
+        import ctypes, mmap
+        buf = mmap.mmap(-1, PAMap.page_size)
+        buf[0] = 1
+        page = ctypes.c_char.from_buffer(buf)
+        pme = PAMap().entry(ctypes.addressof(page))
+        del page
+        buf.close()
+        _soft_dirty_supported = pme is not None and pme.bit(_PM_SOFT_DIRTY)
+    return _soft_dirty_supported
+
+def soft_dirty_vmrs(pid):
+    """
+    Find the pages of a process written since the soft-dirty bits were last cleared, for each VMR with any.
+    New VMRs are reported as well, since the kernel marks all of their pages as soft-dirty.
+    Returns a dict from the (vaddr, vaend) of each of these VMRs to a list of the (start VA, end VA) of its written pages
+    """
+    m = PAMap(pid=str(pid))
+    dirty = {}
+    with open("/proc/" + str(pid) + "/maps") as f:
+        for ln in f:
+            (addr, aend) = ln.split()[0].split('-')
+            (vaddr, vaend) = (int(addr, 16), int(aend, 16))
+            # PAGEMAP_SCAN can find the soft-dirty pages without reading every entry
+            dirty_ranges = m.scan(vaddr, vaend, _PAGE_IS_SOFT_DIRTY)
+            if dirty_ranges is None:
+                dirty_ranges = m.soft_dirty_ranges(vaddr, (vaend - vaddr) // m.page_size)
+            else:
+                dirty_ranges = [(start, end) for (start, end, _) in dirty_ranges]
+            if dirty_ranges:
+                dirty[(vaddr, vaend)] = dirty_ranges
+    return dirty
+
+def max_mapcount(paddr, size):
+    """
+    Read the largest number of times any page of a physical range is mapped right now, from /proc/kpagecount.
+    Returns None if the counts can't be read.
+    """
+    page_size = PAMap.page_size
+    counts = kpagecount_array().read_range(paddr // page_size, (paddr + size - 1) // page_size + 1 - paddr // page_size)
+    return None if counts is None else max(counts, default=0)
+
+def print_va_pa_rows(rows):
+    """
+    Print the rows of a PageMapColumns, or a list of PageMapObj
+    """
+    page_size = PAMap.page_size
+    for result_obj in rows:
+        if result_obj.missing_pte:
+            print_pa = f'{"Inaccessible" : >16}'
+        elif result_obj.mapped:
+            print_pa = f'{result_obj.paddr:16x}'
+        else:
+            print_pa = f'{"None" : >16}'
+        n_pages = result_obj.size // page_size
+        if result_obj.mapped:
+            print(f'VA={result_obj.vaddr:16x}, PA={print_pa}, Pages={n_pages:3d}, Device={result_obj.device_addr:16x}, kflags: {kpf_string(result_obj.kflags)}')
+        else:
+            print(f'VA={result_obj.vaddr:16x}, PA={print_pa}, Pages={n_pages:3d}')
+
+def get_va_pa_columns(pid, should_print = False, sparse = False, huge_pages = True) -> PageMapColumns:
+    """
+    Scan the virtual address space of the given process. None means self. -1 means kernel.
+    Returns the results as a PageMapColumns
+    
+    :param sparse: if true, use /proc/pid/smaps to skip reading the pagemap for VMRs with nothing resident,
+                   and return one unmapped row for each of them
+    :param huge_pages: if true, return the transparent and hugetlbfs huge pages in VMRs that smaps
+                       reports as using them as separate rows with their own page size
+    """
+    results = PageMapColumns(system_ram_map().ranges)
+    for (_, _, vmr_results) in iter_va_pa_columns(pid, sparse, huge_pages):
+        results.extend(vmr_results)
+            
+    if should_print:
+        print_va_pa_rows(results)
     
-    return results
\ No newline at end of file
+    return results
+
+def get_va_pa_mappings(pid, should_print = False, sparse = False, huge_pages = True):
+    """
+    Scan the virtual address space of the given process. None means self. -1 means kernel.
+    Returns the list of PAMap objects
+    
+    :param sparse: if true, use /proc/pid/smaps to skip reading the pagemap for VMRs with nothing resident,
+                   and return one unmapped object for each of them
+    :param huge_pages: if true, return the transparent and hugetlbfs huge pages in VMRs that smaps
+                       reports as using them as separate objects with their own page size
+    """
+    return [row.to_obj() for row in get_va_pa_columns(pid, should_print, sparse, huge_pages)]
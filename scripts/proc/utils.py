@@ -1,5 +1,7 @@
 import bisect
 import copy
+import heapq
+import itertools
 import traceback
 
 ### UTILITY CLASSES ###
@@ -30,17 +32,199 @@ class EasyDict():
     def values(self):
         return self.__dict__.values()
 
+class BlockedSortedList():
+    """
+    Sorted list of unique numbers, stored as a list of sorted blocks
+    
+    A lookup is a binary search over the last number of each block, and then within one block.
+    An insert only shifts the numbers in one block, which is split in half once it gets too large,
+    so both stay fast with millions of numbers
+    """
+    
+    block_size = 512 # Blocks are split once they reach twice this size
+    
+    def __init__(self):
+        self.blocks = [] # Sorted blocks of sorted numbers
+        self.maxes = [] # The last number in each block
+        self.len = 0
+        
+    @classmethod
+    def from_sorted(cls, values: list[int]) -> 'BlockedSortedList':
+        """
+        Build the list from numbers that are already sorted and unique, in O(n)
+        """
+        result = cls()
+        result.blocks = [values[i:i + cls.block_size] for i in range(0, len(values), cls.block_size)]
+        result.maxes = [block[-1] for block in result.blocks]
+        result.len = len(values)
+        return result
+        
+    def __len__(self) -> int:
+        return self.len
+    
+    def __iter__(self):
+        for block in self.blocks:
+            yield from block
+            
+    def add(self, x: int):
+        """
+        Add a number, if it is not already in the list
+        """
+        
+        if not self.blocks:
+            self.blocks.append([x])
+            self.maxes.append(x)
+            self.len = 1
+            return
+        
+        # Numbers past the end go into the last block
+        b = min(bisect.bisect_left(self.maxes, x), len(self.blocks) - 1)
+        block = self.blocks[b]
+        i = bisect.bisect_left(block, x)
+        
+        if i < len(block) and block[i] == x:
+            return
+        
+        block.insert(i, x)
+        self.maxes[b] = block[-1]
+        self.len += 1
+        
+        if len(block) >= 2 * self.block_size:
+            right = block[self.block_size:]
+            del block[self.block_size:]
+            self.blocks.insert(b + 1, right)
+            self.maxes[b] = block[-1]
+            self.maxes.insert(b + 1, right[-1])
+    
+    def remove(self, x: int):
+        """
+        Remove a number, if it is in the list
+        """
+        
+        b = bisect.bisect_left(self.maxes, x)
+        
+        if b == len(self.blocks):
+            return
+        
+        block = self.blocks[b]
+        i = bisect.bisect_left(block, x)
+        
+        if block[i] != x:
+            return
+        
+        del block[i]
+        self.len -= 1
+        
+        if not block:
+            del self.blocks[b]
+            del self.maxes[b]
+        else:
+            self.maxes[b] = block[-1]
+    
+    def floor(self, x: int) -> int | None:
+        """
+        Get the largest number that is <= x, or None if there is none
+        """
+        
+        b = bisect.bisect_right(self.maxes, x)
+        
+        if b < len(self.blocks):
+            block = self.blocks[b]
+            i = bisect.bisect_right(block, x)
+            if i > 0:
+                return block[i - 1]
+            
+        return self.maxes[b - 1] if b > 0 else None
+    
+    def higher(self, x: int) -> int | None:
+        """
+        Get the smallest number that is > x, or None if there is none
+        """
+        
+        b = bisect.bisect_right(self.maxes, x)
+        
+        if b == len(self.blocks):
+            return None
+        
+        block = self.blocks[b]
+        return block[bisect.bisect_right(block, x)]
+    
+    def iter_from(self, x: int):
+        """
+        Iterate through the numbers that are >= x, in order
+        """
+        
+        b = bisect.bisect_left(self.maxes, x)
+        
+        if b == len(self.blocks):
+            return
+        
+        block = self.blocks[b]
+        yield from itertools.islice(block, bisect.bisect_left(block, x), None)
+        
+        for b in range(b + 1, len(self.blocks)):
+            yield from self.blocks[b]
+
 class IntervalDict():
     """
     Dict where a range of numbers map to a value 
     
-    Supports put, get, and split (not delete)
+    Supports put, get, split, and delete
+    The markers are kept in a BlockedSortedList, so all of these are O(log n)
+    Split intervals share their value until it is changed through mutate
     """
     
     def __init__(self):
-        self.markers = [] # This is both start and endpoints
+        self.markers = BlockedSortedList() # This is both start and endpoints
         self.dict = {}
-        self.list_len = 0
+        self.refs = {} # Number of intervals holding each value, by id, to know when mutate needs a copy
+        
+    @classmethod
+    def from_sorted(cls, intervals) -> 'IntervalDict':
+        """
+        Build the dictionary in O(n) from intervals that are already sorted and do not overlap,
+        which is checked in the same pass. Empty intervals are skipped, like in put
+        
+        :param intervals: iterable of ((interval_start, interval_end), value), as returned by items
+        """
+        result = cls()
+        result.replace_sorted(intervals)
+        return result
+    
+    def replace_sorted(self, intervals):
+        """
+        Replace all of the intervals in O(n) with ones that are already sorted and do not overlap, like from_sorted
+        
+        :param intervals: iterable of ((interval_start, interval_end), value), as returned by items
+        """
+        markers = []
+        values = {}
+        refs = {}
+        
+        for (start, end), value in intervals:
+            if start >= end:
+                continue
+            
+            if markers and start < markers[-1]:
+                print(f'----Unsorted : = Marker {markers[-1]:16x}    [{start:16x},{end:16x}]')
+                raise ValueError("Intervals overlap or are not sorted")
+            
+            # Touching intervals share a marker
+            if not markers or markers[-1] != start:
+                markers.append(start)
+            markers.append(end)
+            values[start] = value
+            refs[id(value)] = refs.get(id(value), 0) + 1
+            
+        self.markers = BlockedSortedList.from_sorted(markers)
+        self.dict = values
+        self.refs = refs
+    
+    def __len__(self) -> int:
+        """
+        Number of intervals in the dict
+        """
+        return len(self.dict)
     
     def put(self, start: int, end: int, value: any):
         """
@@ -53,33 +237,54 @@ class IntervalDict():
         :param value: value to add to the dict for the specified interval
         """
         
-        insert_idx = bisect.bisect_right(self.markers, start)
+        # An empty interval holds no keys, so there is nothing to store
+        if start >= end:
+            return
+        
+        prev_marker = self.markers.floor(start)
 
         # The previous marker is a start point so you are clearly in the middle.
-        if insert_idx > 0 and self.markers[insert_idx - 1] in self.dict:
-            print(f'----Overlap_B : = Idx: {insert_idx} Marker_At_Index {self.markers[insert_idx]:16x}    [{start:16x},{end:16x}]')
+        if prev_marker is not None and prev_marker in self.dict:
+            print(f'----Overlap_B : = Marker {prev_marker:16x}    [{start:16x},{end:16x}]')
             raise ValueError("Overlap Start interval")
         
         # Prev is not a start. So just check if your end will trample over the next interval
-        if self.list_len > insert_idx and self.markers[insert_idx] < end:
-            print(f'----Overlap_A : = Idx: {insert_idx} Marker_At_Index '
-                  f'{self.markers[insert_idx]:16x}    '
-                  f'{self.markers[insert_idx+1]:16x}    '
-                  f'[{start:16x},{end:16x}]')
+        next_marker = self.markers.higher(start)
+        if next_marker is not None and next_marker < end:
+            print(f'----Overlap_A : = Marker {next_marker:16x}    [{start:16x},{end:16x}]')
             raise ValueError("Overlap End interval")
 
-        # Insert the end point, if needed
-        if self.list_len <= insert_idx or self.markers[insert_idx] != end:
-            self.markers.insert(insert_idx, end)
-            self.list_len += 1
-        
-        # Insert the start point, if needed
-        if insert_idx == 0 or self.markers[insert_idx - 1] != start:
-            self.markers.insert(insert_idx, start)
-            self.list_len += 1
+        # Insert the end and start points, if needed
+        self.markers.add(end)
+        self.markers.add(start)
             
         # Insert the value to the dict
         self.dict[start] = value
+        self.add_ref(value)
+    
+    def delete(self, start: int):
+        """
+        Remove the interval starting at start
+        Its markers are removed too, unless they are also the end of the interval before or the start of the one after
+        """
+        val = self.dict.pop(start)
+        self.refs[id(val)] -= 1
+        if self.refs[id(val)] == 0:
+            del self.refs[id(val)]
+        
+        end = self.markers.higher(start)
+        if end not in self.dict:
+            self.markers.remove(end)
+        
+        prev_marker = self.markers.floor(start - 1)
+        if prev_marker is None or prev_marker not in self.dict:
+            self.markers.remove(start)
+    
+    def add_ref(self, value: any):
+        """
+        Count one more interval holding value
+        """
+        self.refs[id(value)] = self.refs.get(id(value), 0) + 1
         
     def get(self, key: int) -> tuple[tuple[int,int], any]:
         """
@@ -90,16 +295,17 @@ class IntervalDict():
                  or, if the key is not in any interval, ((None, None), None)
         """
         
-        idx = bisect.bisect_right(self.markers, key)
+        start = self.markers.floor(key)
+        end = self.markers.higher(key)
         
-        if idx == 0 or idx >= self.list_len:
+        if start is None or end is None:
             # Index not within any interval
             return (None, None), None
         
-        val = self.dict.get(self.markers[idx - 1])
+        val = self.dict.get(start)
         
         if val:
-            return (self.markers[idx - 1], self.markers[idx]), val
+            return (start, end), val
         else:
             return (None, None), None
         
@@ -112,80 +318,520 @@ class IntervalDict():
         :return: a list of tuples of the interval and value, ((interval_start, interval_end), val)
                  or, if the range does not contain any interval, an empty list
         """
+        return list(self.iter_interval(start, end))
+    
+    def iter_interval(self, start: int, end: int):
+        """
+        Iterate over the intervals and values contained within the specified interval, like get_interval
+        but without building the list
         
-        left_idx = bisect.bisect_left(self.markers, start + 1)
-        right_idx = bisect.bisect_right(self.markers, end - 1)
+        :param start: start of the range to search for in intervals
+        :param end: end of the range to search for in intervals
+        :return: a generator of tuples of the interval and value, ((interval_start, interval_end), val)
+        """
         
-        results = []
-        for i in range(left_idx - 1, right_idx):
-            if i < 0 or i >= self.list_len:
-                continue
+        # Start from the interval containing start, if any
+        first = self.markers.floor(start)
+        markers = self.markers.iter_from(start if first is None else first)
+        
+        prev_marker = next(markers, None)
+        for marker in markers:
+            if prev_marker >= end:
+                break
             
-            val = self.dict.get(self.markers[i])
+            val = self.dict.get(prev_marker)
         
             if val:
-                results.append(((self.markers[i], self.markers[i + 1]), val))
-
-        return results
+                yield (prev_marker, marker), val
+                
+            prev_marker = marker
     
     def split_interval(self, split_at: int) -> any:
         """
         Splits an interval by the given split_at point
-        The right split will get a shallow copy of the original value
+        The right split shares the original value, until one of the splits is changed through mutate
         
         :param split_at: point at which to split the interval
-        :return: the copied value
+        :return: the value of the right split
         """
         
+        start = self.markers.floor(split_at)
+        end = self.markers.higher(split_at)
+        val = self.dict.get(start)
+        
+        assert val is not None, f"Can't split a nonexistent interval at {split_at:16x}"
+        assert start != split_at and end != split_at, "Can't split an interval at the endpoint"
         
-        idx = bisect.bisect_right(self.markers, split_at)
-        val = self.dict.get(self.markers[idx - 1])
+        self.markers.add(split_at)
+        self.dict[split_at] = val
+        self.add_ref(val)
         
-        assert val is not None, f"Can't split a nonexistent interval [{self.markers[idx - 1]:16x}, {self.markers[idx]:16x}]"
-        assert self.markers[idx - 1] != split_at and self.markers[idx] != split_at, "Can't split an interval at the endpoint"
+        return val
+    
+    def mutate(self, start: int) -> any:
+        """
+        Get the value of the interval starting at start, to change it in place
+        If the value is shared with other intervals, the interval first gets its own shallow copy of it
+        
+        :param start: start of the interval
+        :return: the value, which no other interval holds
+        """
+        val = self.dict[start]
         
-        bisect.insort(self.markers, split_at)
-        self.list_len += 1
-        val_copy = copy.copy(val)
-        self.dict[split_at] = val_copy
+        if self.refs[id(val)] > 1:
+            self.refs[id(val)] -= 1
+            val = copy.copy(val)
+            self.dict[start] = val
+            self.add_ref(val)
         
-        return val_copy
+        return val
     
     def items(self) -> list[tuple[tuple[int,int], any]]:
         """
         Get a list of all the intervals and values in the dict
         """
         items = []
+        markers = iter(self.markers)
+        prev_marker = next(markers, None)
         
-        for i in range(self.list_len - 1):
-            value = self.dict.get(self.markers[i])
+        for marker in markers:
+            value = self.dict.get(prev_marker)
             
             if value:
-                items.append(((self.markers[i],self.markers[i+1]), value))
+                items.append(((prev_marker, marker), value))
+                
+            prev_marker = marker
     
         return items
     
+    def coalesce(self, equiv) -> dict[int,int]:
+        """
+        Merge touching intervals with equivalent values in one pass, keeping the value of the first one
+        
+        :param equiv: function of two values, true if their intervals can be merged
+        :return: dict from the old start of every interval that was merged into the one before it,
+                 to the start of the merged interval. Starts that did not change are not included
+        """
+        remap = {}
+        intervals = []
+        
+        for (start, end), value in self.items():
+            if intervals and intervals[-1][0][1] == start and equiv(intervals[-1][1], value):
+                (merged_start, _), merged_value = intervals[-1]
+                intervals[-1] = ((merged_start, end), merged_value)
+                remap[start] = merged_start
+            else:
+                intervals.append(((start, end), value))
+        
+        self.replace_sorted(intervals)
+        
+        return remap
+    
     def __str__(self):
         lines = []
-        for i in range(self.list_len - 1):
-            value = self.dict.get(self.markers[i])
-            
-            if value:
-                #lines.append(f'-[{self.endpoint_list[i]:16x},{self.endpoint_list[i+1]:16x}]: {value}')
-                lines.append(f'-[{self.markers[i]},{self.markers[i+1]}]: {value}')
+        for (start, end), value in self.items():
+            #lines.append(f'-[{start:16x},{end:16x}]: {value}')
+            lines.append(f'-[{start},{end}]: {value}')
 
         return '\n'.join(lines)
 
 
+def _treap_priority(start: int) -> int:
+    """
+    Deterministic priority of the node for an interval starting at start, so that the same intervals always
+    make the same tree, whatever order they were added in
+    The start is kept in the low bits to break ties
+    """
+    h = (start * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    h ^= h >> 31
+    return (h << 64) | (start & 0xFFFFFFFFFFFFFFFF)
+
+class _TreapNode():
+    """
+    Node of a PersistentIntervalDict
+    Nodes are not changed once they are in a tree, since they may be shared with other versions
+    """
+    __slots__ = ("start", "end", "value", "priority", "left", "right")
+    
+    def __init__(self, start: int, end: int, value: any, left: '_TreapNode' = None, right: '_TreapNode' = None):
+        self.start = start
+        self.end = end
+        self.value = value
+        self.priority = _treap_priority(start)
+        self.left = left
+        self.right = right
+    
+    def with_changes(self, **changes) -> '_TreapNode':
+        """
+        Copy of this node, with some of the fields changed
+        """
+        node = _TreapNode.__new__(_TreapNode)
+        node.start, node.end, node.value = self.start, self.end, self.value
+        node.priority, node.left, node.right = self.priority, self.left, self.right
+        for name, value in changes.items():
+            setattr(node, name, value)
+        return node
+
+def _treap_split(node: _TreapNode, key: int) -> tuple[_TreapNode, _TreapNode, _TreapNode]:
+    """
+    Split a tree into the nodes starting before key, the node starting at key if any, and the nodes after it
+    Only the nodes on the path to key are copied, the subtrees off it are shared
+    """
+    if node is None:
+        return None, None, None
+    if key < node.start:
+        left, mid, right = _treap_split(node.left, key)
+        return left, mid, node.with_changes(left=right)
+    if key > node.start:
+        left, mid, right = _treap_split(node.right, key)
+        return node.with_changes(right=left), mid, right
+    return node.left, node, node.right
+
+def _treap_merge(left: _TreapNode, right: _TreapNode) -> _TreapNode:
+    """
+    Join two trees, where every node of left starts before every node of right
+    """
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        return left.with_changes(right=_treap_merge(left.right, right))
+    return right.with_changes(left=_treap_merge(left, right.left))
+
+def _treap_nodes(node: _TreapNode):
+    """
+    Iterate over the nodes of a tree in order
+    """
+    stack = []
+    while stack or node is not None:
+        if node is not None:
+            stack.append(node)
+            node = node.left
+        else:
+            node = stack.pop()
+            yield node
+            node = node.right
+
+def _treap_diff(a: _TreapNode, b: _TreapNode):
+    """
+    Differences from tree a to tree b, see PersistentIntervalDict.diff
+    Subtrees shared by both are skipped. Since the shape of the tree only depends on the starts of the intervals,
+    a subtree only changed in b is split along the path to its root, and the rest stays shared
+    """
+    if a is b:
+        return
+    if a is None:
+        for node in _treap_nodes(b):
+            yield (node.start, node.end), None, node.value
+        return
+    if b is None:
+        for node in _treap_nodes(a):
+            yield (node.start, node.end), node.value, None
+        return
+    
+    # The root with the highest priority is also the root of the other tree, if that has the same start
+    if a.priority >= b.priority:
+        b_left, b_mid, b_right = _treap_split(b, a.start)
+        a_left, a_mid, a_right = a.left, a, a.right
+    else:
+        a_left, a_mid, a_right = _treap_split(a, b.start)
+        b_left, b_mid, b_right = b.left, b, b.right
+    
+    yield from _treap_diff(a_left, b_left)
+    
+    if a_mid is None:
+        yield (b_mid.start, b_mid.end), None, b_mid.value
+    elif b_mid is None:
+        yield (a_mid.start, a_mid.end), a_mid.value, None
+    elif a_mid.end != b_mid.end:
+        yield (a_mid.start, a_mid.end), a_mid.value, None
+        yield (b_mid.start, b_mid.end), None, b_mid.value
+    elif a_mid.value is not b_mid.value and a_mid.value != b_mid.value:
+        yield (a_mid.start, a_mid.end), a_mid.value, b_mid.value
+    
+    yield from _treap_diff(a_right, b_right)
+
+class PersistentIntervalDict(IntervalDict):
+    """
+    IntervalDict where every change makes a new version of the dict that shares most of its structure with the old one,
+    so snapshot is O(1) and diff between versions only looks at the parts that changed
+    
+    The intervals are kept in a treap with deterministic priorities, and changes copy the path to the nodes they change.
+    Put, get, and split are O(log n)
+    """
+    
+    def __init__(self):
+        self.root = None
+        self.len = 0
+        self.owned = {} # Values made by mutate since the last snapshot, by id, which no other version holds
+    
+    def replace_sorted(self, intervals):
+        """
+        Replace all of the intervals in O(n) with ones that are already sorted and do not overlap, like from_sorted
+        Nothing is shared with the previous version afterwards
+        
+        :param intervals: iterable of ((interval_start, interval_end), value), as returned by items
+        """
+        # Build the tree from left to right, with the nodes on its right edge on a stack
+        stack = []
+        prev_end = None
+        n = 0
+        
+        for (start, end), value in intervals:
+            if start >= end:
+                continue
+            
+            if prev_end is not None and start < prev_end:
+                print(f'----Unsorted : = Marker {prev_end:16x}    [{start:16x},{end:16x}]')
+                raise ValueError("Intervals overlap or are not sorted")
+            prev_end = end
+            
+            # The nodes are not in a tree yet, so they can still be changed
+            node = _TreapNode(start, end, value)
+            last = None
+            while stack and stack[-1].priority < node.priority:
+                last = stack.pop()
+            node.left = last
+            if stack:
+                stack[-1].right = node
+            stack.append(node)
+            n += 1
+        
+        self.root = stack[0] if stack else None
+        self.len = n
+        self.owned = {}
+    
+    def __len__(self) -> int:
+        """
+        Number of intervals in the dict
+        """
+        return self.len
+    
+    def snapshot(self) -> 'PersistentIntervalDict':
+        """
+        Get a copy of the dict in O(1), which is not affected by later changes to this one, or the other way around
+        """
+        result = PersistentIntervalDict()
+        result.root = self.root
+        result.len = self.len
+        
+        # Both versions now hold the values made by mutate
+        self.owned = {}
+        
+        return result
+    
+    def floor_node(self, key: int) -> _TreapNode:
+        """
+        Node of the last interval starting at or before key, or None
+        """
+        node = self.root
+        result = None
+        while node is not None:
+            if node.start <= key:
+                result = node
+                node = node.right
+            else:
+                node = node.left
+        return result
+    
+    def ceiling_node(self, key: int) -> _TreapNode:
+        """
+        Node of the first interval starting at or after key, or None
+        """
+        node = self.root
+        result = None
+        while node is not None:
+            if node.start >= key:
+                result = node
+                node = node.left
+            else:
+                node = node.right
+        return result
+    
+    def put(self, start: int, end: int, value: any):
+        """
+        Add a value to the dictionary for an interval key
+        This will fail if it overlaps an existing interval in the dict
+        Assumes closed start points and open end points
+        
+        :param start: start of the interval key
+        :param end: end of the interval key
+        :param value: value to add to the dict for the specified interval
+        """
+        
+        # An empty interval holds no keys, so there is nothing to store
+        if start >= end:
+            return
+        
+        prev = self.floor_node(start)
+        if prev is not None and prev.end > start:
+            print(f'----Overlap_B : = Marker {prev.start:16x}    [{start:16x},{end:16x}]')
+            raise ValueError("Overlap Start interval")
+        
+        next = self.ceiling_node(start)
+        if next is not None and next.start < end:
+            print(f'----Overlap_A : = Marker {next.start:16x}    [{start:16x},{end:16x}]')
+            raise ValueError("Overlap End interval")
+        
+        left, _, right = _treap_split(self.root, start)
+        self.root = _treap_merge(_treap_merge(left, _TreapNode(start, end, value)), right)
+        self.len += 1
+    
+    def delete(self, start: int):
+        """
+        Remove the interval starting at start
+        """
+        left, node, right = _treap_split(self.root, start)
+        
+        if node is None:
+            raise KeyError(start)
+        
+        self.root = _treap_merge(left, right)
+        self.len -= 1
+    
+    def get(self, key: int) -> tuple[tuple[int,int], any]:
+        """
+        Get the value for the interval containing the key
+        
+        :param key: the value to search for in intervals
+        :return: a tuple of the interval and value, ((interval_start, interval_end), val)
+                 or, if the key is not in any interval, ((None, None), None)
+        """
+        node = self.floor_node(key)
+        
+        if node is not None and key < node.end and node.value:
+            return (node.start, node.end), node.value
+        else:
+            return (None, None), None
+    
+    def iter_interval(self, start: int, end: int):
+        """
+        Iterate over the intervals and values contained within the specified interval, like get_interval
+        but without building the list
+        
+        :param start: start of the range to search for in intervals
+        :param end: end of the range to search for in intervals
+        :return: a generator of tuples of the interval and value, ((interval_start, interval_end), val)
+        """
+        # Start from the interval containing start, if any
+        first = self.floor_node(start)
+        key = first.start if first is not None and first.end > start else start
+        
+        # Nodes from key onwards, with the ones still to visit on a stack
+        stack = []
+        node = self.root
+        while node is not None:
+            if node.start >= key:
+                stack.append(node)
+                node = node.left
+            else:
+                node = node.right
+        
+        while stack:
+            node = stack.pop()
+            if node.start >= end:
+                break
+            
+            if node.value:
+                yield (node.start, node.end), node.value
+            
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+    
+    def replace_node(self, start: int, **changes):
+        """
+        Change the fields of the node for the interval starting at start, copying the path to it
+        """
+        def replace(node):
+            if node is None:
+                raise KeyError(start)
+            if start < node.start:
+                return node.with_changes(left=replace(node.left))
+            if start > node.start:
+                return node.with_changes(right=replace(node.right))
+            return node.with_changes(**changes)
+        
+        self.root = replace(self.root)
+    
+    def split_interval(self, split_at: int) -> any:
+        """
+        Splits an interval by the given split_at point
+        The right split shares the original value, until one of the splits is changed through mutate
+        
+        :param split_at: point at which to split the interval
+        :return: the value of the right split
+        """
+        node = self.floor_node(split_at)
+        
+        assert node is not None and split_at < node.end, f"Can't split a nonexistent interval at {split_at:16x}"
+        assert node.start != split_at, "Can't split an interval at the endpoint"
+        
+        self.replace_node(node.start, end=split_at)
+        self.put(split_at, node.end, node.value)
+        self.owned.pop(id(node.value), None)
+        
+        return node.value
+    
+    def mutate(self, start: int) -> any:
+        """
+        Get the value of the interval starting at start, to change it in place
+        Unless mutate already made it since the last snapshot, the interval first gets its own shallow copy of
+        the value, since other versions of the dict may hold it
+        
+        :param start: start of the interval
+        :return: the value, which no other interval or version holds
+        """
+        node = self.ceiling_node(start)
+        
+        if node is None or node.start != start:
+            raise KeyError(start)
+        
+        if self.owned.get(id(node.value)) is node.value:
+            return node.value
+        
+        val = copy.copy(node.value)
+        self.replace_node(start, value=val)
+        self.owned[id(val)] = val
+        
+        return val
+    
+    def items(self) -> list[tuple[tuple[int,int], any]]:
+        """
+        Get a list of all the intervals and values in the dict
+        """
+        return [((node.start, node.end), node.value) for node in _treap_nodes(self.root) if node.value]
+    
+    def diff(self, other: 'PersistentIntervalDict'):
+        """
+        Find the differences from this version of the dict to another, in order of their start
+        Subtrees the two versions share are skipped, so this is O(d log n) for d differences between a dict
+        and a snapshot of it. Unrelated dicts are compared in O(n)
+        
+        :param other: the other version
+        :return: a generator of (interval, value, other_value), with value None for an interval only in other,
+                 and other_value None for an interval only in this dict. An interval whose end changed is
+                 given as one of each
+        """
+        return _treap_diff(self.root, other.root)
+
+
 def insert_with_split(d: IntervalDict, start ,end, info: any):
     """
     Add new entry {(start, end), info} and if it overlaps with other entry(ies), 
     split them accordingly.
+    The parts of the new entry that do not overlap all get info, shared until changed through mutate
     """
     
+    if start >= end:
+        return
+    
     overlaps = d.get_interval(start, end)
+    
     for o in overlaps:
-        (existing_start, existing_end) , info = o
+        (existing_start, existing_end) , _ = o
 
 
         # Is there more of this new interval remaining.
@@ -213,6 +859,89 @@ def insert_with_split(d: IntervalDict, start ,end, info: any):
     if start < end:
         d.put(start, end , info)
 
+def insert_many_with_split(d: IntervalDict, intervals: list[tuple[int,int,any]]):
+    """
+    Add many new entries, with the same result as calling insert_with_split for each of them in order
+    
+    For a large batch, the new entries are sorted and merged with the existing intervals in one pass,
+    and the dict is rebuilt with from_sorted, in O(n + k log k) rather than k inserts. Only the clusters
+    of overlapping intervals are split, the existing intervals between them are kept as they are.
+    Rebuilding costs about as much per existing interval as half an insert does, so a batch with fewer
+    entries than the dict is inserted one entry at a time instead. So is any batch into a non-empty
+    PersistentIntervalDict, where rebuilding would stop it sharing anything with its snapshots.
+    
+    :param intervals: list of (start, end, info) for the new entries
+    """
+    
+    intervals = [interval for interval in intervals if interval[0] < interval[1]]
+    
+    if len(intervals) < len(d) or (isinstance(d, PersistentIntervalDict) and len(d)):
+        for (start, end, info) in intervals:
+            insert_with_split(d, start, end, info)
+        return
+    
+    existing = d.items()
+    existing_starts = [start for ((start, _), _) in existing]
+    existing_ends = [end for ((_, end), _) in existing]
+    order = sorted(range(len(intervals)), key=lambda i: intervals[i][0])
+    
+    parts = []
+    e = 0 # Next existing interval not yet in parts
+    o = 0 # Next new entry not yet in parts, in order of start
+    
+    while o < len(order):
+        # The cluster of new entries and existing intervals that overlap each other, transitively
+        cluster_start, cluster_end = intervals[order[o]][0], intervals[order[o]][1]
+        first_existing = bisect.bisect_right(existing_ends, cluster_start, e)
+        last_new = o + 1
+        while True:
+            while last_new < len(order) and intervals[order[last_new]][0] < cluster_end:
+                cluster_end = max(cluster_end, intervals[order[last_new]][1])
+                last_new += 1
+            last_existing = bisect.bisect_left(existing_starts, cluster_end, first_existing)
+            if last_existing > first_existing and existing_ends[last_existing - 1] > cluster_end:
+                cluster_end = existing_ends[last_existing - 1]
+            else:
+                break
+        
+        # The existing intervals before the cluster are unchanged
+        parts.extend(existing[e:first_existing])
+        
+        if last_new == o + 1 and last_existing == first_existing:
+            start, end, info = intervals[order[o]]
+            parts.append(((start, end), info))
+        else:
+            cluster = [order[n] for n in range(o, last_new)]
+            boundaries = sorted(set(existing_starts[first_existing:last_existing] + existing_ends[first_existing:last_existing] 
+                                    + [intervals[i][0] for i in cluster] + [intervals[i][1] for i in cluster]))
+            
+            # Each piece between two boundaries gets the value of the existing interval covering it, if any,
+            # or else of the earliest new entry covering it, like when the entries are inserted in order
+            x = first_existing # Existing interval that might cover the piece
+            n = 0 # Next new entry in the cluster to start
+            active = [] # Heap of (index, end) of the new entries that have started
+            
+            for piece_start, piece_end in zip(boundaries, boundaries[1:]):
+                while x < last_existing and existing_ends[x] <= piece_start:
+                    x += 1
+                while n < len(cluster) and intervals[cluster[n]][0] <= piece_start:
+                    heapq.heappush(active, (cluster[n], intervals[cluster[n]][1]))
+                    n += 1
+                while active and active[0][1] <= piece_start:
+                    heapq.heappop(active)
+                
+                if x < last_existing and existing_starts[x] <= piece_start:
+                    parts.append(((piece_start, piece_end), existing[x][1]))
+                elif active:
+                    parts.append(((piece_start, piece_end), intervals[active[0][0]][2]))
+        
+        e = last_existing
+        o = last_new
+    
+    parts.extend(existing[e:])
+    
+    d.replace_sorted(parts)
+
 #     ```
 #      Lies outside 
 #      Get_intervals should return zero here. 
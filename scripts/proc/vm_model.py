@@ -76,7 +76,8 @@ def get_host_state(vm_pid: int):
 
     data = ProcFsData()
     try:
-        extract_process_data(data, vm_pid, "qemu", True)
+        # Most of the guest memory reservation is usually not resident
+        extract_process_data(data, vm_pid, "qemu", True, sparse=True)
     except Exception as e:
         print("Error printing stats for QEMU")
         print(repr(e))